@@ -0,0 +1,211 @@
+import json
+import time
+import numpy as np
+from scipy import sparse
+from retrieval import topk_search
+
+
+def kmeans(X, n_clusters, n_iter=20, seed=0):
+
+    """This function returns the centroids of a k-means clustering of the rows of X"""
+
+    rng = np.random.default_rng(seed)
+    X = np.asarray(X, dtype=np.float32)
+    centroids = X[rng.choice(len(X), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        _, assign = topk_search(X, centroids, k=1, metric='sqeuclidean')
+        assign = assign[:, 0]
+
+        # Sum the points of every cluster with a sparse (n_clusters, N) assignment matrix
+        members = sparse.csr_matrix((np.ones(len(X), dtype=np.float32), (assign, np.arange(len(X)))),
+                                    shape=(n_clusters, len(X)))
+        counts = np.bincount(assign, minlength=n_clusters)
+        sums = members @ X
+
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        # Empty clusters are moved to random points
+        n_empty = np.count_nonzero(~nonempty)
+        if n_empty:
+            centroids[~nonempty] = X[rng.choice(len(X), n_empty, replace=False)]
+
+    return centroids
+
+
+def recall_at_k(approx_indices, exact_indices, k=10):
+
+    """This function returns the mean fraction of the exact top-k found by the approximate search"""
+
+    found = [len(np.intersect1d(a[:k], e[:k])) for a, e in zip(approx_indices, exact_indices)]
+    return np.mean(found) / k
+
+
+class IVFPQIndex:
+
+    """This class is an approximate nearest neighbour index: an inverted file with a k-means coarse quantizer,
+    where the residual of every vector to its centroid is product-quantized into n_subvectors bytes.
+    At query time only the nprobe closest lists are scanned, with asymmetric distances from lookup tables"""
+
+    def __init__(self, n_lists=256, n_subvectors=8, n_bits=8, metric='euclidean'):
+
+        assert metric in ('euclidean', 'cosine'), 'The IVF-PQ index supports euclidean and cosine distances'
+        self.n_lists = n_lists
+        self.n_subvectors = n_subvectors
+        self.n_bits = n_bits
+        self.metric = metric
+        self.dim = None
+        self.centroids = None
+        self.codebooks = None
+        self.list_offsets = None
+        self.list_ids = np.empty(0, dtype=np.int64)
+        self.list_codes = np.empty((0, n_subvectors), dtype=np.uint8)
+        # What the index was built from, see indexes.index_meta
+        self.meta = dict()
+
+    def _prepare(self, X):
+
+        """This function normalizes (cosine) and zero-pads the vectors to a multiple of n_subvectors"""
+
+        X = np.asarray(X, dtype=np.float32).reshape((len(X), -1))
+        if self.metric == 'cosine':
+            norms = np.linalg.norm(X, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            X = X / norms
+        pad = -X.shape[1] % self.n_subvectors
+        if pad:
+            X = np.pad(X, ((0, 0), (0, pad)))
+        return X
+
+    def _subvectors(self, X):
+        return X.reshape((len(X), self.n_subvectors, -1))
+
+    def train(self, X, n_iter=20, max_train=100000, seed=0):
+
+        """This function learns the coarse centroids and the product quantizer codebooks"""
+
+        self.dim = np.asarray(X).reshape((len(X), -1)).shape[1]
+        X = self._prepare(X)
+        if len(X) > max_train:
+            X = X[np.random.default_rng(seed).choice(len(X), max_train, replace=False)]
+
+        print('\nTraining IVF-PQ coarse quantizer on {:d} vectors...'.format(len(X)))
+        self.n_lists = min(self.n_lists, len(X))
+        self.centroids = kmeans(X, self.n_lists, n_iter, seed)
+
+        _, assign = topk_search(X, self.centroids, k=1, metric='sqeuclidean')
+        residuals = self._subvectors(X - self.centroids[assign[:, 0]])
+
+        print('Training product quantizer...')
+        n_codes = min(2 ** self.n_bits, len(X))
+        self.codebooks = np.stack([kmeans(residuals[:, m], n_codes, n_iter, seed)
+                                   for m in range(self.n_subvectors)])
+        self.list_offsets = np.zeros(self.n_lists + 1, dtype=np.int64)
+        print('Done training')
+
+    def add(self, X, ids=None):
+
+        """This function encodes the vectors and appends them to their inverted lists"""
+
+        X = self._prepare(X)
+        if ids is None:
+            ids = np.arange(len(self.list_ids), len(self.list_ids) + len(X))
+
+        _, assign = topk_search(X, self.centroids, k=1, metric='sqeuclidean')
+        assign = assign[:, 0]
+        residuals = self._subvectors(X - self.centroids[assign])
+        codes = np.empty((len(X), self.n_subvectors), dtype=np.uint8)
+        for m in range(self.n_subvectors):
+            codes[:, m] = topk_search(residuals[:, m], self.codebooks[m], k=1, metric='sqeuclidean')[1][:, 0]
+
+        # Keep the lists as one array sorted by list, with offsets, and merge the new vectors into it
+        old_lists = np.repeat(np.arange(self.n_lists), np.diff(self.list_offsets))
+        all_lists = np.concatenate([old_lists, assign])
+        order = np.argsort(all_lists, kind='stable')
+        self.list_ids = np.concatenate([self.list_ids, ids])[order]
+        self.list_codes = np.concatenate([self.list_codes, codes])[order]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(all_lists, minlength=self.n_lists))])
+
+    def search(self, Q, k=10, nprobe=8):
+
+        """This function returns the approximate distances and ids of the k nearest vectors of every query"""
+
+        Q = self._prepare(Q)
+        nprobe = min(nprobe, self.n_lists)
+        _, probes = topk_search(Q, self.centroids, k=nprobe, metric='sqeuclidean')
+        sub_range = np.arange(self.n_subvectors)
+
+        distances = np.full((len(Q), k), np.inf, dtype=np.float32)
+        indices = np.full((len(Q), k), -1, dtype=np.int64)
+        for q_idx, q in enumerate(Q):
+            cand_dist = []
+            cand_ids = []
+            for c in probes[q_idx]:
+                start, end = self.list_offsets[c], self.list_offsets[c + 1]
+                if start == end:
+                    continue
+                # Lookup table of the squared distances between the query residual and every code
+                residual = (q - self.centroids[c]).reshape((self.n_subvectors, 1, -1))
+                lut = ((residual - self.codebooks) ** 2).sum(axis=2)
+                cand_dist.append(lut[sub_range, self.list_codes[start:end]].sum(axis=1))
+                cand_ids.append(self.list_ids[start:end])
+
+            if not cand_dist:
+                continue
+            cand_dist = np.concatenate(cand_dist)
+            cand_ids = np.concatenate(cand_ids)
+            n = min(k, len(cand_dist))
+            best = np.argpartition(cand_dist, n - 1)[:n]
+            best = best[np.argsort(cand_dist[best], kind='stable')]
+            distances[q_idx, :n] = cand_dist[best]
+            indices[q_idx, :n] = cand_ids[best]
+
+        # Squared L2 distances are turned into the distances of the metric
+        if self.metric == 'cosine':
+            return distances / 2, indices
+        return np.sqrt(distances), indices
+
+    def save(self, index_file):
+
+        """This function writes the index to a .npz file"""
+
+        np.savez(index_file, n_lists=self.n_lists, n_subvectors=self.n_subvectors, n_bits=self.n_bits,
+                 metric=self.metric, dim=self.dim, centroids=self.centroids, codebooks=self.codebooks,
+                 list_offsets=self.list_offsets, list_ids=self.list_ids, list_codes=self.list_codes,
+                 meta=json.dumps(self.meta))
+
+    @classmethod
+    def load(cls, index_file):
+
+        """This function reads an index written by save"""
+
+        saved = np.load(index_file)
+        index = cls(int(saved['n_lists']), int(saved['n_subvectors']), int(saved['n_bits']), str(saved['metric']))
+        index.dim = int(saved['dim'])
+        index.centroids = saved['centroids']
+        index.codebooks = saved['codebooks']
+        index.list_offsets = saved['list_offsets']
+        index.list_ids = saved['list_ids']
+        index.list_codes = saved['list_codes']
+        index.meta = json.loads(str(saved['meta'])) if 'meta' in saved.files else dict()
+        return index
+
+
+def recall_sweep(index, E_query, E_gallery, k=10, nprobes=(1, 2, 4, 8, 16, 32, 64)):
+
+    """This function prints recall@k against the exact search and the query latency for several nprobe"""
+
+    _, exact = topk_search(E_query, E_gallery, k=k, metric=index.metric)
+
+    print('\n  nprobe   recall@{:d}   ms/query'.format(k))
+    results = []
+    for nprobe in nprobes:
+        if nprobe > index.n_lists:
+            break
+        start = time.perf_counter()
+        _, approx = index.search(E_query, k=k, nprobe=nprobe)
+        ms_query = 1000 * (time.perf_counter() - start) / len(E_query)
+        recall = recall_at_k(approx, exact, k)
+        print('{:8d} {:11.3f} {:10.3f}'.format(nprobe, recall, ms_query))
+        results.append((nprobe, recall, ms_query))
+    return results
@@ -109,10 +109,14 @@ class TripletsEncoder:
 
     # Inference
     def predict_triplets(self, x):
-        return self.triplets_encoder.layers[3].predict(x, verbose=1)
-
-    # Set neural network architecture
-    def set_arch(self):
+        # The three-branch model embeds with its shared encoder (layers[3]), the online one is the encoder itself
+        if len(self.triplets_encoder.inputs) == 3:
+            return self.triplets_encoder.layers[3].predict(x, verbose=1)
+        return self.triplets_encoder.predict(x, verbose=1)
+
+    # Set neural network architecture: 'triplets' for the three-branch model trained on sampled triplets,
+    # 'online' for the shared encoder alone, trained on P x K batches with a mining loss
+    def set_arch(self, mode='triplets'):
         input = tf.keras.layers.Input(shape=self.shape_img)
         x = tf.keras.layers.Conv2D(32, (3, 3), activation='relu', padding='same')(input)
         x = tf.keras.layers.MaxPooling2D((2, 2), padding='same')(x)
@@ -126,6 +130,11 @@ class TripletsEncoder:
 
         # Model
         model = tf.keras.models.Model(input, x)
+        if mode == 'online':
+            self.triplets_encoder = model
+            model.summary()
+            return
+
         triplet_model_a = tf.keras.layers.Input(self.shape_img)
         triplet_model_p = tf.keras.layers.Input(self.shape_img)
         triplet_model_n = tf.keras.layers.Input(self.shape_img)
@@ -136,8 +145,8 @@ class TripletsEncoder:
         triplet_model.summary()
 
     # Compiling
-    def compile_triplets(self, triplet_loss, optimizer="adam"):
-        self.triplets_encoder.compile(optimizer=optimizer, loss=triplet_loss, metrics=['accuracy'])
+    def compile_triplets(self, triplet_loss, optimizer="adam", metrics=('accuracy',)):
+        self.triplets_encoder.compile(optimizer=optimizer, loss=triplet_loss, metrics=list(metrics))
 
     # Fitting
     def fit_triplets(self, data_generator, steps_per_epoch, epochs, batch_size, wandb):
@@ -176,5 +185,6 @@ class TripletsEncoder:
     # Load model architecture and weights
     def load_triplets(self, triplet_loss, optimizer="adam"):
         print("Loading model...")
-        self.triplets_encoder = tf.keras.models.load_model(self.tripletsFile, custom_objects={'triplet_loss':triplet_loss})
+        # Compiled again below, so models trained with any of the triplet losses can be loaded
+        self.triplets_encoder = tf.keras.models.load_model(self.tripletsFile, compile=False)
         self.triplets_encoder.compile(optimizer=optimizer, loss=triplet_loss)
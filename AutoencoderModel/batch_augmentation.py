@@ -0,0 +1,148 @@
+import time
+import argparse
+import numpy as np
+
+
+class BatchAugmenter:
+
+    """This class applies the augmentation of transform.data_augmentation (rotation, zoom, shift, shear, flips and
+    random crop resized back to the image size) to whole (B, H, W, C) batches at once: every transformation of an
+    image is composed into one affine map, and all the images are resampled together with vectorized bilinear
+    interpolation. The crop size is a fraction of the image size, so any -img_size works"""
+
+    def __init__(self, crop_ratio=224/324, rotation_range=25, zoom_range=0.1, width_shift_range=0.1,
+                 height_shift_range=0.1, shear_range=0.2, horizontal_flip=True, vertical_flip=True, seed=None):
+
+        self.crop_ratio = crop_ratio
+        self.rotation_range = rotation_range
+        self.zoom_range = zoom_range
+        self.width_shift_range = width_shift_range
+        self.height_shift_range = height_shift_range
+        self.shear_range = shear_range
+        self.horizontal_flip = horizontal_flip
+        self.vertical_flip = vertical_flip
+        self.rng = np.random.default_rng(seed)
+
+    def sample_coordinates(self, B, H, W):
+
+        """This function returns, for every output pixel of every image, the (y, x) input coordinates to sample"""
+
+        rng = self.rng
+        ii = np.arange(H, dtype=np.float32)[None, :, None]
+        jj = np.arange(W, dtype=np.float32)[None, None, :]
+
+        # Random crop: the output grid covers a crop_size window of the augmented image
+        crop_h = max(1, int(round(H * self.crop_ratio)))
+        crop_w = max(1, int(round(W * self.crop_ratio)))
+        top = rng.integers(0, H - crop_h + 1, B).astype(np.float32)[:, None, None]
+        left = rng.integers(0, W - crop_w + 1, B).astype(np.float32)[:, None, None]
+        u = top + (ii + 0.5) * (crop_h / H) - 0.5 - (H - 1) / 2
+        v = left + (jj + 0.5) * (crop_w / W) - 0.5 - (W - 1) / 2
+
+        # Flips
+        if self.vertical_flip:
+            u = u * np.where(rng.random(B) < 0.5, -1, 1).astype(np.float32)[:, None, None]
+        if self.horizontal_flip:
+            v = v * np.where(rng.random(B) < 0.5, -1, 1).astype(np.float32)[:, None, None]
+
+        # Rotation, shear and zoom composed into one 2x2 matrix per image, then the shift
+        theta = np.deg2rad(rng.uniform(-self.rotation_range, self.rotation_range, B))
+        shear = np.deg2rad(rng.uniform(-self.shear_range, self.shear_range, B))
+        zoom_y, zoom_x = rng.uniform(1 - self.zoom_range, 1 + self.zoom_range, (2, B))
+        shift_y = rng.uniform(-self.height_shift_range, self.height_shift_range, B) * H
+        shift_x = rng.uniform(-self.width_shift_range, self.width_shift_range, B) * W
+
+        m00 = np.cos(theta) * zoom_y
+        m01 = -np.sin(theta + shear) * zoom_x
+        m10 = np.sin(theta) * zoom_y
+        m11 = np.cos(theta + shear) * zoom_x
+
+        def per_image(a):
+            return a.astype(np.float32)[:, None, None]
+
+        y = per_image(m00) * u + per_image(m01) * v + per_image(shift_y) + (H - 1) / 2
+        x = per_image(m10) * u + per_image(m11) * v + per_image(shift_x) + (W - 1) / 2
+        return y, x
+
+    def __call__(self, X):
+
+        """This function returns an augmented copy of a batch of images"""
+
+        X = np.asarray(X, dtype=np.float32)
+        B, H, W, _ = X.shape
+        y, x = self.sample_coordinates(B, H, W)
+
+        # Bilinear interpolation, pixels outside the image take the value of the nearest border pixel
+        y0 = np.floor(y)
+        x0 = np.floor(x)
+        wy = (y - y0)[..., None]
+        wx = (x - x0)[..., None]
+        y0 = y0.astype(np.intp)
+        x0 = x0.astype(np.intp)
+        y1 = np.clip(y0 + 1, 0, H - 1)
+        x1 = np.clip(x0 + 1, 0, W - 1)
+        y0 = np.clip(y0, 0, H - 1)
+        x0 = np.clip(x0, 0, W - 1)
+        b = np.arange(B)[:, None, None]
+
+        top = X[b, y0, x0] * (1 - wx) + X[b, y0, x1] * wx
+        bottom = X[b, y1, x0] * (1 - wx) + X[b, y1, x1] * wx
+        return top * (1 - wy) + bottom * wy
+
+    def flow(self, X, batch_size, shuffle=True):
+
+        """This function is a drop-in replacement of transform.data_augmentation: an infinite generator of
+        (augmented batch, augmented batch) pairs for the autoencoder"""
+
+        while True:
+            order = self.rng.permutation(len(X)) if shuffle else np.arange(len(X))
+            for start in range(0, len(X), batch_size):
+                batch = self(X[np.sort(order[start:start + batch_size])])
+                yield batch, batch
+
+
+def benchmark(img_size=324, batch_size=32, n_batches=5, seed=0):
+
+    """This function compares the throughput of the vectorized augmentation and of the current
+    ImageDataGenerator + random_crop path on random images"""
+
+    from transform import data_augmentation
+
+    X = np.random.default_rng(seed).random((batch_size * n_batches, img_size, img_size, 3), dtype=np.float32)
+
+    augmenter = BatchAugmenter(seed=seed)
+    start = time.perf_counter()
+    for start_idx in range(0, len(X), batch_size):
+        augmenter(X[start_idx:start_idx + batch_size])
+    vectorized = len(X) / (time.perf_counter() - start)
+
+    generator = data_augmentation(X, batch_size)
+    start = time.perf_counter()
+    for _ in range(n_batches):
+        generator.next()
+    keras = len(X) / (time.perf_counter() - start)
+
+    print('\nAugmentation throughput, {:d}x{:d} images, batches of {:d}'.format(img_size, img_size, batch_size))
+    print('>>> ImageDataGenerator + random_crop: {:.1f} images/sec'.format(keras))
+    print('>>> BatchAugmenter:                   {:.1f} images/sec ({:.1f}x)'.format(vectorized, vectorized / keras))
+    return keras, vectorized
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Augmentation throughput benchmark')
+    parser.add_argument('-img_size',
+                        type=int,
+                        default=324,
+                        help='image size for the model')
+    parser.add_argument('-bs',
+                        type=int,
+                        default=32,
+                        help='batch size')
+    parser.add_argument('-n_batches',
+                        type=int,
+                        default=5,
+                        help='number of batches augmented by each method')
+    args = parser.parse_args()
+
+    benchmark(args.img_size, args.bs, args.n_batches)
@@ -0,0 +1,104 @@
+import time
+import asyncio
+import threading
+from collections import deque
+import numpy as np
+
+
+class MicroBatcher:
+
+    """This class coalesces concurrent single-item requests into batches: a batch is run as soon as it has
+    max_batch_size items or its first item has waited max_wait_ms, with one call of batch_fn on the stacked
+    items (e.g. the encoder predict), and every request gets back its own row of the result"""
+
+    def __init__(self, batch_fn, max_batch_size=32, max_wait_ms=5., history=1000):
+
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.timings = deque(maxlen=history)
+        self.loop = None
+        self.queue = None
+        self.task = None
+
+    async def start(self):
+
+        """This function starts the batching task on the running event loop"""
+
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.task = self.loop.create_task(self.run())
+
+    def start_in_thread(self):
+
+        """This function runs the batcher on an event loop in a daemon thread, to be used from synchronous code"""
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start(), loop).result()
+
+    async def submit(self, item):
+
+        """This function queues one item and returns its result once its batch has been run"""
+
+        future = self.loop.create_future()
+        await self.queue.put((item, future, time.perf_counter()))
+        return await future
+
+    def submit_threadsafe(self, item):
+
+        """This function is the blocking version of submit, for threads other than the one of the event loop"""
+
+        return asyncio.run_coroutine_threadsafe(self.submit(item), self.loop).result()
+
+    async def run(self):
+
+        """This function collects the batches and runs them one at a time"""
+
+        while True:
+            batch = [await self.queue.get()]
+            deadline = self.loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.perf_counter()
+            try:
+                # The model runs in a worker thread so that new requests keep being queued meanwhile
+                results = await self.loop.run_in_executor(None, self.batch_fn, np.stack([item for item, _, _ in batch]))
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            end = time.perf_counter()
+
+            for i, (_, future, _) in enumerate(batch):
+                if not future.done():
+                    future.set_result(results[i])
+
+            self.timings.append({'size': len(batch),
+                                 'wait_ms': 1000 * (start - batch[0][2]),
+                                 'run_ms': 1000 * (end - start)})
+
+    def metrics(self):
+
+        """This function summarizes the timings of the last batches"""
+
+        if not self.timings:
+            return {'batches': 0}
+        sizes = np.array([t['size'] for t in self.timings])
+        waits = np.array([t['wait_ms'] for t in self.timings])
+        runs = np.array([t['run_ms'] for t in self.timings])
+        return {'batches': len(sizes),
+                'mean_batch_size': float(sizes.mean()),
+                'items_per_sec': float(sizes.sum() / (runs.sum() / 1000)) if runs.sum() > 0 else None,
+                'wait_ms_p50': float(np.percentile(waits, 50)),
+                'wait_ms_p99': float(np.percentile(waits, 99)),
+                'run_ms_p50': float(np.percentile(runs, 50)),
+                'run_ms_p99': float(np.percentile(runs, 99))}
@@ -0,0 +1,437 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+from ann import IVFPQIndex, recall_at_k
+from hnsw import HNSWIndex
+from hashing import BinaryHashIndex
+from retrieval import topk_search
+from indexes import INDEX_FILES, index_search_fn
+from profiling import peak_rss_mb
+
+
+DISTANCES = ('knn', 'pairwise', 'ivfpq', 'hnsw', 'hamming')
+ENCODERS = ('convAE', 'triplets_loss', 'pretrained')
+
+
+def synthetic_embeddings(n_gallery, n_query, dim=128, n_classes=100, noise=0.6, seed=0, block_size=65536):
+
+    """This function returns clustered Gaussian embeddings (float32), so that the neighbours of a query are
+    meaningful: n_classes centers on the unit sphere, every gallery and query row is a center plus noise.
+    The same seed always gives the same gallery and queries"""
+
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_classes, dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+
+    def sample(n):
+        classes = rng.integers(0, n_classes, n)
+        X = np.empty((n, dim), dtype=np.float32)
+        # Written block by block, 1M x 128 embeddings stay at their final 512 MB
+        for start in range(0, n, block_size):
+            c = classes[start:start + block_size]
+            X[start:start + block_size] = centers[c] + noise / np.sqrt(dim) * rng.normal(size=(len(c), dim))
+        return X, classes
+
+    E_gallery, gallery_classes = sample(n_gallery)
+    E_query, query_classes = sample(n_query)
+    return E_gallery, gallery_classes, E_query, query_classes
+
+
+def synthetic_gallery(gallery_dir, n_images, img_size=64, n_classes=10, seed=0):
+
+    """This function writes n_images JPEG images (a colour per class plus noise) into n_classes subfolders of
+    gallery_dir, the layout read by Loader.get_files. A gallery already written is reused"""
+
+    from tensorflow.keras.preprocessing.image import save_img
+
+    done_file = os.path.join(gallery_dir, 'done.json')
+    if os.path.exists(done_file):
+        with open(done_file) as f:
+            if json.load(f) == {'n_images': n_images, 'img_size': img_size, 'n_classes': n_classes, 'seed': seed}:
+                return
+        shutil.rmtree(gallery_dir)
+
+    rng = np.random.default_rng(seed)
+    colours = rng.uniform(0, 255, size=(n_classes, 3))
+    for c in range(n_classes):
+        os.makedirs(os.path.join(gallery_dir, str(c)), exist_ok=True)
+    for i in range(n_images):
+        c = i % n_classes
+        img = np.clip(colours[c] + rng.normal(0, 40, size=(img_size, img_size, 3)), 0, 255)
+        save_img(os.path.join(gallery_dir, str(c), '{:07d}.jpg'.format(i)), img, scale=False)
+
+    with open(done_file, 'w') as f:
+        json.dump({'n_images': n_images, 'img_size': img_size, 'n_classes': n_classes, 'seed': seed}, f)
+
+
+def latency_stats(latencies, n_items):
+
+    """This function returns the throughput (items per second over all the calls) and the p50 and p99 latency of
+    the calls in milliseconds"""
+
+    latencies = np.asarray(latencies)
+    total = latencies.sum()
+    return {
+        'throughput': n_items / total if total > 0 else None,
+        'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+        'p99_ms': 1000 * float(np.percentile(latencies, 99)),
+        'total_s': float(total),
+    }
+
+
+def timed_calls(fn, batches, repeat=1):
+
+    """This function calls fn on every batch and returns the time of every call, the fastest of repeat runs
+    (like timeit, the other runs only add the noise of the machine)"""
+
+    latencies = np.full(len(batches), np.inf)
+    for _ in range(repeat):
+        for i, batch in enumerate(batches):
+            start = time.perf_counter()
+            fn(batch)
+            latencies[i] = min(latencies[i], time.perf_counter() - start)
+    return latencies
+
+
+def build_index(distance, E_gallery, n_lists=256, n_subvectors=8, M=16, ef_construction=100, n_bits=256):
+
+    """This function trains and fills the index of an approximate distance (None for knn and pairwise)"""
+
+    if distance == 'ivfpq':
+        # At least about 40 training vectors per list
+        index = IVFPQIndex(n_lists=min(n_lists, max(1, len(E_gallery) // 40)), n_subvectors=n_subvectors,
+                           metric="cosine")
+        index.train(E_gallery)
+        index.add(E_gallery)
+        return index
+    if distance == 'hnsw':
+        index = HNSWIndex(metric="cosine", M=M, ef_construction=ef_construction)
+        index.add(E_gallery)
+        return index
+    if distance == 'hamming':
+        index = BinaryHashIndex(n_bits=n_bits)
+        index.train(E_gallery)
+        index.add(E_gallery)
+        return index
+    return None
+
+
+def index_size_mb(index, distance, tmp_dir):
+
+    """This function returns the size in MB of the saved index"""
+
+    index_file = os.path.join(tmp_dir, INDEX_FILES[distance])
+    index.save(index_file)
+    size = os.path.getsize(index_file) / 2 ** 20
+    os.remove(index_file)
+    return size
+
+
+def benchmark_search(scales, distances, dim=128, n_query=100, k=10, max_hnsw=10000, seed=0, repeat=3, **params):
+
+    """This function runs, for every scale and distance, the index build and the queries on synthetic embeddings:
+    build time and index size, throughput of the batched search, p50/p99 latency of single queries (best of
+    repeat runs) and recall@k against the exact search"""
+
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    for n in scales:
+        E_gallery, _, E_query, _ = synthetic_embeddings(n, n_query, dim, seed=seed)
+        gallery_ids = list(range(n))
+        exact = {'cosine': topk_search(E_query, E_gallery, k=k, metric="cosine")[1],
+                 'euclidean': topk_search(E_query, E_gallery, k=k, metric="minkowski", p=2.)[1]}
+        print('\n{:d} gallery embeddings of size {:d} ({:.1f} MB)'.format(n, dim, E_gallery.nbytes / 2 ** 20))
+
+        for distance in distances:
+            row = {'stage': 'search', 'method': distance, 'scale': n, 'dim': dim}
+            if distance == 'hnsw' and n > max_hnsw:
+                # The graph is built one insertion at a time in Python
+                results.append(dict(row, skipped='scale above -max_hnsw'))
+                continue
+
+            start = time.perf_counter()
+            index = build_index(distance, E_gallery, params.get('n_lists', 256), params.get('n_subvectors', 8),
+                                params.get('M', 16), params.get('ef_construction', 100), params.get('n_bits', 256))
+            row['build_s'] = time.perf_counter() - start
+            row['index_mb'] = index_size_mb(index, distance, tmp_dir) if index is not None else E_gallery.nbytes / 2 ** 20
+
+            search = index_search_fn(distance, index, E_gallery, gallery_ids, 'minkowski', params.get('nprobe', 8),
+                                     params.get('ef', 50), params.get('shortlist', 100))
+            start = time.perf_counter()
+            indices = np.asarray(search(E_query, k))
+            batch_s = time.perf_counter() - start
+
+            row.update(latency_stats(timed_calls(lambda q: search(q, k), [E_query[i:i + 1] for i in range(n_query)],
+                                                 repeat), n_query))
+            row['batch_throughput'] = n_query / batch_s
+            row['recall'] = recall_at_k(indices, exact['euclidean' if distance == 'pairwise' else 'cosine'], k)
+            row['peak_rss_mb'] = peak_rss_mb()
+            print('{:>9s} build {:8.2f} s  {:9.1f} q/s  p50 {:8.2f} ms  p99 {:8.2f} ms  recall@{:d} {:.3f}'.format(
+                distance, row['build_s'], row['batch_throughput'], row['p50_ms'], row['p99_ms'], k, row['recall']))
+            results.append(row)
+        del E_gallery
+    shutil.rmtree(tmp_dir)
+    return results
+
+
+def benchmark_encoder(model_name, shape_img, output_dir, n_images=256, batch_size=32):
+
+    """This function times the embedding of random images, batch_size at a time, with the trained encoder when
+    its weights are in output_dir, otherwise with the same architecture randomly initialized"""
+
+    from encoders import load_encoder
+    from autoencoder import AutoEncoder, TripletsEncoder
+    from pooling import pretrained_encoder
+
+    weights = {'convAE': "ConvAE_encoder.h5", 'triplets_loss': "triplets_encoder.h5"}.get(model_name)
+    if weights is None or os.path.exists(os.path.join(output_dir, weights)):
+        embed = load_encoder(model_name, shape_img, output_dir)[0]
+        # The pretrained encoder has the ImageNet weights
+        trained = True
+    else:
+        if model_name == 'convAE':
+            model = AutoEncoder(shape_img, None, None)
+            model.set_arch()
+            model = model.encoder
+        else:
+            model = TripletsEncoder(shape_img, None)
+            model.set_arch(mode='online')
+            model = model.triplets_encoder
+        embed = model.predict
+        trained = False
+
+    rng = np.random.default_rng(0)
+    batches = [rng.random((batch_size,) + shape_img, dtype=np.float32) for _ in range(n_images // batch_size)]
+    # The first call builds the graph, it is not timed
+    embed(batches[0])
+    row = {'stage': 'embed', 'method': model_name, 'scale': n_images, 'img_size': shape_img[0],
+           'batch_size': batch_size, 'trained_weights': trained}
+    row.update(latency_stats(timed_calls(embed, batches), len(batches) * batch_size))
+    row['peak_rss_mb'] = peak_rss_mb()
+    print('{:>14s} {:9.1f} images/s  p50 {:8.2f} ms  p99 {:8.2f} ms per batch of {:d}'.format(
+        model_name, row['throughput'], row['p50_ms'], row['p99_ms'], batch_size))
+    return row
+
+
+def benchmark_load(gallery_dir, n_images, img_size=64, batch_size=32, n_workers=None):
+
+    """This function writes a synthetic gallery of n_images, then times its listing with Loader.get_files and its
+    decoding with Loader.read_images, batch_size images at a time"""
+
+    from image_loading import Loader
+
+    synthetic_gallery(gallery_dir, n_images, img_size)
+    loader = Loader(img_size, img_size, 3)
+
+    start = time.perf_counter()
+    images_paths = sorted(loader.get_files(gallery_dir, n_workers))
+    list_s = time.perf_counter() - start
+
+    batches = [images_paths[start:start + batch_size] for start in range(0, len(images_paths), batch_size)]
+    row = {'stage': 'load', 'method': 'read_images', 'scale': n_images, 'img_size': img_size,
+           'batch_size': batch_size, 'list_s': list_s}
+    row.update(latency_stats(timed_calls(lambda paths: loader.read_images(paths, n_workers), batches), n_images))
+    row['peak_rss_mb'] = peak_rss_mb()
+    print('{:>14s} {:9.1f} images/s  p50 {:8.2f} ms  p99 {:8.2f} ms per batch, listed in {:.3f} s'.format(
+        'load', row['throughput'], row['p50_ms'], row['p99_ms'], list_s))
+    return row
+
+
+def git_commit():
+
+    """This function returns the current commit of the repository, or None outside of git"""
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results_file, results, **settings):
+
+    """This function writes the results sorted by stage, method and scale, with sorted keys and one value per
+    line, so that the results files of two commits can be compared with diff"""
+
+    results = sorted(results, key=lambda row: (row['stage'], row['method'], row['scale']))
+    report = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': settings,
+        'results': results,
+    }
+    results_dir = os.path.dirname(results_file)
+    if results_dir and not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    with open(results_file, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print('\nResults written to {:s}'.format(results_file))
+
+
+def compare_results(old_file, new_file, tolerance=0.1):
+
+    """This function prints the throughput and p50 latency of every row present in both results files, and
+    flags the rows more than tolerance slower than before (the p99 of a single run is too noisy to compare).
+    It returns the number of regressions"""
+
+    rows = []
+    for results_file in (old_file, new_file):
+        with open(results_file) as f:
+            report = json.load(f)
+        rows.append({(r['stage'], r['method'], r['scale']): r for r in report['results'] if 'throughput' in r})
+    old, new = rows
+
+    regressions = 0
+    print('\n{:>7s} {:>14s} {:>8s} {:>12s} {:>12s} {:>8s} {:>10s} {:>10s}'.format(
+        'stage', 'method', 'scale', 'old items/s', 'new items/s', 'ratio', 'old p50', 'new p50'))
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key]['throughput'] / old[key]['throughput']
+        slower = ratio < 1 - tolerance or new[key]['p50_ms'] > (1 + tolerance) * old[key]['p50_ms']
+        regressions += slower
+        print('{:>7s} {:>14s} {:8d} {:12.1f} {:12.1f} {:8.2f} {:10.2f} {:10.2f}{:s}'.format(
+            *key, old[key]['throughput'], new[key]['throughput'], ratio, old[key]['p50_ms'], new[key]['p50_ms'],
+            '  <-- slower' if slower else ''))
+    print('\n{:d} regressions beyond {:.0%}'.format(regressions, tolerance))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark of the retrieval stages on synthetic galleries')
+    parser.add_argument('-stages',
+                        type=str,
+                        default='search',
+                        help='comma separated stages: load (synthetic images), embed (encoders), search (synthetic '
+                             'embeddings)')
+    parser.add_argument('-scales',
+                        type=str,
+                        default='1000,10000,100000,1000000',
+                        help='comma separated gallery sizes of the search stage')
+    parser.add_argument('-distances',
+                        type=str,
+                        default=','.join(DISTANCES),
+                        help='comma separated distances of the search stage')
+    parser.add_argument('-dim',
+                        type=int,
+                        default=128,
+                        help='size of the synthetic embeddings')
+    parser.add_argument('-n_query',
+                        type=int,
+                        default=100,
+                        help='number of queries')
+    parser.add_argument('-k',
+                        type=int,
+                        default=10,
+                        help='number of gallery images returned per query')
+    parser.add_argument('-max_hnsw',
+                        type=int,
+                        default=10000,
+                        help='largest gallery indexed with hnsw, its graph is built in Python')
+    parser.add_argument('-n_lists',
+                        type=int,
+                        default=256,
+                        help='number of inverted lists of the ivfpq index')
+    parser.add_argument('-n_subvectors',
+                        type=int,
+                        default=8,
+                        help='number of bytes of the product-quantized codes of the ivfpq index')
+    parser.add_argument('-nprobe',
+                        type=int,
+                        default=8,
+                        help='number of inverted lists scanned per query by the ivfpq index')
+    parser.add_argument('-M',
+                        type=int,
+                        default=16,
+                        help='number of links per node of the hnsw graph')
+    parser.add_argument('-ef_construction',
+                        type=int,
+                        default=100,
+                        help='size of the candidate list used to insert images in the hnsw graph')
+    parser.add_argument('-ef',
+                        type=int,
+                        default=50,
+                        help='size of the candidate list of the hnsw search')
+    parser.add_argument('-n_bits',
+                        type=int,
+                        default=256,
+                        help='number of bits of the binary codes of the hamming search')
+    parser.add_argument('-shortlist',
+                        type=int,
+                        default=100,
+                        help='number of gallery images re-ranked after the hamming search')
+    parser.add_argument('-encoders',
+                        type=str,
+                        default=','.join(ENCODERS),
+                        help='comma separated encoders of the embed stage')
+    parser.add_argument('-img_size',
+                        type=int,
+                        default=324,
+                        help='image size of the embed stage')
+    parser.add_argument('-n_images',
+                        type=int,
+                        default=1000,
+                        help='number of synthetic images of the load stage')
+    parser.add_argument('-bs',
+                        type=int,
+                        default=32,
+                        help='batch size of the load and embed stages')
+    parser.add_argument('-workers',
+                        type=int,
+                        default=None,
+                        help='number of threads used to decode the images (default = one per CPU)')
+    parser.add_argument('-repeat',
+                        type=int,
+                        default=3,
+                        help='runs of the queries, the fastest time of every query is kept')
+    parser.add_argument('-seed',
+                        type=int,
+                        default=0,
+                        help='seed of the synthetic data')
+    parser.add_argument('-out',
+                        type=str,
+                        default=None,
+                        help='results file (default = output/benchmarks/<commit>.json)')
+    parser.add_argument('-compare',
+                        type=str,
+                        default=None,
+                        help='results file of a previous run to compare with')
+    parser.add_argument('-tolerance',
+                        type=float,
+                        default=0.1,
+                        help='slowdown reported as a regression by -compare (default = 0.1, 10%%)')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    results = []
+    if 'load' in stages:
+        GalleryDir = os.path.join(os.getcwd(), "output", "benchmarks", "gallery_{}".format(args.n_images))
+        results.append(benchmark_load(GalleryDir, args.n_images, 64, args.bs, args.workers))
+    if 'embed' in stages:
+        shape_img = (args.img_size, args.img_size, 3)
+        for model_name in args.encoders.split(','):
+            OutputDir = os.path.join(os.getcwd(), "output", model_name)
+            results.append(benchmark_encoder(model_name, shape_img, OutputDir, 8 * args.bs, args.bs))
+    if 'search' in stages:
+        results.extend(benchmark_search([int(n) for n in args.scales.split(',')], args.distances.split(','),
+                                        args.dim, args.n_query, args.k, args.max_hnsw, args.seed, args.repeat,
+                                        n_lists=args.n_lists, n_subvectors=args.n_subvectors, M=args.M,
+                                        ef_construction=args.ef_construction, n_bits=args.n_bits,
+                                        nprobe=args.nprobe, ef=args.ef, shortlist=args.shortlist))
+
+    ResultsFile = args.out
+    if ResultsFile is None:
+        ResultsFile = os.path.join(os.getcwd(), "output", "benchmarks", "{}.json".format(git_commit() or 'results'))
+    save_results(ResultsFile, results, **vars(args))
+
+    if args.compare is not None:
+        sys.exit(1 if compare_results(args.compare, ResultsFile, args.tolerance) else 0)
@@ -0,0 +1,67 @@
+import tensorflow as tf
+from tensorflow.keras.layers.experimental import preprocessing
+from image_loading import IMG_EXTENSIONS
+
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def decode_img(img_path, img_size):
+
+    """This function reads, decodes and resizes one image file into a normalized (img_size, img_size, 3) tensor,
+    with the nearest neighbour interpolation used by load_img"""
+
+    img = tf.io.decode_image(tf.io.read_file(img_path), channels=3, expand_animations=False)
+    img = tf.image.resize(img, (img_size, img_size), method='nearest')
+    return tf.cast(img, tf.float32) / 255
+
+
+def random_crop(img, img_size, crop_ratio=224/324):
+
+    """This function crops a random square of crop_ratio * img_size and resizes it back to img_size,
+    like transform.random_crop does for the default image size"""
+
+    crop_size = int(round(img_size * crop_ratio))
+    img = tf.image.random_crop(img, (crop_size, crop_size, 3))
+    return tf.image.resize(img, (img_size, img_size))
+
+
+def batch_augmentation():
+
+    """This function returns the augmentation applied to whole batches, the same transformations as
+    transform.data_augmentation except the shear, which has no Keras preprocessing layer"""
+
+    return tf.keras.Sequential([
+        preprocessing.RandomFlip('horizontal_and_vertical'),
+        preprocessing.RandomRotation(25/360, fill_mode='nearest'),
+        preprocessing.RandomZoom(0.1, fill_mode='nearest'),
+        preprocessing.RandomTranslation(0.1, 0.1, fill_mode='nearest'),
+    ])
+
+
+def make_train_dataset(data_mapping, img_size, batch_size, augment=True, cache=None, shuffle_buffer=1024):
+
+    """This function returns an infinite tf.data pipeline of (image, image) batches for AutoEncoder.fit.
+    The files of a Loader.get_files mapping are streamed from disk and decoded with a parallel map, so the
+    training set does not have to fit in memory. cache='' keeps the decoded images in memory after the first
+    epoch, a file name caches them on disk"""
+
+    images_paths = [img_path for img_path in data_mapping.keys() if img_path.endswith(IMG_EXTENSIONS)]
+
+    dataset = tf.data.Dataset.from_tensor_slices(images_paths)
+    dataset = dataset.shuffle(len(images_paths), reshuffle_each_iteration=True)
+    dataset = dataset.map(lambda img_path: decode_img(img_path, img_size), num_parallel_calls=AUTOTUNE)
+    if cache is not None:
+        dataset = dataset.cache(cache)
+    dataset = dataset.shuffle(shuffle_buffer).repeat()
+
+    if augment:
+        augmentation = batch_augmentation()
+        dataset = dataset.map(lambda img: random_crop(img, img_size), num_parallel_calls=AUTOTUNE)
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.map(lambda imgs: augmentation(imgs, training=True), num_parallel_calls=AUTOTUNE)
+    else:
+        dataset = dataset.batch(batch_size)
+
+    dataset = dataset.map(lambda imgs: (imgs, imgs), num_parallel_calls=AUTOTUNE)
+    return dataset.prefetch(AUTOTUNE)
@@ -0,0 +1,163 @@
+import os
+import hashlib
+import numpy as np
+
+
+def file_hash(file_path, block_size=1 << 20):
+
+    """This function returns the sha1 of the content of a file"""
+
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def model_fingerprint(weights, img_size, layer):
+
+    """This function returns a short id of the model used to compute the embeddings.
+    weights is either the path of a .h5 file (hashed by content) or a name such as 'imagenet'"""
+
+    h = hashlib.sha1()
+    if os.path.isfile(weights):
+        h.update(file_hash(weights).encode())
+    else:
+        h.update(str(weights).encode())
+    h.update(str(img_size).encode())
+    h.update(str(layer).encode())
+    return h.hexdigest()[:16]
+
+
+class EmbeddingCache:
+
+    """This class persists the embeddings of the images on disk, so that only new or changed
+    images have to be decoded and embedded again. There is one cache file per model fingerprint: new
+    embeddings are appended as small segment files, merged into it every max_segments segments, when
+    the stale entries are dropped (see compact)"""
+
+    def __init__(self, cache_dir, fingerprint, content_hash=False, max_segments=8):
+
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.cache_file = os.path.join(cache_dir, fingerprint + '.npz')
+        self.content_hash = content_hash
+        self.max_segments = max_segments
+        self.index = {}
+        self.embeddings = None
+        # Keys requested since the cache was opened, always kept by compact
+        self.used = set()
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.segments = sorted(os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+                               if name.startswith(fingerprint + '_') and name.endswith('.npz')
+                               and not name.endswith('.tmp.npz'))
+        for cache_file in ([self.cache_file] if os.path.exists(self.cache_file) else []) + self.segments:
+            cached = np.load(cache_file)
+            self.add(list(cached['keys']), cached['embeddings'])
+
+    def image_key(self, img_path):
+
+        """This function returns the key of an image: its content hash, or path + mtime + size"""
+
+        if self.content_hash:
+            return file_hash(img_path)
+        stat = os.stat(img_path)
+        return '{:s}:{:d}:{:d}'.format(os.path.abspath(img_path), stat.st_mtime_ns, stat.st_size)
+
+    def is_current(self, key):
+
+        """This function checks whether a path + mtime + size key still matches its image on disk
+        (content hashes are not checked, it would mean reading every image)"""
+
+        if self.content_hash:
+            return False
+        img_path, mtime, size = key.rsplit(':', 2)
+        try:
+            stat = os.stat(img_path)
+        except OSError:
+            return False
+        return (str(stat.st_mtime_ns), str(stat.st_size)) == (mtime, size)
+
+    def get_embeddings(self, images_paths, embed_fn):
+
+        """This function returns the flattened embeddings of the images, calling embed_fn(paths)
+        only on the images that are not already in the cache"""
+
+        keys = [self.image_key(img_path) for img_path in images_paths]
+        missing = [i for i, key in enumerate(keys) if key not in self.index]
+        print('\nEmbedding cache: {:d} hits, {:d} misses'.format(len(keys) - len(missing), len(missing)))
+        self.used.update(keys)
+
+        if missing:
+            new_embeddings = np.asarray(embed_fn([images_paths[i] for i in missing]))
+            new_embeddings = new_embeddings.reshape((len(missing), -1))
+            self.add([keys[i] for i in missing], new_embeddings)
+            self.append([keys[i] for i in missing], new_embeddings)
+
+        if not keys:
+            return np.empty((0, 0), dtype=np.float32)
+        return self.embeddings[[self.index[key] for key in keys]]
+
+    def add(self, keys, embeddings):
+
+        """This function adds new embeddings to the cache"""
+
+        first_row = 0 if self.embeddings is None else len(self.embeddings)
+        for i, key in enumerate(keys):
+            self.index[key] = first_row + i
+        if self.embeddings is None:
+            self.embeddings = embeddings
+        else:
+            self.embeddings = np.concatenate([self.embeddings, embeddings])
+
+    def append(self, keys, embeddings):
+
+        """This function writes new embeddings to a new segment file, and compacts the cache
+        once there are max_segments segments"""
+
+        n_segment = 0
+        if self.segments:
+            n_segment = int(os.path.basename(self.segments[-1])[len(self.fingerprint) + 1:-len('.npz')]) + 1
+        segment_file = os.path.join(self.cache_dir, '{:s}_{:05d}.npz'.format(self.fingerprint, n_segment))
+        tmp_file = segment_file[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_file, keys=np.array(keys), embeddings=embeddings)
+        os.replace(tmp_file, segment_file)
+        self.segments.append(segment_file)
+        if len(self.segments) >= self.max_segments:
+            self.compact()
+
+    def compact(self):
+
+        """This function rewrites the cache file with the live entries only, the ones requested since
+        the cache was opened or whose image did not change, and removes the segment files"""
+
+        keys = [key for key in sorted(self.index, key=self.index.get) if key in self.used or self.is_current(key)]
+        print('\nEmbedding cache: compacting, {:d} of {:d} entries kept'.format(len(keys), len(self.index)))
+        self.embeddings = self.embeddings[[self.index[key] for key in keys]]
+        self.index = {key: row for row, key in enumerate(keys)}
+        self.save()
+        for segment_file in self.segments:
+            os.remove(segment_file)
+        self.segments = []
+
+    def save(self):
+
+        """This function writes the whole cache to the cache file"""
+
+        keys = sorted(self.index, key=self.index.get)
+        tmp_file = self.cache_file + '.tmp.npz'
+        np.savez(tmp_file, keys=np.array(keys), embeddings=self.embeddings)
+        os.replace(tmp_file, self.cache_file)
+
+
+def embed_with_cache(images_paths, embed_fn, cache=None):
+
+    """This function returns the flattened embeddings of the images, using the cache if given"""
+
+    if cache is None:
+        embeddings = np.asarray(embed_fn(images_paths))
+        return embeddings.reshape((len(images_paths), -1))
+    return cache.get_embeddings(images_paths, embed_fn)
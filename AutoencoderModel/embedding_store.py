@@ -0,0 +1,140 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def gallery_hash(images_paths):
+
+    """This function returns a hash of the paths, modification times and sizes of the gallery images"""
+
+    h = hashlib.sha1()
+    for img_path in images_paths:
+        stat = os.stat(img_path)
+        h.update('{:s}:{:d}:{:d}\n'.format(img_path, stat.st_mtime_ns, stat.st_size).encode())
+    return h.hexdigest()
+
+
+def save_embedding_matrix(store_path, embeddings, names, paths=None, classes=None, dtype='float32', chunk_size=4096,
+                          fingerprint=None):
+
+    """This function writes the gallery embeddings as a flat (N, D) .npy matrix plus a .json sidecar
+    with the names, paths and classes of the images, the model fingerprint and the hash of the gallery.
+    The matrix is written in chunks through a memmap"""
+
+    embeddings = embeddings.reshape((len(embeddings), -1))
+    tmp_file = store_path + '.tmp.npy'
+    matrix = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype, shape=embeddings.shape)
+    for start in range(0, len(embeddings), chunk_size):
+        matrix[start:start + chunk_size] = embeddings[start:start + chunk_size]
+    matrix.flush()
+    del matrix
+    os.replace(tmp_file, store_path + '.npy')
+    write_sidecar(store_path, names, paths, classes, dtype, embeddings.shape, fingerprint)
+
+    print('\nSaved {:d} embeddings of size {:d} to {:s}'.format(embeddings.shape[0], embeddings.shape[1], store_path))
+
+
+def write_sidecar(store_path, names, paths, classes, dtype, shape, fingerprint=None):
+
+    """This function writes the .json sidecar of a store"""
+
+    sidecar = {
+        'fingerprint': fingerprint or '',
+        'gallery': None if paths is None else gallery_hash(paths),
+        'names': list(names),
+        'paths': None if paths is None else list(paths),
+        'classes': None if classes is None else np.asarray(classes).tolist(),
+        'dtype': np.dtype(dtype).name,
+        'shape': list(shape),
+    }
+    with open(store_path + '.json', 'w') as f:
+        json.dump(sidecar, f)
+
+
+def extract_embedding_matrix(store_path, images_paths, names, embed_paths, chunk_size=256, dtype='float32',
+                             classes=None, fingerprint=None):
+
+    """This function embeds the images chunk by chunk with embed_paths (paths -> embeddings) and writes every
+    chunk to the store as soon as it is computed, so the memory is bounded by chunk_size and not by the gallery.
+    The number of rows written is kept in a progress file: after a crash, the extraction restarts from there if
+    the images, the chunk size and the model fingerprint are the same, otherwise from the first image"""
+
+    tmp_file = store_path + '.tmp.npy'
+    progress_file = store_path + '.progress.json'
+    paths_id = hashlib.sha1('\n'.join(images_paths).encode()).hexdigest()
+
+    done, matrix = 0, None
+    if os.path.exists(progress_file) and os.path.exists(tmp_file):
+        with open(progress_file) as f:
+            progress = json.load(f)
+        # Rows embedded by another model are not reused
+        if (progress['paths'], progress['chunk_size'], progress.get('fingerprint')) == (paths_id, chunk_size,
+                                                                                         fingerprint or ''):
+            matrix = np.lib.format.open_memmap(tmp_file, mode='r+')
+            done = progress['done']
+            print('\nResuming the extraction at image {:d} of {:d}'.format(done, len(images_paths)))
+
+    for start in range(done, len(images_paths), chunk_size):
+        embeddings = np.asarray(embed_paths(images_paths[start:start + chunk_size]))
+        embeddings = embeddings.reshape((len(embeddings), -1))
+        if matrix is None:
+            matrix = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype,
+                                               shape=(len(images_paths), embeddings.shape[1]))
+        matrix[start:start + len(embeddings)] = embeddings
+        matrix.flush()
+
+        progress_tmp = progress_file + '.tmp'
+        with open(progress_tmp, 'w') as f:
+            json.dump({'paths': paths_id, 'chunk_size': chunk_size, 'fingerprint': fingerprint or '',
+                       'done': start + len(embeddings)}, f)
+        os.replace(progress_tmp, progress_file)
+        print('Embedded {:d} / {:d} images'.format(start + len(embeddings), len(images_paths)))
+
+    if matrix is None:
+        matrix = np.empty((0, 0), dtype=dtype)
+        np.save(tmp_file, matrix)
+    shape = matrix.shape
+    del matrix
+    os.replace(tmp_file, store_path + '.npy')
+    write_sidecar(store_path, names, images_paths, classes, dtype, shape, fingerprint)
+    if os.path.exists(progress_file):
+        os.remove(progress_file)
+
+    return load_embedding_matrix(store_path)[0]
+
+
+def load_embedding_matrix(store_path):
+
+    """This function opens a store written by save_embedding_matrix. The matrix is memory-mapped read-only,
+    so the pages are shared between processes and nothing is read until it is used"""
+
+    embeddings = np.load(store_path + '.npy', mmap_mode='r')
+    with open(store_path + '.json') as f:
+        sidecar = json.load(f)
+
+    classes = sidecar['classes']
+    if classes is not None:
+        classes = np.array(classes)
+
+    print('\nOpened {:d} embeddings of size {:d} from {:s}'.format(embeddings.shape[0], embeddings.shape[1], store_path))
+
+    return embeddings, sidecar['names'], sidecar['paths'], classes
+
+
+def store_mismatch(store_path, fingerprint, images_paths):
+
+    """This function returns the fields of the sidecar of a store (model fingerprint, gallery hash) that differ
+    from the ones of the current model and gallery images"""
+
+    with open(store_path + '.json') as f:
+        sidecar = json.load(f)
+    current = {'fingerprint': fingerprint or '', 'gallery': gallery_hash(images_paths)}
+    return [key for key in current if sidecar.get(key) != current[key]]
+
+
+def store_exists(store_path):
+
+    """This function checks whether both files of a store exist"""
+
+    return os.path.exists(store_path + '.npy') and os.path.exists(store_path + '.json')
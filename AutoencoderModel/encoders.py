@@ -0,0 +1,74 @@
+import os
+from autoencoder import AutoEncoder, TripletsEncoder
+from triplets import triplet_loss
+from embedding_cache import model_fingerprint
+from inference import make_embed_fn
+from quantization import tflite_file, load_tflite_encoder
+from pooling import pretrained_encoder
+from profiling import stage
+
+
+def load_encoder_model(model_name, shape_img, output_dir, pooling='none'):
+
+    """This function loads the Keras model mapping normalized images to embeddings,
+    together with the weights file and the layer used to fingerprint it.
+    pooling selects the head of the pretrained ResNet50 (none, gap, gem, rmac), see pooling.py"""
+
+    if model_name == 'convAE':
+        autoencoderFile = os.path.join(output_dir, "ConvAE_autoecoder.h5")
+        encoderFile = os.path.join(output_dir, "ConvAE_encoder.h5")
+        model = AutoEncoder(shape_img, autoencoderFile, encoderFile)
+        model.load_models(loss='mse', optimizer="adam")
+        return model.encoder, (encoderFile, 'encoder')
+
+    if model_name == 'pretrained':
+        print("\nLoading model...")
+        model = pretrained_encoder(shape_img, pooling)
+        return model, ('imagenet', 'resnet50_notop' if pooling == 'none' else 'resnet50_' + pooling)
+
+    tripletsFile = os.path.join(output_dir, "triplets_encoder.h5")
+    triplet_model = TripletsEncoder(shape_img, tripletsFile)
+    triplet_model.load_triplets(triplet_loss, optimizer="adam")
+    # The shared encoder of the three-branch model, or the model itself when trained with online mining
+    model = triplet_model.triplets_encoder
+    if len(model.inputs) == 3:
+        model = model.layers[3]
+    return model, (tripletsFile, 'layers[3]')
+
+
+def timed(embed):
+
+    """This function returns embed recorded as the predict stage of the profiler"""
+
+    def timed_embed(X):
+        with stage('predict', len(X)):
+            return embed(X)
+
+    return timed_embed
+
+
+def load_encoder(model_name, shape_img, output_dir, precision='float32', jit=False, pooling='none'):
+
+    """This function loads the model once and returns a function embedding a batch of normalized images
+    into flattened vectors, together with the model fingerprint used by the embedding cache.
+    precision (mixed_bfloat16, mixed_float16) and jit select a compiled inference, see inference.py,
+    int8 runs the TFLite model exported by quantization.py"""
+
+    if precision == 'int8':
+        tfliteFile = tflite_file(output_dir, pooling)
+        # The TFLite file is hashed by content, the model and pooling head tell apart identical exports
+        return timed(load_tflite_encoder(tfliteFile)), model_fingerprint(tfliteFile, shape_img[0],
+                                                                          '{}_{}/int8'.format(model_name, pooling))
+
+    model, (weights, layer) = load_encoder_model(model_name, shape_img, output_dir, pooling)
+
+    if precision == 'float32' and not jit:
+        def embed(X):
+            return model.predict(X.reshape((-1,) + shape_img)).reshape((len(X), -1))
+    else:
+        embed = make_embed_fn(model, precision, jit)
+
+    # Embeddings computed in another precision are cached apart
+    if precision != 'float32':
+        layer = layer + '/' + precision
+    return timed(embed), model_fingerprint(weights, shape_img[0], layer)
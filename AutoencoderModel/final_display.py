@@ -1,5 +1,6 @@
 import requests
 import json
+from profiling import stage
 
 
 def submit(results, url):
@@ -27,9 +28,10 @@ def create_results_dict(results_dict, query_img, gallery_list):
     """This function returns the dictionary of the results.
     Specifically, the query and the rispective gallery images ranked"""
 
-    results_dict[query_img] = []
-    for gallery_img in gallery_list:
-        results_dict[query_img].append(gallery_img)
+    with stage('results', 1):
+        results_dict[query_img] = []
+        for gallery_img in gallery_list:
+            results_dict[query_img].append(gallery_img)
 
 
 
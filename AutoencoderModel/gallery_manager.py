@@ -0,0 +1,173 @@
+import os
+import json
+import argparse
+from hnsw import HNSWIndex
+
+
+def scan_images(images_paths):
+
+    """This function returns the (modification time, size) of every image"""
+
+    scan = dict()
+    for img_path in images_paths:
+        stat = os.stat(img_path)
+        scan[img_path] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+    return scan
+
+
+def scan_gallery(gallery_dir):
+
+    """This function returns the (modification time, size) of every image of the gallery folder"""
+
+    from image_loading import list_imgs_no_subfolders
+    return scan_images(list_imgs_no_subfolders(gallery_dir))
+
+
+def load_manifest(manifest_file):
+
+    """This function reads the manifest of the indexed gallery: image path -> mtime, size and graph node"""
+
+    if not os.path.exists(manifest_file):
+        return dict()
+    with open(manifest_file) as f:
+        return json.load(f)['images']
+
+
+def load_manifest_meta(manifest_file):
+
+    """This function reads what the graph of the manifest was built from (see indexes.index_meta)"""
+
+    if not os.path.exists(manifest_file):
+        return dict()
+    with open(manifest_file) as f:
+        return json.load(f).get('meta', dict())
+
+
+def save_manifest(manifest_file, manifest, meta=None):
+
+    """This function writes the manifest atomically, with what the graph was built from"""
+
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'images': manifest, 'meta': dict() if meta is None else meta}, f)
+    os.replace(tmp_file, manifest_file)
+
+
+def diff_gallery(manifest, scan):
+
+    """This function returns the added, changed and removed images of the gallery with respect to the manifest"""
+
+    added = [img_path for img_path in scan if img_path not in manifest]
+    removed = [img_path for img_path in manifest if img_path not in scan]
+    changed = [img_path for img_path in scan if img_path in manifest and
+               (manifest[img_path]['mtime'], manifest[img_path]['size']) != (scan[img_path]['mtime'], scan[img_path]['size'])]
+    return added, changed, removed
+
+
+def sync_gallery(index, manifest, scan, embed_paths, batch_size=256):
+
+    """This function updates the index and the manifest in place: removed and changed images are tombstoned,
+    added and changed images are embedded (with embed_paths) and inserted, the others are left untouched"""
+
+    added, changed, removed = diff_gallery(manifest, scan)
+    print('\nGallery: {:d} added, {:d} changed, {:d} removed, {:d} unchanged'.format(
+        len(added), len(changed), len(removed), len(scan) - len(added) - len(changed)))
+
+    for img_path in removed + changed:
+        index.mark_deleted(manifest.pop(img_path)['node'])
+
+    to_insert = added + changed
+    for start in range(0, len(to_insert), batch_size):
+        batch_paths = to_insert[start:start + batch_size]
+        first_node = index.count
+        index.add(embed_paths(batch_paths), batch_paths)
+        for i, img_path in enumerate(batch_paths):
+            manifest[img_path] = dict(scan[img_path], node=first_node + i)
+
+    return added, changed, removed
+
+
+if __name__ == '__main__':
+
+    from image_loading import Loader
+    from encoders import load_encoder
+    from indexes import meta_mismatch
+
+    parser = argparse.ArgumentParser(description='Incremental update of the gallery index')
+    parser.add_argument('--data_path',
+                        '-d',
+                        type=str,
+                        default='dataset_test',
+                        help='Dataset path, the gallery folder inside it is indexed')
+    parser.add_argument('-img_size',
+                        type=int,
+                        default=324,
+                        help='image size for the model')
+    parser.add_argument('-channels',
+                        type=int,
+                        default=3,
+                        help='number of channels')
+    parser.add_argument('-model',
+                        type=str,
+                        default='convAE',
+                        help='Default model = convAE, other options: pretrained, triplets_loss')
+    parser.add_argument('-M',
+                        type=int,
+                        default=16,
+                        help='number of links per node of the hnsw graph')
+    parser.add_argument('-ef_construction',
+                        type=int,
+                        default=100,
+                        help='size of the candidate list used to insert images in the hnsw graph')
+    parser.add_argument('-compact',
+                        type=str,
+                        default='False',
+                        help='Rebuild the graph without the tombstoned images (default = False)')
+    parser.add_argument('-workers',
+                        type=int,
+                        default=None,
+                        help='number of threads used to decode the images (default = one per CPU)')
+    args = parser.parse_args()
+
+    shape_img = (args.img_size, args.img_size, args.channels)
+    GalleryDir = os.path.join(os.getcwd(), args.data_path, "gallery")
+    OutputDir = os.path.join(os.getcwd(), "output", args.model)
+    if not os.path.exists(OutputDir):
+        os.makedirs(OutputDir)
+    # Same graph as the one searched by main.test.py and server.py with -distance hnsw
+    IndexFile = os.path.join(OutputDir, "hnsw_index.pickle")
+    ManifestFile = os.path.join(OutputDir, "gallery_manifest.json")
+
+    embed, fingerprint = load_encoder(args.model, shape_img, OutputDir)
+    meta = {'fingerprint': fingerprint, 'reduce': 'none'}
+    index, manifest, rebuilt = None, dict(), False
+    if os.path.exists(IndexFile):
+        index = HNSWIndex.load(IndexFile)
+        manifest = load_manifest(ManifestFile)
+        mismatch = meta_mismatch(index, meta)
+        if mismatch or load_manifest_meta(ManifestFile) != index.meta:
+            print('The saved graph was built from another model ({}), rebuilding it'.format(
+                ', '.join(mismatch or ['manifest'])))
+            index, manifest = None, dict()
+    if index is None:
+        index = HNSWIndex(metric="cosine", M=args.M, ef_construction=args.ef_construction)
+        index.meta = dict(meta)
+        rebuilt = True
+
+    scan = scan_gallery(GalleryDir)
+    added, changed, removed = diff_gallery(manifest, scan)
+
+    loader = Loader(args.img_size, args.img_size, args.channels)
+    sync_gallery(index, manifest, scan, lambda paths: embed(loader.read_images(paths, args.workers) / 255))
+    if index.vectors is not None:
+        index.meta['dim'] = int(index.vectors.shape[1])
+
+    if args.compact == 'True':
+        print('Compacting the graph ({:d} tombstones)'.format(len(index.deleted)))
+        index = index.compact()
+        manifest = {img_path: dict(manifest[img_path], node=node) for node, img_path in enumerate(index.labels)}
+
+    if added or changed or removed or rebuilt or args.compact == 'True':
+        index.save(IndexFile)
+        save_manifest(ManifestFile, manifest, index.meta)
+    print('Done: {:d} images in the graph, {:d} tombstones'.format(len(index), len(index.deleted)))
@@ -0,0 +1,180 @@
+import json
+import time
+import numpy as np
+from retrieval import topk_search, block_distances
+from ann import recall_at_k
+
+
+# Number of set bits of every byte
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def hamming_distances(Q_codes, G_codes):
+
+    """This function returns the (len(Q_codes), len(G_codes)) Hamming distances between packed binary codes,
+    with a xor and a popcount lookup table"""
+
+    xor = np.bitwise_xor(Q_codes[:, None, :], G_codes[None, :, :])
+    return POPCOUNT[xor].sum(axis=2, dtype=np.uint16)
+
+
+class BinaryHashIndex:
+
+    """This class is a binary hashing index: the embeddings are projected on their n_bits principal components
+    (mean-centered, 'mean') or on an ITQ rotation of them ('itq'), and the sign of every projection is packed
+    into bits, 32x smaller than float32. The search ranks the gallery by Hamming distance and re-ranks the
+    shortlist with the exact distance between the float embeddings"""
+
+    def __init__(self, n_bits=256, method='itq', n_iter=50, seed=0):
+
+        assert method in ('mean', 'itq'), 'The binary hashing method is mean or itq'
+        assert n_bits % 8 == 0, 'The number of bits must be a multiple of 8'
+        self.n_bits = n_bits
+        self.method = method
+        self.n_iter = n_iter
+        self.seed = seed
+        self.mean = None
+        self.projection = None
+        self.codes = np.empty((0, n_bits // 8), dtype=np.uint8)
+        # What the index was built from, see indexes.index_meta
+        self.meta = dict()
+
+    def train(self, X, max_train=20000):
+
+        """This function learns the mean, the principal components and (itq) the rotation of the bits"""
+
+        rng = np.random.default_rng(self.seed)
+        if len(X) > max_train:
+            X = X[np.sort(rng.choice(len(X), max_train, replace=False))]
+        X = np.asarray(X, dtype=np.float32).reshape((len(X), -1))
+        self.mean = X.mean(axis=0)
+        X = X - self.mean
+
+        _, _, Vt = np.linalg.svd(X, full_matrices=False)
+        n_components = min(self.n_bits, len(Vt))
+        projection = Vt[:n_components].T
+        if n_components < self.n_bits:
+            # Fewer principal components than bits: the remaining bits use random directions
+            extra = rng.normal(size=(X.shape[1], self.n_bits - n_components)).astype(np.float32)
+            projection = np.hstack([projection, extra / np.linalg.norm(extra, axis=0)])
+
+        if self.method == 'itq':
+            # Iterative quantization: alternate the bits B = sign(VR) and the rotation R minimizing ||B - VR||
+            V = X @ projection
+            R = np.linalg.qr(rng.normal(size=(self.n_bits, self.n_bits)))[0].astype(np.float32)
+            for _ in range(self.n_iter):
+                B = np.where(V @ R >= 0, 1., -1.).astype(np.float32)
+                U, _, Wt = np.linalg.svd(V.T @ B)
+                R = U @ Wt
+            projection = projection @ R
+
+        self.projection = np.ascontiguousarray(projection, dtype=np.float32)
+        return self
+
+    def encode(self, X, block_size=4096):
+
+        """This function returns the packed binary codes of the embeddings, one block of rows at a time"""
+
+        codes = np.empty((len(X), self.n_bits // 8), dtype=np.uint8)
+        for start in range(0, len(X), block_size):
+            block = np.asarray(X[start:start + block_size], dtype=np.float32).reshape((-1, len(self.mean)))
+            codes[start:start + block_size] = np.packbits((block - self.mean) @ self.projection >= 0, axis=1)
+        return codes
+
+    def add(self, X):
+
+        """This function appends the codes of new gallery embeddings"""
+
+        self.codes = np.concatenate([self.codes, self.encode(X)])
+
+    def hamming_search(self, Q, shortlist=100, query_block=64, gallery_block=8192):
+
+        """This function returns the indices of the shortlist gallery codes closest to every query in Hamming
+        distance, computed one (query_block, gallery_block) tile at a time"""
+
+        Q_codes = self.encode(Q)
+        shortlist = min(shortlist, len(self.codes))
+        top_dist = np.full((len(Q), shortlist), np.iinfo(np.uint16).max, dtype=np.uint16)
+        candidates = np.zeros((len(Q), shortlist), dtype=np.int64)
+
+        for q_start in range(0, len(Q), query_block):
+            q_codes = Q_codes[q_start:q_start + query_block]
+            best_dist = top_dist[q_start:q_start + query_block]
+            best_indx = candidates[q_start:q_start + query_block]
+
+            for g_start in range(0, len(self.codes), gallery_block):
+                g_codes = self.codes[g_start:g_start + gallery_block]
+                dist = hamming_distances(q_codes, g_codes)
+
+                # Merge the running shortlist with the new block, as in retrieval.topk_search
+                cand_dist = np.concatenate([best_dist, dist], axis=1)
+                cand_indx = np.concatenate([best_indx, np.broadcast_to(np.arange(g_start, g_start + len(g_codes)),
+                                                                       dist.shape)], axis=1)
+                part = np.argpartition(cand_dist, shortlist - 1, axis=1)[:, :shortlist]
+                best_dist[:] = np.take_along_axis(cand_dist, part, axis=1)
+                best_indx[:] = np.take_along_axis(cand_indx, part, axis=1)
+
+        return candidates
+
+    def search(self, Q, E_gallery, k=10, shortlist=100, metric='cosine'):
+
+        """This function returns the distances and indices of the k nearest gallery embeddings of every query:
+        Hamming shortlist, then exact distances (metric) between the float embeddings of the shortlist"""
+
+        candidates = self.hamming_search(Q, max(shortlist, k))
+        k = min(k, candidates.shape[1])
+        distances = np.empty((len(Q), k), dtype=np.float32)
+        indices = np.empty((len(Q), k), dtype=np.int64)
+
+        for i, cand in enumerate(candidates):
+            cand = np.sort(cand)
+            q = np.asarray(Q[i:i + 1], dtype=np.float32).reshape((1, -1))
+            G = np.asarray(E_gallery[cand], dtype=np.float32).reshape((len(cand), -1))
+            dist = block_distances(q, G, metric, 2., np.einsum('ij,ij->i', q, q), np.einsum('ij,ij->i', G, G))[0]
+            order = np.argsort(dist)[:k]
+            distances[i] = dist[order]
+            indices[i] = cand[order]
+        return distances, indices
+
+    def save(self, index_file):
+
+        """This function writes the index to a .npz file"""
+
+        np.savez(index_file, n_bits=self.n_bits, method=self.method, n_iter=self.n_iter, seed=self.seed,
+                 mean=self.mean, projection=self.projection, codes=self.codes, meta=json.dumps(self.meta))
+
+    @classmethod
+    def load(cls, index_file):
+
+        """This function reads an index written by save"""
+
+        saved = np.load(index_file)
+        index = cls(int(saved['n_bits']), str(saved['method']), int(saved['n_iter']), int(saved['seed']))
+        index.mean = saved['mean']
+        index.projection = saved['projection']
+        index.codes = saved['codes']
+        index.meta = json.loads(str(saved['meta'])) if 'meta' in saved.files else dict()
+        return index
+
+
+def hashing_recall_sweep(index, E_query, E_gallery, k=10, shortlists=(10, 50, 100, 200, 500, 1000), metric='cosine'):
+
+    """This function prints recall@k against the exact search and the query latency for several shortlists,
+    and the memory of the codes compared with the float32 embeddings"""
+
+    _, exact = topk_search(E_query, E_gallery, k=k, metric=metric)
+    float_bytes = 4 * len(E_gallery) * int(np.prod(E_gallery.shape[1:]))
+    print('\nCodes: {:.2f} MB, float32 embeddings: {:.2f} MB'.format(index.codes.nbytes / 2 ** 20, float_bytes / 2 ** 20))
+
+    print('\n  shortlist   recall@{:d}   ms/query'.format(k))
+    results = []
+    for shortlist in shortlists:
+        if shortlist > len(E_gallery):
+            break
+        start = time.perf_counter()
+        _, approx = index.search(E_query, E_gallery, k=k, shortlist=shortlist, metric=metric)
+        ms_query = 1000 * (time.perf_counter() - start) / len(E_query)
+        recall = recall_at_k(approx, exact, k)
+        print('{:11d} {:11.3f} {:10.3f}'.format(shortlist, recall, ms_query))
+        results.append((shortlist, recall, ms_query))
+    return results
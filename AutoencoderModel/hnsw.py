@@ -0,0 +1,214 @@
+import heapq
+import pickle
+import numpy as np
+
+
+class HNSWIndex:
+
+    """This class is a hierarchical navigable small world graph index. Every vector is a node linked to its
+    nearest nodes on a random number of layers, queries descend greedily from the sparse top layer and run a
+    best-first search on the bottom one. New vectors are inserted one by one, so the index never needs a rebuild"""
+
+    def __init__(self, metric='cosine', M=16, ef_construction=100, seed=0):
+
+        assert metric in ('euclidean', 'cosine'), 'The HNSW index supports euclidean and cosine distances'
+        self.metric = metric
+        self.M = M
+        self.M0 = 2 * M
+        self.ef_construction = ef_construction
+        self.level_mult = 1 / np.log(M)
+        self.rng = np.random.default_rng(seed)
+
+        self.vectors = None
+        self.count = 0
+        self.labels = []
+        self.neighbors = []
+        self.entry_point = None
+        self.max_level = -1
+        self.deleted = set()
+        # What the graph was built from, see indexes.index_meta
+        self.meta = dict()
+
+    def __len__(self):
+        return self.count - len(self.deleted)
+
+    def mark_deleted(self, node):
+
+        """This function tombstones a node: it still links the graph but is never returned by search"""
+
+        self.deleted.add(node)
+
+    def live_labels(self):
+
+        """This function returns the labels of the nodes that are not deleted"""
+
+        return [label for node, label in enumerate(self.labels) if node not in self.deleted]
+
+    def compact(self):
+
+        """This function returns a new index built from the nodes that are not deleted"""
+
+        live = [node for node in range(self.count) if node not in self.deleted]
+        index = HNSWIndex(self.metric, self.M, self.ef_construction)
+        index.meta = dict(self.meta)
+        if live:
+            index.add(self.vectors[live], [self.labels[node] for node in live])
+        return index
+
+    def _prepare(self, X):
+        X = np.asarray(X, dtype=np.float32).reshape((len(X), -1))
+        if self.metric == 'cosine':
+            norms = np.linalg.norm(X, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            X = X / norms
+        return X
+
+    def _distances(self, q, ids):
+
+        """This function returns the distances between a prepared query and some nodes"""
+
+        V = self.vectors[ids]
+        if self.metric == 'cosine':
+            return 1 - V @ q
+        diff = V - q
+        return np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+    def _search_layer(self, q, entry_points, ef, level):
+
+        """This function runs the best-first search of one layer and returns the ef closest (distance, node)"""
+
+        visited = set(entry_points)
+        dists = self._distances(q, entry_points)
+        candidates = [(d, n) for d, n in zip(dists, entry_points)]
+        heapq.heapify(candidates)
+        results = [(-d, n) for d, n in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            dist, node = heapq.heappop(candidates)
+            if dist > -results[0][0]:
+                break
+            new_nodes = [n for n in self.neighbors[node][level] if n not in visited]
+            if not new_nodes:
+                continue
+            visited.update(new_nodes)
+            for n, d in zip(new_nodes, self._distances(q, new_nodes)):
+                if len(results) < ef or d < -results[0][0]:
+                    heapq.heappush(candidates, (d, n))
+                    heapq.heappush(results, (-d, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted((-d, n) for d, n in results)
+
+    def _shrink(self, node, level, max_links):
+
+        """This function keeps only the max_links closest neighbours of a node"""
+
+        links = self.neighbors[node][level]
+        if len(links) > max_links:
+            dists = self._distances(self.vectors[node], links)
+            self.neighbors[node][level] = [links[i] for i in np.argsort(dists)[:max_links]]
+
+    def _grow(self, n_new, dim):
+        if self.vectors is None:
+            self.vectors = np.empty((max(n_new, 1024), dim), dtype=np.float32)
+        elif self.count + n_new > len(self.vectors):
+            capacity = max(2 * len(self.vectors), self.count + n_new)
+            vectors = np.empty((capacity, dim), dtype=np.float32)
+            vectors[:self.count] = self.vectors[:self.count]
+            self.vectors = vectors
+
+    def add(self, X, labels=None):
+
+        """This function inserts new vectors in the graph, labels (e.g. the image paths) default to their position"""
+
+        X = self._prepare(X)
+        if labels is None:
+            labels = range(self.count, self.count + len(X))
+        self._grow(len(X), X.shape[1])
+
+        for q, label in zip(X, labels):
+            node = self.count
+            self.vectors[node] = q
+            self.labels.append(label)
+            self.count += 1
+
+            level = int(-np.log(1 - self.rng.random()) * self.level_mult)
+            self.neighbors.append([[] for _ in range(level + 1)])
+
+            if self.entry_point is None:
+                self.entry_point = node
+                self.max_level = level
+                continue
+
+            # Greedy descent on the layers above the level of the new node
+            entry = [self.entry_point]
+            for lc in range(self.max_level, level, -1):
+                entry = [self._search_layer(q, entry, 1, lc)[0][1]]
+
+            for lc in range(min(level, self.max_level), -1, -1):
+                found = self._search_layer(q, entry, self.ef_construction, lc)
+                self.neighbors[node][lc] = [n for _, n in found[:self.M]]
+                max_links = self.M0 if lc == 0 else self.M
+                for n in self.neighbors[node][lc]:
+                    self.neighbors[n][lc].append(node)
+                    self._shrink(n, lc, max_links)
+                entry = [n for _, n in found]
+
+            if level > self.max_level:
+                self.entry_point = node
+                self.max_level = level
+
+    def search(self, Q, k=10, ef=50):
+
+        """This function returns the distances and the nodes of the approximate k nearest neighbours of every
+        query; a larger ef gives a better recall and a slower search. Use labels to map nodes back to images"""
+
+        Q = self._prepare(Q)
+        distances = np.full((len(Q), k), np.inf, dtype=np.float32)
+        indices = np.full((len(Q), k), -1, dtype=np.int64)
+        if self.entry_point is None:
+            return distances, indices
+
+        for q_idx, q in enumerate(Q):
+            entry = [self.entry_point]
+            for lc in range(self.max_level, 0, -1):
+                entry = [self._search_layer(q, entry, 1, lc)[0][1]]
+
+            # Deleted nodes are skipped, the candidate list is enlarged until k live nodes are found
+            search_ef = max(ef, k)
+            while True:
+                found = [(d, n) for d, n in self._search_layer(q, entry, search_ef, 0) if n not in self.deleted]
+                if len(found) >= k or search_ef >= self.count:
+                    break
+                search_ef *= 2
+            found = found[:k]
+            distances[q_idx, :len(found)] = [d for d, _ in found]
+            indices[q_idx, :len(found)] = [n for _, n in found]
+
+        return distances, indices
+
+    def save(self, index_file):
+
+        """This function writes the index to a pickle file"""
+
+        state = dict(self.__dict__)
+        state['vectors'] = None if self.vectors is None else self.vectors[:self.count]
+        with open(index_file, 'wb') as f:
+            pickle.dump(state, f)
+
+    @classmethod
+    def load(cls, index_file):
+
+        """This function reads an index written by save"""
+
+        with open(index_file, 'rb') as f:
+            state = pickle.load(f)
+        index = cls.__new__(cls)
+        index.deleted = set()
+        index.meta = dict()
+        index.__dict__.update(state)
+        return index
@@ -1,67 +1,134 @@
 import os
-import glob
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import skimage.io
 from skimage.transform import resize
 from tensorflow.keras.preprocessing.image import img_to_array
 from tensorflow.keras.preprocessing.image import load_img
+from profiling import stage
+
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def class_label(c_name):
+
+    """This function returns the class of a subfolder: -1 for the distractors, an int for numbered classes"""
+
+    if c_name == 'distractor':
+        return -1
+    if c_name.isdigit():
+        return int(c_name)
+    return c_name
+
+
+def scan_class_folder(data_path, c_name, extensions=IMG_EXTENSIONS):
+
+    """This function lists the images of one class subfolder in a single scandir pass and returns
+    their [path, class, size, mtime] entries"""
+
+    c = class_label(c_name)
+    files = []
+    with os.scandir(os.path.join(data_path, c_name)) as entries:
+        for entry in entries:
+            if entry.name.endswith(extensions) and entry.is_file():
+                stat = entry.stat()
+                files.append([entry.path, c, stat.st_size, stat.st_mtime_ns])
+    return files
+
+
+def manifest_name(data_path):
+
+    """This function returns the manifest file name of a folder, unique for the path it is given"""
+
+    path_id = hashlib.sha1(data_path.encode()).hexdigest()[:10]
+    return 'manifest_{:s}_{:s}.json'.format(os.path.basename(os.path.normpath(data_path)), path_id)
+
+
+def read_img(img_path, img_length, img_height):
+
+    """This function reads a single image and returns it as a 3 channels numpy array"""
+
+    img = load_img(img_path, target_size=(img_length, img_height))
+
+    img = img_to_array(img)
+
+    if img.shape[2] == 1:
+        img = np.repeat(img, 3, axis=2)
+    if img.shape[2] == 4:
+        img = img[:, :, :3]
+
+    return img
 
 
 class Loader:
     
     """This class reads images with common extensions from a directory for later use"""
 
-    def __init__(self, img_length, img_height, num_channels):
+    def __init__(self, img_length, img_height, num_channels, manifest_dir=None):
         
         self.img_length = img_length
         self.img_height = img_height
         self.num_channels = num_channels
+        self.manifest_dir = manifest_dir
 
-    def get_files(self, data_path):
+    def get_files(self, data_path, n_workers=None, rescan=False):
 
-        """This function returns the data mapping"""
-        
-        assert os.path.exists(data_path), 'Insert a valid path!'
-        data_classes = os.listdir(data_path)  
-        data_mapping = {}
-
-        for c, c_name in enumerate(data_classes):
-            temp_path = os.path.join(data_path, c_name)
-            temp_images = os.listdir(temp_path)
-
-            for i in temp_images:
-                img_tmp = os.path.join(temp_path, i)
-
-                if img_tmp.endswith('.jpg'):
-                    if c_name == 'distractor':
-                        data_mapping[img_tmp] = -1
-                    else:
-                        if c_name.isdigit():
-                            data_mapping[img_tmp] = int(c_name)
-                        else:
-                            data_mapping[img_tmp] = c_name
-                elif img_tmp.endswith('.jpeg'):
-                    if c_name == 'distractor':
-                        data_mapping[img_tmp] = -1
-                    else:
-                        if c_name.isdigit():
-                            data_mapping[img_tmp] = int(c_name)
-                        else:
-                            data_mapping[img_tmp] = c_name
-                elif img_tmp.endswith('.png'):
-                    if c_name == 'distractor':
-                        data_mapping[img_tmp] = -1
-                    else:
-                        if c_name.isdigit():
-                            data_mapping[img_tmp] = int(c_name)
-                        else:
-                            data_mapping[img_tmp] = c_name
+        """This function returns the data mapping, built from the manifest of the folder"""
 
+        data_mapping = {img_path: c for img_path, c, _, _ in self.get_manifest(data_path, n_workers, rescan)}
 
         print('\nLoaded {:d} from {:s} images'.format(len(data_mapping.keys()), data_path))
 
         return data_mapping
 
+    def get_manifest(self, data_path, n_workers=None, rescan=False):
+
+        """This function returns the (path, class, size, mtime) of every image of the class subfolders, sorted by
+        path. With a manifest_dir the manifest is saved, and on the next runs only the subfolders whose
+        modification time changed (an image was added, removed or renamed) are scanned again. An image
+        overwritten in place does not change its subfolder, so its size and mtime stay the saved ones:
+        rescan=True scans every subfolder again"""
+
+        with stage('list') as counter:
+            assert os.path.exists(data_path), 'Insert a valid path!'
+            manifest_file = None
+            saved = {'folders': {}, 'files': []}
+            if self.manifest_dir is not None:
+                manifest_file = os.path.join(self.manifest_dir, manifest_name(data_path))
+                if os.path.exists(manifest_file):
+                    with open(manifest_file) as f:
+                        saved = json.load(f)
+
+            with os.scandir(data_path) as entries:
+                folders = {entry.name: entry.stat().st_mtime_ns for entry in entries if entry.is_dir()}
+            saved_files = dict()
+            for entry in saved['files']:
+                saved_files.setdefault(os.path.basename(os.path.dirname(entry[0])), []).append(entry)
+
+            # Unchanged subfolders are taken from the saved manifest, the others are scanned in parallel
+            to_scan = [c_name for c_name in folders if rescan or saved['folders'].get(c_name) != folders[c_name]]
+            with ThreadPoolExecutor(n_workers) as pool:
+                scanned = dict(zip(to_scan, pool.map(lambda c_name: scan_class_folder(data_path, c_name), to_scan)))
+
+            files = []
+            for c_name in folders:
+                files.extend(scanned[c_name] if c_name in scanned else saved_files.get(c_name, []))
+            files.sort(key=lambda entry: entry[0])
+
+            if manifest_file is not None and (to_scan or set(folders) != set(saved['folders'])):
+                if not os.path.exists(self.manifest_dir):
+                    os.makedirs(self.manifest_dir)
+                tmp_file = manifest_file + '.tmp'
+                with open(tmp_file, 'w') as f:
+                    json.dump({'data_path': data_path, 'folders': folders, 'files': files}, f)
+                os.replace(tmp_file, manifest_file)
+            counter['items'] = len(files)
+
+        return [tuple(entry) for entry in files]
+
     def get_data_paths(self, data_mapping):
 
         """This function returns the image path, the image name and the image as a numpy array"""
@@ -76,88 +143,115 @@ class Loader:
 
         print('\nProcessing images...')
 
-        for img_path in data_mapping.keys():
+        with stage('decode') as counter:
+            for img_path in data_mapping.keys():
+                if img_path.endswith(IMG_EXTENSIONS):
+                    images_paths.append(img_path)
+                    temp = "r"+img_path
+                    images_names.append(os.path.split(temp)[1])
+                    images_arrays.append(read_img(img_path, img_length, img_height))
+                    classes.append(data_mapping[img_path])
+            counter['items'] = len(images_paths)
 
-            if img_path.endswith('.jpg'):
-                images_paths.append(img_path)
-                temp = "r"+img_path
-                images_names.append(os.path.split(temp)[1])
+        print('\nImages processed')
 
-                img = load_img(img_path, target_size=(img_length, img_height))
+        return images_names, images_paths, images_arrays, np.array(classes)
 
-                img = img_to_array(img)
+    def get_data_names(self, data_mapping):
 
-                if img.shape[2] == 1:
-                    img = np.repeat(img, 3, axis=2)
-                if img.shape[2] == 4:
-                    img = img[:, :, :3]
+        """This function returns the image names, paths and classes without decoding the images"""
 
-                images_arrays.append(img)
-                classes.append(data_mapping[img_path])
+        images_paths = [img_path for img_path in data_mapping.keys() if img_path.endswith(IMG_EXTENSIONS)]
+        images_names = [os.path.split("r"+img_path)[1] for img_path in images_paths]
+        classes = [data_mapping[img_path] for img_path in images_paths]
 
-            elif img_path.endswith('.jpeg'):
-                images_paths.append(img_path)
-                temp = "r"+img_path
-                images_names.append(os.path.split(temp)[1])
+        return images_names, images_paths, np.array(classes)
 
-                img = load_img(img_path, target_size=(img_length, img_height))
+    def get_data_array(self, data_mapping, n_workers=None):
 
-                img = img_to_array(img)
+        """This function works like get_data_paths, but the images are decoded on a thread pool and
+        written directly into one preallocated (N, H, W, C) float32 array instead of a list"""
 
-                if img.shape[2] == 1:
-                    img = np.repeat(img, 3, axis=2)
-                if img.shape[2] == 4:
-                    img = img[:, :, :3]
+        images_names, images_paths, classes = self.get_data_names(data_mapping)
 
-                images_arrays.append(img)
-                classes.append(data_mapping[img_path])
+        print('\nProcessing images...')
 
-            elif img_path.endswith('.png'):
-                images_paths.append(img_path)
-                temp = "r"+img_path
-                images_names.append(os.path.split(temp)[1])
+        images_arrays = self.read_images(images_paths, n_workers)
 
-                img = load_img(img_path, target_size=(img_length, img_height))
+        print('\nImages processed')
 
-                img = img_to_array(img)
+        return images_names, images_paths, images_arrays, classes
 
-                if img.shape[2] == 1:
-                    img = np.repeat(img, 3, axis=2)
-                if img.shape[2] == 4:
-                    img = img[:, :, :3]
+    def get_data_batches(self, data_mapping, batch_size, n_workers=None):
 
-                images_arrays.append(img)
-                classes.append(data_mapping[img_path])
+        """This function is a generator version of get_data_array: it yields the same
+        (names, paths, arrays, classes) tuple for fixed-size batches of the data mapping"""
 
-        print('\nImages processed')
+        images_names, images_paths, classes = self.get_data_names(data_mapping)
 
-        return images_names, images_paths, images_arrays, np.array(classes)
+        with ThreadPoolExecutor(n_workers) as pool:
+            for start in range(0, len(images_paths), batch_size):
+                end = start + batch_size
+                batch_arrays = self.read_images(images_paths[start:end], pool=pool)
+
+                yield images_names[start:end], images_paths[start:end], batch_arrays, classes[start:end]
+
+    def read_images(self, images_paths, n_workers=None, pool=None, dtype=np.float32):
+
+        """This function decodes the images in parallel and fills a preallocated array (uint8 keeps the raw pixels)"""
+
+        images_arrays = np.empty((len(images_paths), self.img_length, self.img_height, 3), dtype=dtype)
+
+        def fill(i):
+            images_arrays[i] = read_img(images_paths[i], self.img_length, self.img_height)
+
+        with stage('decode', len(images_paths)):
+            if pool is None:
+                with ThreadPoolExecutor(n_workers) as pool:
+                    list(pool.map(fill, range(len(images_paths))))
+            else:
+                list(pool.map(fill, range(len(images_paths))))
+
+        return images_arrays
 
 
 def read_imgs_no_subfolders(dirPath, img_size, extensions=None):
 
-    """This function reads images with common extensions from a directory with no subfolders"""
+    """This function reads images with common extensions from a directory with no subfolders, and returns
+    them with their paths (one path per image, in the same order)"""
+
+    img_list = list_imgs_no_subfolders(dirPath, extensions)
+    all_img = [read_img(img_path, img_size, img_size) for img_path in img_list]
+
+    return all_img, img_list
+
+
+def list_imgs_no_subfolders(dirPath, extensions=None):
+
+    """This function returns the sorted paths of the images read by read_imgs_no_subfolders, in the same order"""
 
     if extensions is None:
         extensions = ['.jpg', '.png', '.jpeg']
+    extensions = tuple(extensions)
 
-    all_img = []
-    img_list = glob.glob(os.path.join(dirPath, '*'))
+    with os.scandir(dirPath) as entries:
+        img_list = [entry.path for entry in entries if entry.name.endswith(extensions) and entry.is_file()]
 
-    for ext in extensions:
-        for img_path in img_list:
-            if img_path.endswith(ext):
+    return sorted(img_list)
 
-                img = load_img(img_path, target_size=(img_size, img_size))
 
-                img = img_to_array(img)
+class LazyImages:
 
-                if img.shape[2] == 1:
-                    img = np.repeat(img, 3, axis=2)
-                if img.shape[2] == 4:
-                    img = img[:, :, :3]
+    """This class gives list-like access to normalized images that are decoded only when indexed,
+    it is used to plot the retrieved gallery images without keeping the whole gallery in memory"""
 
-                all_img.append(img)
+    def __init__(self, images_paths, img_size):
 
-    return all_img, img_list
+        self.images_paths = images_paths
+        self.img_size = img_size
+
+    def __len__(self):
+        return len(self.images_paths)
 
+    def __getitem__(self, i):
+        return read_img(self.images_paths[i], self.img_size, self.img_size) / 255
@@ -0,0 +1,128 @@
+import os
+import hashlib
+import numpy as np
+from retrieval import topk_search
+from ann import IVFPQIndex
+from hnsw import HNSWIndex
+from hashing import BinaryHashIndex
+from gallery_manager import scan_images, load_manifest, load_manifest_meta, save_manifest, sync_gallery
+
+
+# Index saved in the output folder by every approximate distance
+INDEX_FILES = {'ivfpq': "ivfpq_index.npz", 'hnsw': "hnsw_index.pickle", 'hamming': "hash_index.npz"}
+
+
+def index_meta(E_gallery, gallery_paths, fingerprint=None, reduce='none'):
+
+    """This function returns what an index is built from, saved with it and checked when it is reused: the
+    fingerprint of the encoder, a hash of the gallery paths, the dimension and the reduction of the embeddings"""
+
+    paths_hash = hashlib.sha1('\n'.join(gallery_paths).encode()).hexdigest()
+    dim = int(np.prod(np.shape(E_gallery)[1:]))
+    return {'fingerprint': fingerprint or '', 'paths': paths_hash, 'dim': dim, 'reduce': reduce}
+
+
+def meta_mismatch(index, meta):
+
+    """This function returns the fields of meta that differ from the ones saved with the index"""
+
+    return [key for key in meta if index.meta.get(key) != meta[key]]
+
+
+def load_index(distance, output_dir):
+
+    """This function reads the ivfpq, hnsw or hamming index saved in the output folder"""
+
+    index_file = os.path.join(output_dir, INDEX_FILES[distance])
+    assert os.path.exists(index_file), 'No {} index in {}: build it first with pipeline.py -distance {}'.format(
+        distance, output_dir, distance)
+    if distance == 'ivfpq':
+        return IVFPQIndex.load(index_file)
+    if distance == 'hnsw':
+        return HNSWIndex.load(index_file)
+    return BinaryHashIndex.load(index_file)
+
+
+def build_index(distance, E_gallery, gallery_paths, output_dir, rebuild=False, fingerprint=None, reduce='none',
+                n_lists=256, n_subvectors=8, M=16, ef_construction=100, n_bits=256, hash_method='itq'):
+
+    """This function returns the index of the gallery embeddings for the ivfpq, hnsw and hamming distances (None
+    for knn and pairwise): the index saved in the output folder, or a new one trained and saved when there is none
+    or the saved one was built from another model, gallery or reduction (see index_meta). The hnsw graph is
+    updated in place like gallery_manager.py does, only new or changed gallery images are inserted"""
+
+    if distance not in INDEX_FILES:
+        return None
+    index_file = os.path.join(output_dir, INDEX_FILES[distance])
+
+    meta = index_meta(E_gallery, gallery_paths, fingerprint, reduce)
+
+    if distance == 'hnsw':
+        # The graph follows the gallery changes, only the model and the embeddings are checked
+        del meta['paths']
+        manifest_file = os.path.join(output_dir, "gallery_manifest.json")
+        index, manifest, rebuilt = None, dict(), True
+        if os.path.exists(index_file) and not rebuild:
+            index = HNSWIndex.load(index_file)
+            manifest = load_manifest(manifest_file)
+            mismatch = meta_mismatch(index, meta)
+            if load_manifest_meta(manifest_file) != index.meta:
+                mismatch.append('manifest')
+            rebuilt = bool(mismatch)
+            if mismatch:
+                print('\nThe saved hnsw graph does not match the embeddings ({}), rebuilding it'.format(
+                    ', '.join(mismatch)))
+                index, manifest = None, dict()
+        if index is None:
+            index = HNSWIndex(metric="cosine", M=M, ef_construction=ef_construction)
+            index.meta = meta
+        gallery_rows = {img_path: i for i, img_path in enumerate(gallery_paths)}
+        added, changed, removed = sync_gallery(index, manifest, scan_images(gallery_paths),
+                                               lambda paths: E_gallery[[gallery_rows[p] for p in paths]])
+        if added or changed or removed or rebuilt:
+            index.save(index_file)
+            save_manifest(manifest_file, manifest, index.meta)
+        return index
+
+    if os.path.exists(index_file) and not rebuild:
+        index = load_index(distance, output_dir)
+        mismatch = meta_mismatch(index, meta)
+        if not mismatch:
+            return index
+        print('\nThe saved {} index does not match the embeddings ({}), rebuilding it'.format(distance,
+                                                                                           ', '.join(mismatch)))
+    if distance == 'ivfpq':
+        index = IVFPQIndex(n_lists=n_lists, n_subvectors=n_subvectors, metric="cosine")
+    else:
+        index = BinaryHashIndex(n_bits=n_bits, method=hash_method)
+    index.train(E_gallery)
+    index.add(E_gallery)
+    index.meta = meta
+    index.save(index_file)
+    return index
+
+
+def index_search_fn(distance, index, E_gallery, gallery_paths, metric='minkowski', nprobe=8, ef=50, shortlist=100):
+
+    """This function returns a function searching the indices of the k nearest gallery rows of a batch of query
+    embeddings (-1 when fewer than k are found) with the index returned by build_index or load_index"""
+
+    if distance == 'knn':
+        return lambda E_query, k: topk_search(E_query, E_gallery, k=k, metric="cosine")[1]
+
+    if distance == 'ivfpq':
+        return lambda E_query, k: index.search(E_query, k=k, nprobe=nprobe)[1]
+
+    if distance == 'hnsw':
+        gallery_rows = {img_path: i for i, img_path in enumerate(gallery_paths)}
+
+        def search(E_query, k):
+            nodes = index.search(E_query, k=k, ef=ef)[1]
+            return np.array([[gallery_rows.get(index.labels[n], -1) if n >= 0 else -1 for n in row] for row in nodes])
+
+        return search
+
+    if distance == 'hamming':
+        return lambda E_query, k: index.search(E_query, E_gallery, k=k, shortlist=shortlist, metric="cosine")[1]
+
+    return lambda E_query, k: topk_search(E_query, E_gallery, k=k, metric=metric, p=2.)[1]
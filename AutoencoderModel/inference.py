@@ -0,0 +1,142 @@
+import os
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from retrieval import topk_search
+
+
+PRECISIONS = ('float32', 'mixed_bfloat16', 'mixed_float16')
+
+
+def cast_model(model, precision):
+
+    """This function returns a copy of a Keras model whose layers compute in the mixed precision policy
+    (mixed_bfloat16 or mixed_float16), with the weights of the float32 model"""
+
+    policy = tf.keras.mixed_precision.Policy(precision)
+
+    def clone_layer(layer):
+        config = layer.get_config()
+        config['dtype'] = policy
+        return layer.__class__.from_config(config)
+
+    mixed_model = tf.keras.models.clone_model(model, clone_function=clone_layer)
+    mixed_model.set_weights(model.get_weights())
+    return mixed_model
+
+
+def make_embed_fn(model, precision='float32', jit=False, batch_size=32):
+
+    """This function returns a function embedding a batch of normalized images into flattened float32 vectors
+    with a tf.function of the model, compiled with XLA if jit is True. The images are fed in batches of constant
+    size (the last one is padded), so the function is traced and compiled only once"""
+
+    if precision != 'float32':
+        model = cast_model(model, precision)
+    input_shape = tuple(int(d) for d in model.input.shape[1:])
+    output_dim = int(np.prod(model.output.shape[1:]))
+
+    @tf.function(jit_compile=jit)
+    def forward(x):
+        return tf.cast(model(x, training=False), tf.float32)
+
+    def embed(X):
+        X = np.asarray(X, dtype=np.float32).reshape((-1,) + input_shape)
+        embeddings = np.empty((len(X), output_dim), dtype=np.float32)
+        for start in range(0, len(X), batch_size):
+            batch = X[start:start + batch_size]
+            n = len(batch)
+            if n < batch_size:
+                batch = np.concatenate([batch, np.zeros((batch_size - n,) + input_shape, dtype=np.float32)])
+            embeddings[start:start + n] = forward(batch).numpy()[:n].reshape((n, -1))
+        return embeddings
+
+    return embed
+
+
+def embedding_drift(E, E_reference, k=10):
+
+    """This function compares embeddings with the float32 ones: mean relative error, mean cosine similarity and
+    the fraction of the k nearest neighbours (among the same images) that are unchanged"""
+
+    norms = np.linalg.norm(E_reference, axis=1)
+    norms[norms == 0] = 1
+    relative_error = np.mean(np.linalg.norm(E - E_reference, axis=1) / norms)
+    cosine = np.mean(np.sum(E * E_reference, axis=1) / norms / np.maximum(np.linalg.norm(E, axis=1), 1e-12))
+
+    k = min(k, len(E) - 1)
+    neighbours = topk_search(E, E, k=k + 1, metric='cosine')[1][:, 1:]
+    neighbours_reference = topk_search(E_reference, E_reference, k=k + 1, metric='cosine')[1][:, 1:]
+    overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(neighbours, neighbours_reference)])
+    return relative_error, cosine, overlap
+
+
+def benchmark_inference(model, X, settings, batch_size=32):
+
+    """This function embeds the same images with every (precision, jit) setting and returns, for each of them,
+    the throughput and the drift of the embeddings with respect to float32 without XLA"""
+
+    E_reference = make_embed_fn(model, 'float32', False, batch_size)(X)
+    results = []
+    for precision, jit in settings:
+        embed = make_embed_fn(model, precision, jit, batch_size)
+        # Warm up: tracing and XLA compilation
+        embed(X[:batch_size])
+        start = time.perf_counter()
+        E = embed(X)
+        images_per_sec = len(X) / (time.perf_counter() - start)
+        relative_error, cosine, overlap = embedding_drift(E, E_reference)
+        results.append({'precision': precision, 'jit': jit, 'images_per_sec': images_per_sec,
+                        'relative_error': relative_error, 'cosine': cosine, 'top10_overlap': overlap})
+    return results
+
+
+if __name__ == '__main__':
+
+    from image_loading import Loader, list_imgs_no_subfolders
+    from encoders import load_encoder_model
+
+    parser = argparse.ArgumentParser(description='Inference speed and embedding drift of the encoders')
+    parser.add_argument('--data_path',
+                        '-d',
+                        type=str,
+                        default='dataset_test',
+                        help='Dataset path, the images of the gallery folder inside it are embedded')
+    parser.add_argument('-img_size',
+                        type=int,
+                        default=324,
+                        help='image size for the model')
+    parser.add_argument('-channels',
+                        type=int,
+                        default=3,
+                        help='number of channels')
+    parser.add_argument('-model',
+                        type=str,
+                        default='convAE',
+                        help='Default model = convAE, other options: pretrained, triplets_loss')
+    parser.add_argument('-n_images',
+                        type=int,
+                        default=256,
+                        help='number of gallery images embedded by every setting')
+    parser.add_argument('-bs',
+                        type=int,
+                        default=32,
+                        help='batch size')
+    args = parser.parse_args()
+
+    shape_img = (args.img_size, args.img_size, args.channels)
+    GalleryDir = os.path.join(os.getcwd(), args.data_path, "gallery")
+    OutputDir = os.path.join(os.getcwd(), "output", args.model)
+
+    loader = Loader(args.img_size, args.img_size, args.channels)
+    X = loader.read_images(list_imgs_no_subfolders(GalleryDir)[:args.n_images]) / 255
+    model, _ = load_encoder_model(args.model, shape_img, OutputDir)
+
+    settings = [(precision, jit) for precision in PRECISIONS for jit in (False, True)]
+    print('\n{:<16s}{:<6s}{:>12s}{:>12s}{:>10s}{:>14s}'.format('precision', 'jit', 'images/sec', 'rel. error',
+                                                               'cosine', 'top10 overlap'))
+    for result in benchmark_inference(model, X, settings, args.bs):
+        print('{:<16s}{:<6s}{:>12.1f}{:>12.5f}{:>10.5f}{:>14.3f}'.format(
+            result['precision'], str(result['jit']), result['images_per_sec'], result['relative_error'],
+            result['cosine'], result['top10_overlap']))
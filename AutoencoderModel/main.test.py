@@ -1,18 +1,16 @@
 import argparse
 import os
-import pickle
 
-from scipy import spatial
-from sklearn.neighbors import NearestNeighbors
-import tensorflow as tf
-from triplets import triplet_loss
-from autoencoder import AutoEncoder, TripletsEncoder
-from image_loading import read_imgs_no_subfolders
-from transform import normalize_img, data_augmentation
+from image_loading import Loader, LazyImages, read_imgs_no_subfolders
+from encoders import load_encoder
+from pipeline import RetrievalPipeline, SubmitSink, PickleSink
+from transform import normalize_img
 from visualization import plot_query_retrieval
 from final_display import *
+from ann import recall_sweep
+from hashing import hashing_recall_sweep
+from profiling import PROFILER, report_file
 import numpy as np
-import time
 
 
 parser = argparse.ArgumentParser(description='Description challenge test')
@@ -44,9 +42,110 @@ parser.add_argument('-metric',
 parser.add_argument('-distance',
                     type=str,
                     default='knn',
-                    help='Knn or pairwise distance between query and gallery')
+                    help='knn, pairwise, ivfpq, hnsw (approximate) or hamming (binary codes + re-ranking) distance '
+                         'between query and gallery')
+parser.add_argument('-cache',
+                    type=str,
+                    default='True',
+                    help='Reuse the gallery embeddings cached on disk (default = True)')
+parser.add_argument('-workers',
+                    type=int,
+                    default=None,
+                    help='number of threads used to decode the images (default = one per CPU)')
+parser.add_argument('-nprobe',
+                    type=int,
+                    default=8,
+                    help='number of inverted lists scanned per query by the ivfpq index (recall/latency trade-off)')
+parser.add_argument('-n_lists',
+                    type=int,
+                    default=256,
+                    help='number of inverted lists of the ivfpq index')
+parser.add_argument('-n_subvectors',
+                    type=int,
+                    default=8,
+                    help='number of bytes of the product-quantized codes of the ivfpq index')
+parser.add_argument('-ef',
+                    type=int,
+                    default=50,
+                    help='size of the candidate list of the hnsw search (recall/latency trade-off)')
+parser.add_argument('-M',
+                    type=int,
+                    default=16,
+                    help='number of links per node of the hnsw graph')
+parser.add_argument('-ef_construction',
+                    type=int,
+                    default=100,
+                    help='size of the candidate list used to insert images in the hnsw graph')
+parser.add_argument('-rebuild_index',
+                    type=str,
+                    default='False',
+                    help='Rebuild the ivfpq or hnsw index even if it is saved in the output folder (default = False)')
+parser.add_argument('-recall',
+                    type=str,
+                    default='False',
+                    help='Report recall@10 of the ivfpq index (for several nprobe) or of the hamming search (for several '
+                         'shortlists) against exact search (default = False)')
+parser.add_argument('-store',
+                    type=str,
+                    default=None,
+                    help='Path of a memory-mapped gallery embedding store: read if it exists, written otherwise')
+parser.add_argument('-store_dtype',
+                    type=str,
+                    default='float32',
+                    help='dtype of the gallery embedding store, float32 or float16')
 
+parser.add_argument('-n_bits',
+                    type=int,
+                    default=256,
+                    help='number of bits of the binary codes with -distance hamming')
+parser.add_argument('-hash_method',
+                    type=str,
+                    default='itq',
+                    help='binary hashing: mean (sign of the centered principal components) or itq (rotated)')
+parser.add_argument('-shortlist',
+                    type=int,
+                    default=100,
+                    help='number of gallery images re-ranked with the float embeddings after the Hamming search')
+parser.add_argument('-chunk_size',
+                    type=int,
+                    default=0,
+                    help='embed the gallery in chunks of this size, written to the -store as they are computed; '
+                         'an interrupted extraction resumes where it stopped (default = 0, all at once)')
+parser.add_argument('-rerank',
+                    type=str,
+                    default='none',
+                    help='re-ranking of the first-stage matches: none, qe (average query expansion) or kreciprocal')
+parser.add_argument('-rerank_n',
+                    type=int,
+                    default=100,
+                    help='number of first-stage matches re-ranked')
+parser.add_argument('-pooling',
+                    type=str,
+                    default='none',
+                    help='pooling head of the pretrained model: none (flattened), gap, gem or rmac')
+parser.add_argument('-reduce',
+                    type=str,
+                    default='none',
+                    help='reduction of the embeddings before the search: none, pca or random (sparse random '
+                         'projection); use -rebuild_index True when it changes')
+parser.add_argument('-n_components',
+                    type=int,
+                    default=256,
+                    help='dimension of the reduced embeddings')
+parser.add_argument('-whiten',
+                    type=str,
+                    default='True',
+                    help='Whiten the PCA components (default = True)')
+parser.add_argument('-report',
+                    type=str,
+                    default=None,
+                    help='JSON profiling report of the run (default = output/<model>/profiles/<script>_<time>.json)')
+parser.add_argument('-profile_stage',
+                    type=str,
+                    default=None,
+                    help='stage run under cProfile, e.g. decode, predict or search (default = None)')
 args = parser.parse_args()
+PROFILER.profile_stage = args.profile_stage
 
 shape_img = (args.img_size, args.img_size, args.channels)
 
@@ -55,288 +154,68 @@ GalleryDir = os.path.join(os.getcwd(), args.data_path, "gallery")
 OutputDir = os.path.join(os.getcwd(), "output", args.model)
 if not os.path.exists(OutputDir):
     os.makedirs(OutputDir)
+loader = Loader(args.img_size, args.img_size, args.channels)
+
+plot_prefix = {'convAE': "ConvAE_retrieval_", 'pretrained': "Pretr_retrieval_"}.get(args.model, "Triplets_retrieval_")
+pickle_suffix = {'convAE': "autoencoder", 'pretrained': "pretrained"}.get(args.model, "triplets")
+result_name = args.distance if args.distance in ('knn', 'ivfpq', 'hnsw', 'hamming') else 'pairwise'
+
+# The results are submitted and pickled by the sinks of the pipeline
+sinks = [SubmitSink(), PickleSink('dictionaries_submission_pickle/{}_{}.pickle'.format(result_name, pickle_suffix))]
+
+# Load the encoder of -model, the pipeline embeds, indexes, searches and re-ranks
+embed, fingerprint = load_encoder(args.model, shape_img, OutputDir, pooling=args.pooling)
+pipeline = RetrievalPipeline(loader, embed, OutputDir, fingerprint, args.distance, args.metric, k=10,
+                             index_params=dict(n_lists=args.n_lists, n_subvectors=args.n_subvectors, M=args.M,
+                                               ef_construction=args.ef_construction, n_bits=args.n_bits,
+                                               hash_method=args.hash_method),
+                             search_params=dict(nprobe=args.nprobe, ef=args.ef, shortlist=args.shortlist),
+                             reduce=args.reduce, n_components=args.n_components, whiten=args.whiten == 'True',
+                             rerank_method=args.rerank, rerank_n=args.rerank_n, sinks=sinks, cache=args.cache == 'True',
+                             store=args.store, store_dtype=args.store_dtype, chunk_size=args.chunk_size,
+                             rebuild_index=args.rebuild_index == 'True', n_workers=args.workers)
 
 QueryImgs, QueryName = read_imgs_no_subfolders(QueryDir, args.img_size)
-GalleryImgs, GalleryName = read_imgs_no_subfolders(GalleryDir, args.img_size)
 QueryName = [os.path.split(img_path)[1] for img_path in QueryName]
-GalleryName = [os.path.split(img_path)[1] for img_path in GalleryName]
+
+# With a store of the same model and gallery images the gallery is not embedded again
+GalleryName, GalleryPaths, _, E_gallery_flatten = pipeline.load_gallery(GalleryDir)
 
 # Normalize all images
 print("Normalizing query images")
 QueryImgs = normalize_img(QueryImgs)
-print("Normalizing gallery images")
-GalleryImgs = normalize_img(GalleryImgs)
-
-if args.model == 'convAE':
-
-    # Build models
-    autoencoderFile = os.path.join(OutputDir, "ConvAE_autoecoder.h5")
-    print("autoencoder file", autoencoderFile)
-    encoderFile = os.path.join(OutputDir, "ConvAE_encoder.h5")
-    model = AutoEncoder(shape_img, autoencoderFile, encoderFile)
-    model.set_arch()
-
-    input_shape_model = tuple([int(x) for x in model.encoder.input.shape[1:]])
-    output_shape_model = tuple([int(x) for x in model.encoder.output.shape[1:]])
-
-    # Loading model
-    model.load_models(loss='mse', optimizer="adam")
-    
-    # Convert images to numpy array of right dimensions
-    print("\nConverting to numpy array of right dimensions")
-    X_query = np.array(QueryImgs).reshape((-1,) + input_shape_model)
-    X_gallery = np.array(GalleryImgs).reshape((-1,) + input_shape_model)
-    print(">>> X_query.shape = " + str(X_query.shape))
-    print(">>> X_gallery.shape = " + str(X_gallery.shape))
-    
-    # Create embeddings using model
-    print("\nCreating embeddings")
-    E_query = model.predict(X_query)
-    E_query_flatten = E_query.reshape((-1, np.prod(output_shape_model)))
-    E_gallery = model.predict(X_gallery)
-    E_gallery_flatten = E_gallery.reshape((-1, np.prod(output_shape_model)))
-
-
-
-    print("\nComputing pairwise distance between query and gallery images")
-
-    # Define the distance between query - gallery features vectors
-    pairwise_dist = spatial.distance.cdist(E_query_flatten, E_gallery_flatten, args.metric, p=2.)
-    print('\nComputed distances and got c-dist {}'.format(pairwise_dist.shape))
-
-    print("\nCalculating indices and gallery matches...")
-    indices = np.argsort(pairwise_dist, axis=-1)
-
-    final_res_pairwise = dict()
-    for i, emb_flatten in enumerate(indices):
-        img_query = QueryImgs[i]
-        query_name = QueryName[i]
-        imgs_retrieval = [GalleryImgs[indx] for indx in indices[i][:10]]
-        names_retrieval = [GalleryName[indx] for indx in indices[i][:10]]
-
-        if args.plot == 'True':
-            outFile = os.path.join(OutputDir, "ConvAE_retrieval_pairwise_" + str(i) + ".png")
-            plot_query_retrieval(img_query, imgs_retrieval, None)
-
-        create_results_dict(final_res_pairwise, query_name, names_retrieval)
-
-
-    print("\nComputing knn for distance between query and gallery images")
-
-    # Fit kNN model on gallery images
-    print("\nFitting KNN model on training data...")
-    k = 10
-    knn = NearestNeighbors(n_neighbors=k, metric="cosine")
-    knn.fit(E_gallery_flatten)
-    print("Done fitting")
-
-    # Querying on test images
-    final_res_knn = dict()
-    print("\nQuerying...")
-    for i, emb_flatten in enumerate(E_query_flatten):
-        distances, indx = knn.kneighbors([emb_flatten])
-        img_query = QueryImgs[i]  
-        query_name = QueryName[i]
-        imgs_retrieval = [GalleryImgs[idx] for idx in indx.flatten()]
-        names_retrieval = [GalleryName[idx] for idx in indx.flatten()]
-
-        if args.plot == 'True':
-            outFile = os.path.join(OutputDir, "ConvAE_retrieval_knn_" + str(i) + ".png")
-            plot_query_retrieval(img_query, imgs_retrieval, outFile)
-
-        create_results_dict(final_res_knn, query_name, names_retrieval)
-
-    print('Saving results...')
-
-    url = "http://ec2-18-191-24-254.us-east-2.compute.amazonaws.com/results/"
-
-    if args.distance == 'knn':
-        final_results_knn = create_final_dict(final_res_knn)
-        submit(final_results_knn, url)
-        file_knn = open('dictionaries_submission_pickle/knn_autoencoder.pickle', 'wb')
-        pickle.dump(final_results_knn, file_knn)
-
-    else:
-        final_results_pairwise = create_final_dict(final_res_pairwise)
-        submit(final_results_pairwise, url)
-        file_p = open('dictionaries_submission_pickle/pairwise_autoencoder.pickle', 'wb')
-        pickle.dump(final_results_pairwise, file_p)
-
-    print("Done saving")
-
-
-elif args.model == 'pretrained':
-
-    # Load pre-trained VGG19 model + higher level layers
-    print("\nLoading model...")
-    model = tf.keras.applications.ResNet50(weights='imagenet', include_top=False, input_shape=shape_img)
-    model.summary()
-
-    shape_img_resize = tuple([int(x) for x in model.input.shape[1:]])
-    input_shape_model = tuple([int(x) for x in model.input.shape[1:]])
-    output_shape_model = tuple([int(x) for x in model.output.shape[1:]])
-
-    # Convert images to numpy array of right dimensions
-    print("\nConverting to numpy array of right dimensions")
-    X_query = np.array(QueryImgs).reshape((-1,) + input_shape_model)
-    X_gallery = np.array(GalleryImgs).reshape((-1,) + input_shape_model)
-    print(">>> X_query.shape = " + str(X_query.shape))
-    print(">>> X_gallery.shape = " + str(X_gallery.shape))
-
-    # Create embeddings using model
-    print("\nCreating embeddings")
-    E_query = model.predict(X_query)
-    E_query_flatten = E_query.reshape((-1, np.prod(output_shape_model)))
-    E_gallery = model.predict(X_gallery)
-    E_gallery_flatten = E_gallery.reshape((-1, np.prod(output_shape_model)))
-
-
-
-    print("\nComputing pairwise distance between query and gallery images")
-
-    # Define the distance between query - gallery features vectors
-    pairwise_dist = spatial.distance.cdist(E_query_flatten, E_gallery_flatten, args.metric, p=2.)
-    print('\nComputed distances and got c-dist {}'.format(pairwise_dist.shape))
-
-    print("\nCalculating indices and gallery matches...")
-    indices = np.argsort(pairwise_dist, axis=-1)
-
-    final_res_pairwise = dict()
-    for i, emb_flatten in enumerate(indices):
-        img_query = QueryImgs[i]
-        query_name = QueryName[i]
-        imgs_retrieval = [GalleryImgs[indx] for indx in indices[i][:10]]
-        names_retrieval = [GalleryName[indx] for indx in indices[i][:10]]
-
-        if args.plot == 'True':
-            outFile = os.path.join(OutputDir, "ConvAE_retrieval_pairwise_" + str(i) + ".png")
-            plot_query_retrieval(img_query, imgs_retrieval, None)
-
-        create_results_dict(final_res_pairwise, query_name, names_retrieval)
-
-
-    print("\nComputing knn for distance between query and gallery images")
-
-    # Fit kNN model on gallery images
-    print("\nFitting KNN model on training data...")
-    k = 10
-    knn = NearestNeighbors(n_neighbors=k, metric="cosine")
-    knn.fit(E_gallery_flatten)
-    print("Done fitting")
-
-    # Querying on test images
-    final_res_knn = dict()
-    print("\nQuerying...")
-    for i, emb_flatten in enumerate(E_query_flatten):
-        distances, indx = knn.kneighbors([emb_flatten])
-        img_query = QueryImgs[i]  
-        query_name = QueryName[i]
-        imgs_retrieval = [GalleryImgs[idx] for idx in indx.flatten()]
-        names_retrieval = [GalleryName[idx] for idx in indx.flatten()]
-        
-        if args.plot == 'True':
-            outFile = os.path.join(OutputDir, "Pretr_retrieval_knn_" + str(i) + ".png")
-            plot_query_retrieval(img_query, imgs_retrieval, outFile)
-
-        create_results_dict(final_res_knn, query_name, names_retrieval)
-
-    print('Saving results...')
-
-    url = "http://ec2-18-191-24-254.us-east-2.compute.amazonaws.com/results/"
-
-    if args.distance == 'knn':
-        final_results_knn = create_final_dict(final_res_knn)
-        submit(final_results_knn, url)
-        file_knn = open('dictionaries_submission_pickle/knn_pretrained.pickle', 'wb')
-        pickle.dump(final_results_knn, file_knn)
-    else:
-        final_results_pairwise = create_final_dict(final_res_pairwise)
-        submit(final_results_pairwise, url)
-        file_p = open('dictionaries_submission_pickle/pairwise_pretrained.pickle', 'wb')
-        pickle.dump(final_results_pairwise, file_p)
-
-    print("Done saving")
-
-else:
-    # Build model
-    tripletsFile = os.path.join(OutputDir, "triplets_encoder.h5")
-    triplet_model = TripletsEncoder(shape_img, tripletsFile)
-    triplet_model.set_arch()
-
-    # Convert images to numpy array of right dimensions
-    print("\nConverting to numpy array of right dimensions")
-    X_query = np.array(QueryImgs).reshape((-1,) + shape_img)
-    X_gallery = np.array(GalleryImgs).reshape((-1,) + shape_img)
-
-    # Loading model
-    triplet_model.load_triplets(triplet_loss, optimizer="adam")
-
-    # Create embeddings using model
-    print("\nCreating embeddings")
-    E_query = triplet_model.predict_triplets(X_query)
-    E_gallery = triplet_model.predict_triplets(X_gallery)
-
-
-    print("\nComputing pairwise distance between query and gallery images")
-
-    # Define the distance between query - gallery features vectors
-    pairwise_dist = spatial.distance.cdist(E_query, E_gallery, args.metric, p=2.)
-    print('\nComputed distances and got c-dist {}'.format(pairwise_dist.shape))
-
-    print("\nCalculating indices and gallery matches...")
-    indices = np.argsort(pairwise_dist, axis=-1)
-
-    final_res_pairwise = dict()
-    for i, emb_flatten in enumerate(indices):
-        img_query = QueryImgs[i]
-        query_name = QueryName[i]
-        imgs_retrieval = [GalleryImgs[indx] for indx in indices[i][:10]]
-        names_retrieval = [GalleryName[indx] for indx in indices[i][:10]]
-
-        if args.plot == 'True':
-            outFile = os.path.join(OutputDir, "ConvAE_retrieval_pairwise_" + str(i) + ".png")
-            plot_query_retrieval(img_query, imgs_retrieval, None)
-
-        create_results_dict(final_res_pairwise, query_name, names_retrieval)
-
 
-    print("\nComputing knn for distance between query and gallery images")
+# Gallery images are decoded only when their embedding is not cached, or to be plotted
+GalleryImgs = LazyImages(GalleryPaths, args.img_size)
 
-    # Fit kNN model on gallery images
-    print("\nFitting KNN model on training data...")
-    k = 10
-    knn = NearestNeighbors(n_neighbors=k, metric="cosine")
-    knn.fit(E_gallery)
-    print("Done fitting")
+# Create embeddings using model
+print("\nCreating embeddings")
+E_query_flatten = pipeline.embed(np.array(QueryImgs).reshape((-1,) + shape_img))
 
-    # Querying on test images
-    final_res_knn = dict()
-    print("\nQuerying...")
-    for i, emb_flatten in enumerate(E_query):
-        distances, indx = knn.kneighbors([emb_flatten])
-        img_query = QueryImgs[i]
-        query_name = QueryName[i]
-        imgs_retrieval = [GalleryImgs[idx] for idx in indx.flatten()]
-        names_retrieval = [GalleryName[idx] for idx in indx.flatten()]
-        if args.plot == 'True':
-            outFile = os.path.join(OutputDir, "Triplets_retrieval_knn_" + str(i) + ".png")
-            plot_query_retrieval(img_query, imgs_retrieval, None)
+# Optional reduction of the embeddings, fitted on the gallery once and reused
+if args.reduce != 'none':
+    print("\nReducing the embeddings to {:d} dimensions ({:s})".format(args.n_components, args.reduce))
+E_query_flatten, E_gallery_flatten = pipeline.reduce_embeddings(E_query_flatten, E_gallery_flatten)
 
-        create_results_dict(final_res_knn, query_name, names_retrieval)
+# Distances between query and gallery with the method chosen by -distance, and optional re-ranking
+print("\nSearching the gallery images ({:s} distance)".format(args.distance))
+indices = pipeline.search(E_query_flatten, E_gallery_flatten, GalleryPaths)
 
-    print('Saving results...')
+if args.recall == 'True' and args.distance == 'ivfpq':
+    recall_sweep(pipeline.index, E_query_flatten, E_gallery_flatten, k=10)
+if args.recall == 'True' and args.distance == 'hamming':
+    hashing_recall_sweep(pipeline.index, E_query_flatten, E_gallery_flatten, k=10)
 
-    url = "http://ec2-18-191-24-254.us-east-2.compute.amazonaws.com/results/"
+print('\nComputed distances and got top-k {}'.format(indices.shape))
 
-    if args.distance == 'knn':
-        final_results_knn = create_final_dict(final_res_knn)
-        submit(final_results_knn, url)
-        file_knn = open('dictionaries_submission_pickle/knn_triplets.pickle', 'wb')
-        pickle.dump(final_results_knn, file_knn)
-    else:
-        final_results_pairwise = create_final_dict(final_res_pairwise)
-        submit(final_results_pairwise, url)
-        file_p = open('dictionaries_submission_pickle/pairwise_triplets.pickle', 'wb')
-        pickle.dump(final_results_pairwise, file_p)
+if args.plot == 'True':
+    for i, indx in enumerate(indices):
+        imgs_retrieval = [GalleryImgs[idx] for idx in indx if idx >= 0]
+        outFile = os.path.join(OutputDir, plot_prefix + result_name + "_" + str(i) + ".png")
+        plot_query_retrieval(QueryImgs[i], imgs_retrieval, outFile)
 
-    print("Done saving")
+print('Saving results...')
+final_res = pipeline.results(QueryName, GalleryName, indices)
+print("Done saving")
+pipeline.report()
+PROFILER.save(args.report if args.report is not None else report_file(OutputDir, 'main_test'), **vars(args))
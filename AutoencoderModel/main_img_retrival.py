@@ -1,12 +1,16 @@
 import os
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
-from image_loading import Loader
+from image_loading import Loader, LazyImages
+from embedding_cache import EmbeddingCache, model_fingerprint, embed_with_cache
 from autoencoder import AutoEncoder
 from transform import normalize_img, data_augmentation
+from data_pipeline import make_train_dataset
+from batch_augmentation import BatchAugmenter
+from shards import write_shards, shards_exist, ShardedImages
 from final_display import *
+from retrieval import topk_search, topk_accuracy
+from profiling import PROFILER, stage, report_file
 from visualization import *
-from scipy import spatial
 import argparse
 import wandb
 
@@ -57,7 +61,43 @@ parser.add_argument('-plot',
                     type=str,
                     default='False',
                     help='Helper to visualize the results (default = False)')
+parser.add_argument('-pipeline',
+                    type=str,
+                    default='generator',
+                    help='training input: generator (in-memory ImageDataGenerator), vectorized (in-memory batched NumPy '
+                         'augmentation), shards (uint8 shards, see -shards) or tfdata (streamed from disk)')
+parser.add_argument('-shards',
+                    type=str,
+                    default=None,
+                    help='directory of the uint8 training shards, written on the first run '
+                         '(default = output/shards/training_<img_size>)')
+parser.add_argument('-tfdata_cache',
+                    type=str,
+                    default=None,
+                    help='tf.data cache of the decoded training images: empty string for memory, else a file name')
+parser.add_argument('-cache',
+                    type=str,
+                    default='True',
+                    help='Reuse the gallery embeddings cached on disk (default = True)')
+parser.add_argument('-workers',
+                    type=int,
+                    default=None,
+                    help='number of threads used to decode the images (default = one per CPU)')
+parser.add_argument('-rescan',
+                    type=str,
+                    default='False',
+                    help='List every image again instead of the changed subfolders only, e.g. after images were '
+                         'overwritten in place (default = False)')
+parser.add_argument('-report',
+                    type=str,
+                    default=None,
+                    help='JSON profiling report of the run (default = output/<model>/profiles/<script>_<time>.json)')
+parser.add_argument('-profile_stage',
+                    type=str,
+                    default=None,
+                    help='stage run under cProfile, e.g. decode, predict or search (default = None)')
 args = parser.parse_args()
+PROFILER.profile_stage = args.profile_stage
 
 
 if args.wandb == 'True':
@@ -77,9 +117,14 @@ GalleryDir = os.path.join(os.getcwd(), args.data_path, "validation", "gallery")
 OutputDir = os.path.join(os.getcwd(), "output", "convAE")
 if not os.path.exists(OutputDir):
     os.makedirs(OutputDir)
+CacheDir = os.path.join(OutputDir, "embedding_cache")
+ShardDir = args.shards
+if ShardDir is None:
+    ShardDir = os.path.join(os.getcwd(), "output", "shards", "training_{}".format(args.img_size))
 
 # Create loader
-loader = Loader(args.img_size, args.img_size, args.channels)
+# The folder manifests are reused by the next runs
+loader = Loader(args.img_size, args.img_size, args.channels, os.path.join(os.getcwd(), "output", "manifests"))
 
 # Extract img final for the model
 shape_img = (args.img_size, args.img_size, args.channels)
@@ -98,27 +143,42 @@ output_shape_model = tuple([int(x) for x in model.encoder.output.shape[1:]])
 
 if args.mode == "training model":
     # Read images
-    train_map = loader.get_files(TrainDir)
-    train_names, train_paths, imgs_train, train_classes = loader.get_data_paths(train_map)
-    
-  
+    train_map = loader.get_files(TrainDir, args.workers, args.rescan == 'True')
+
     num_files = len(train_map.keys())
     steps_per_epoch = num_files // args.e
     print('steps-per-epoch', steps_per_epoch)
     print('batch number', args.bs)
     print('epochs number', args.e)
 
-    # Normalize all images
-    print("\nNormalizing training images")
-    imgs_train = normalize_img(imgs_train)
-    print("Number of training images:", len(imgs_train))
-    # Convert images to numpy array of right dimensions
-    print("\nConverting training images to numpy array of right dimensions")
-    X_train = np.array(imgs_train).reshape((-1,) + input_shape_model)
-    print(">>> X_train.shape = " + str(X_train.shape))
-    print("Number of training images:", len(X_train))
-    # Create object for train augmentation
-    completeTrainGen = data_augmentation(X_train, args.bs)
+    if args.pipeline == 'tfdata':
+        # Images are streamed from disk, decoded and augmented in parallel by tf.data
+        print("\nCreating tf.data training pipeline")
+        completeTrainGen = make_train_dataset(train_map, args.img_size, args.bs, cache=args.tfdata_cache)
+    elif args.pipeline == 'shards':
+        # Images decoded once into uint8 shards, memory-mapped and normalized batch by batch
+        if not shards_exist(ShardDir, loader, train_map):
+            write_shards(loader, train_map, ShardDir, n_workers=args.workers)
+        X_train = ShardedImages(ShardDir)
+        print(">>> X_train.shape = " + str(X_train.shape))
+        completeTrainGen = BatchAugmenter().flow(X_train, args.bs)
+    else:
+        train_names, train_paths, imgs_train, train_classes = loader.get_data_array(train_map, args.workers)
+
+        # Normalize all images
+        print("\nNormalizing training images")
+        imgs_train = normalize_img(imgs_train)
+        print("Number of training images:", len(imgs_train))
+        # Convert images to numpy array of right dimensions
+        print("\nConverting training images to numpy array of right dimensions")
+        X_train = np.asarray(imgs_train).reshape((-1,) + input_shape_model)
+        print(">>> X_train.shape = " + str(X_train.shape))
+        print("Number of training images:", len(X_train))
+        # Create object for train augmentation
+        if args.pipeline == 'vectorized':
+            completeTrainGen = BatchAugmenter().flow(X_train, args.bs)
+        else:
+            completeTrainGen = data_augmentation(X_train, args.bs)
     print("\nStart training...")
 
     # Compiling
@@ -131,50 +191,43 @@ if args.mode == "training model":
     model.save_models()
     print("Done training")
 
-    print("\nCreating embeddings...")
-    E_train = model.predict(X_train)
-    E_train_flatten = E_train.reshape((-1, np.prod(output_shape_model)))
-
 # Read images
-query_map = loader.get_files(QueryDir)
-query_names, query_paths, imgs_query, query_classes = loader.get_data_paths(query_map)
-gallery_map = loader.get_files(GalleryDir)
-gallery_names, gallery_paths, imgs_gallery, gallery_classes = loader.get_data_paths(gallery_map)
+query_map = loader.get_files(QueryDir, args.workers, args.rescan == 'True')
+query_names, query_paths, imgs_query, query_classes = loader.get_data_array(query_map, args.workers)
+gallery_map = loader.get_files(GalleryDir, args.workers, args.rescan == 'True')
+gallery_names, gallery_paths, gallery_classes = loader.get_data_names(gallery_map)
 
 # Normalize all images
 print("Normalizing query images")
 imgs_query = normalize_img(imgs_query)
-print("Normalizing gallery images")
-imgs_gallery = normalize_img(imgs_gallery)
 
 # Convert images to numpy array of right dimensions
 print("\nConverting validation images to numpy array of right dimensions")
-X_query = np.array(imgs_query).reshape((-1,) + input_shape_model)
-X_gallery = np.array(imgs_gallery).reshape((-1,) + input_shape_model)
+X_query = np.asarray(imgs_query).reshape((-1,) + input_shape_model)
 print(">>> X_query.shape = " + str(X_query.shape))
-print(">>> X_gallery.shape = " + str(X_gallery.shape))
 
 if args.mode != "training model":
     print("\nLoading model...")
     model.load_models(loss=args.loss, optimizer="adam")
 
+
+def embed_gallery(images_paths):
+    # Gallery images are decoded only when their embedding is not cached
+    imgs = normalize_img(loader.read_images(images_paths, args.workers))
+    with stage('predict', len(imgs)):
+        return model.predict(imgs.reshape((-1,) + input_shape_model))
+
+
 # Create embeddings using model
 print("\nCreating embeddings...")
-E_query = model.predict(X_query)
+with stage('predict', len(X_query)):
+    E_query = model.predict(X_query)
 E_query_flatten = E_query.reshape((-1, np.prod(output_shape_model)))
-E_gallery = model.predict(X_gallery)
-E_gallery_flatten = E_gallery.reshape((-1, np.prod(output_shape_model)))
-
-
-# Compute top-k
-def topk_accuracy(gt_label, matched_label, k=1):
-    matched_label = matched_label[:, :k]
-    total = matched_label.shape[0]
-    correct = 0
-    for q_idx, q_lbl in enumerate(gt_label):
-        correct += np.any(q_lbl == matched_label[q_idx, :]).item()
-    acc_tmp = correct/total
-    return acc_tmp
+cache = None
+if args.cache == 'True':
+    cache = EmbeddingCache(CacheDir, model_fingerprint(encoderFile, args.img_size, 'encoder'))
+E_gallery_flatten = embed_with_cache(gallery_paths, embed_gallery, cache)
+imgs_gallery = LazyImages(gallery_paths, args.img_size)
 
 
 # Distancces between query and gallery with pairwise distance
@@ -182,21 +235,20 @@ def topk_accuracy(gt_label, matched_label, k=1):
 print("\nComputing pairwise distance between query and gallery images")
 
 # Define the distance between query - gallery features vectors
-pairwise_dist = spatial.distance.cdist(E_query_flatten, E_gallery_flatten, args.metric, p=2.)
-print('\nComputed distances and got c-dist {}'.format(pairwise_dist.shape))
+pairwise_dist, indices = topk_search(E_query_flatten, E_gallery_flatten, k=10, metric=args.metric, p=2.)
+print('\nComputed distances and got top-k {}'.format(indices.shape))
 
 print("\nCalculating indices and gallery matches...")
-indices = np.argsort(pairwise_dist, axis=-1)
 gallery_matches = gallery_classes[indices]
 
 final_res_pairwise = dict()
 for i, emb_flatten in enumerate(indices):
     img_query = imgs_query[i]
     query_name = query_names[i]
-    imgs_retrieval = [imgs_gallery[indx] for indx in indices[i][:10]]
     names_retrieval = [gallery_names[indx] for indx in indices[i][:10]]
 
     if args.plot == 'True':
+        imgs_retrieval = [imgs_gallery[indx] for indx in indices[i][:10]]
         outFile = os.path.join(OutputDir, "ConvAE_retrieval_" + str(i) + ".png")
         plot_query_retrieval(img_query, imgs_retrieval, None)
 
@@ -213,28 +265,24 @@ for k in [1, 3, 10]:
 
 print("\nComputing knn for distance between query and gallery images")
 
-# Fit kNN model on gallery images
-print("\nFitting KNN model on training data...")
+# Querying on test images, all the queries are searched at once
+print("\nQuerying...")
 k = 10
-knn = NearestNeighbors(n_neighbors=k, metric="cosine")
-knn.fit(E_gallery_flatten)
-print("Done fitting")
+knn_distances, knn_indices = topk_search(E_query_flatten, E_gallery_flatten, k=k, metric="cosine")
+print("Done querying")
 
-# Querying on test images
 final_res_knn = dict()
-print("\nQuerying...")
 query_classes_knn = []
 class_retrieval_knn = []
-for i, emb_flatten in enumerate(E_query_flatten):
-    distances, indx = knn.kneighbors([emb_flatten])
+for i, indx in enumerate(knn_indices):
     img_query = imgs_query[i]
     query_name = query_names[i]
     query_classes_knn.append(query_classes[i])
-    imgs_retrieval = [imgs_gallery[idx] for idx in indx.flatten()]
     names_retrieval = [gallery_names[idx] for idx in indx.flatten()]
     class_retrieval_knn.append([gallery_classes[idx] for idx in indx.flatten()])
 
     if args.plot == 'True':
+        imgs_retrieval = [imgs_gallery[idx] for idx in indx.flatten()]
         outFile = os.path.join(OutputDir, "ConvAE_retrieval_knn_" + str(i) + ".png")
         plot_query_retrieval(img_query, imgs_retrieval, None)
 
@@ -253,5 +301,6 @@ url = "http://ec2-18-191-24-254.us-east-2.compute.amazonaws.com/results/"
 submit(final_results_knn, url)
 print("Done saving")
 
-
-
+# Time, CPU, memory and items of every stage of the run
+PROFILER.report()
+PROFILER.save(args.report if args.report is not None else report_file(OutputDir, 'main_img_retrival'), **vars(args))
@@ -1,12 +1,13 @@
 import os
 import numpy as np
-import tensorflow as tf
-from sklearn.neighbors import NearestNeighbors
 from visualization import plot_query_retrieval
-from image_loading import Loader
+from image_loading import Loader, LazyImages
+from embedding_cache import EmbeddingCache, embed_with_cache
+from encoders import load_encoder
 from transform import normalize_img
 from final_display import *
-from scipy import spatial
+from retrieval import topk_search, topk_accuracy
+from profiling import PROFILER, report_file
 import argparse
 import wandb
 
@@ -54,7 +55,41 @@ parser.add_argument('-plot',
                     type=str,
                     default='False',
                     help='Helper to visualize the results (default = False)')
+parser.add_argument('-cache',
+                    type=str,
+                    default='True',
+                    help='Reuse the gallery embeddings cached on disk (default = True)')
+parser.add_argument('-workers',
+                    type=int,
+                    default=None,
+                    help='number of threads used to decode the images (default = one per CPU)')
+parser.add_argument('-rescan',
+                    type=str,
+                    default='False',
+                    help='List every image again instead of the changed subfolders only, e.g. after images were '
+                         'overwritten in place (default = False)')
+parser.add_argument('-precision',
+                    type=str,
+                    default='float32',
+                    help='inference precision: float32, mixed_bfloat16, mixed_float16 or int8 (TFLite)')
+parser.add_argument('-jit',
+                    type=str,
+                    default='False',
+                    help='Compile the model with XLA (default = False)')
+parser.add_argument('-pooling',
+                    type=str,
+                    default='none',
+                    help='pooling head on the ResNet50 features: none (flattened), gap, gem or rmac')
+parser.add_argument('-report',
+                    type=str,
+                    default=None,
+                    help='JSON profiling report of the run (default = output/<model>/profiles/<script>_<time>.json)')
+parser.add_argument('-profile_stage',
+                    type=str,
+                    default=None,
+                    help='stage run under cProfile, e.g. decode, predict or search (default = None)')
 args = parser.parse_args()
+PROFILER.profile_stage = args.profile_stage
 
 if args.wandb == 'True':
     # Login to wandb
@@ -73,58 +108,46 @@ GalleryDir = os.path.join(os.getcwd(), args.data_path, "validation", "gallery")
 OutputDir = os.path.join(os.getcwd(), "output", "pretrained")
 if not os.path.exists(OutputDir):
     os.makedirs(OutputDir)
+CacheDir = os.path.join(OutputDir, "embedding_cache")
 
 # Create loader
-loader = Loader(args.img_size, args.img_size, args.channels)
+# The folder manifests are reused by the next runs
+loader = Loader(args.img_size, args.img_size, args.channels, os.path.join(os.getcwd(), "output", "manifests"))
 
 # Extract img final for the model
 shape_img = (args.img_size, args.img_size, args.channels)
 print("Image size", shape_img)
 
 # Read images
-query_map = loader.get_files(QueryDir)
-query_names, query_paths, imgs_query, query_classes = loader.get_data_paths(query_map)
-gallery_map = loader.get_files(GalleryDir)
-gallery_names, gallery_paths, imgs_gallery, gallery_classes = loader.get_data_paths(gallery_map)
+query_map = loader.get_files(QueryDir, args.workers, args.rescan == 'True')
+query_names, query_paths, imgs_query, query_classes = loader.get_data_array(query_map, args.workers)
+gallery_map = loader.get_files(GalleryDir, args.workers, args.rescan == 'True')
+gallery_names, gallery_paths, gallery_classes = loader.get_data_names(gallery_map)
 
 # Load pre-trained ResNet50 model + higher level layers
-print("\nLoading model...")
-model = tf.keras.applications.ResNet50(weights='imagenet', include_top=False, input_shape=shape_img)
-model.summary()
-
-shape_img_resize = tuple([int(x) for x in model.input.shape[1:]])
-input_shape_model = tuple([int(x) for x in model.input.shape[1:]])
-output_shape_model = tuple([int(x) for x in model.output.shape[1:]])
+# The pooling head runs inside the graph, only the pooled descriptors leave the model. The embeddings of
+# every pooling head and precision are fingerprinted, and cached, apart
+embed, fingerprint = load_encoder('pretrained', shape_img, OutputDir, args.precision, args.jit == 'True',
+                                  args.pooling)
 
 # Normalize all images
 print("Normalizing query images")
 imgs_query = normalize_img(imgs_query)
-print("Normalizing gallery images")
-imgs_gallery = normalize_img(imgs_gallery)
 
-# Convert images to numpy array of right dimensions
-print("\nConverting to numpy array of right dimensions")
-X_query = np.array(imgs_query).reshape((-1,) + input_shape_model)
-X_gallery = np.array(imgs_gallery).reshape((-1,) + input_shape_model)
 
-# Create embeddings using model
-print("\nCreating embeddings")
-E_query = model.predict(X_query)
-E_query_flatten = E_query.reshape((-1, np.prod(output_shape_model)))
-E_gallery = model.predict(X_gallery)
-E_gallery_flatten = E_gallery.reshape((-1, np.prod(output_shape_model)))
+def embed_gallery(images_paths):
+    # Gallery images are decoded only when their embedding is not cached
+    return embed(normalize_img(loader.read_images(images_paths, args.workers)))
 
 
-
-# Compute top-k
-def topk_accuracy(gt_label, matched_label, k=1):
-    matched_label = matched_label[:, :k]
-    total = matched_label.shape[0]
-    correct = 0
-    for q_idx, q_lbl in enumerate(gt_label):
-        correct += np.any(q_lbl == matched_label[q_idx, :]).item()
-    acc_tmp = correct/total
-    return acc_tmp
+# Create embeddings using model
+print("\nCreating embeddings")
+E_query_flatten = embed(imgs_query)
+cache = None
+if args.cache == 'True':
+    cache = EmbeddingCache(CacheDir, fingerprint)
+E_gallery_flatten = embed_with_cache(gallery_paths, embed_gallery, cache)
+imgs_gallery = LazyImages(gallery_paths, args.img_size)
 
 
 # Distancces between query and gallery with pairwise distance
@@ -132,21 +155,20 @@ def topk_accuracy(gt_label, matched_label, k=1):
 print("\nComputing pairwise distance between query and gallery images")
 
 # Define the distance between query - gallery features vectors
-pairwise_dist = spatial.distance.cdist(E_query_flatten, E_gallery_flatten, args.metric, p=2.)
-print('\nComputed distances and got c-dist {}'.format(pairwise_dist.shape))
+pairwise_dist, indices = topk_search(E_query_flatten, E_gallery_flatten, k=10, metric=args.metric, p=2.)
+print('\nComputed distances and got top-k {}'.format(indices.shape))
 
 print("\nCalculating indices and gallery matches...")
-indices = np.argsort(pairwise_dist, axis=-1)
 gallery_matches = gallery_classes[indices]
 
 final_res_pairwise = dict()
 for i, emb_flatten in enumerate(indices):
     img_query = imgs_query[i]
     query_name = query_names[i]
-    imgs_retrieval = [imgs_gallery[indx] for indx in indices[i][:10]]
     names_retrieval = [gallery_names[indx] for indx in indices[i][:10]]
 
     if args.plot == 'True':
+        imgs_retrieval = [imgs_gallery[indx] for indx in indices[i][:10]]
         outFile = os.path.join(OutputDir, "ConvAE_retrieval_" + str(i) + ".png")
         plot_query_retrieval(img_query, imgs_retrieval, None)
 
@@ -163,28 +185,24 @@ for k in [1, 3, 10]:
 
 print("\nComputing knn for distance between query and gallery images")
 
-# Fit kNN model on gallery images
-print("\nFitting KNN model on training data...")
+# Querying on test images, all the queries are searched at once
+print("\nQuerying...")
 k = 10
-knn = NearestNeighbors(n_neighbors=k, metric="cosine")
-knn.fit(E_gallery_flatten)
-print("Done fitting")
+knn_distances, knn_indices = topk_search(E_query_flatten, E_gallery_flatten, k=k, metric="cosine")
+print("Done querying")
 
-# Querying on test images
 final_res_knn = dict()
-print("\nQuerying...")
 query_classes_knn = []
 class_retrieval_knn = []
-for i, emb_flatten in enumerate(E_query_flatten):
-    distances, indx = knn.kneighbors([emb_flatten])
+for i, indx in enumerate(knn_indices):
     img_query = imgs_query[i]
     query_name = query_names[i]
     query_classes_knn.append(query_classes[i])
-    imgs_retrieval = [imgs_gallery[idx] for idx in indx.flatten()]
     names_retrieval = [gallery_names[idx] for idx in indx.flatten()]
     class_retrieval_knn.append([gallery_classes[idx] for idx in indx.flatten()])
 
     if args.plot == 'True':
+        imgs_retrieval = [imgs_gallery[idx] for idx in indx.flatten()]
         outFile = os.path.join(OutputDir, "ConvAE_retrieval_knn_" + str(i) + ".png")
         plot_query_retrieval(img_query, imgs_retrieval, None)
 
@@ -203,4 +221,6 @@ url = "http://ec2-18-191-24-254.us-east-2.compute.amazonaws.com/results/"
 submit(final_results_knn, url)
 print("Done saving")
 
-
+# Time, CPU, memory and items of every stage of the run
+PROFILER.report()
+PROFILER.save(args.report if args.report is not None else report_file(OutputDir, 'main_pretrained'), **vars(args))
@@ -0,0 +1,449 @@
+import os
+import json
+import pickle
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from image_loading import list_imgs_no_subfolders
+from transform import normalize_img
+from embedding_cache import EmbeddingCache, embed_with_cache
+from embedding_store import (save_embedding_matrix, load_embedding_matrix, store_exists, store_mismatch,
+                             extract_embedding_matrix)
+from retrieval import topk_accuracy
+from indexes import meta_mismatch, build_index, index_search_fn
+from reduction import Reducer
+from reranking import rerank
+from final_display import create_results_dict, create_final_dict, submit
+from profiling import PROFILER, stage, report_file
+
+
+SUBMIT_URL = "http://ec2-18-191-24-254.us-east-2.compute.amazonaws.com/results/"
+
+
+class SubmitSink:
+
+    """This class posts the results to the challenge server"""
+
+    def __init__(self, url=SUBMIT_URL):
+        self.url = url
+
+    def __call__(self, results):
+        submit(create_final_dict(results), self.url)
+
+
+class PickleSink:
+
+    """This class pickles the final dictionary of the results, like the files of dictionaries_submission_pickle"""
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+
+    def __call__(self, results):
+        with open(self.output_file, 'wb') as f:
+            pickle.dump(create_final_dict(results), f)
+
+
+class JSONSink:
+
+    """This class writes the final dictionary of the results as JSON"""
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+
+    def __call__(self, results):
+        with open(self.output_file, 'w') as f:
+            json.dump(create_final_dict(results), f)
+
+
+class RetrievalPipeline:
+
+    """This class runs the retrieval from the image folders to the results dictionary, with pluggable parts:
+    the encoder (embed_fn, a batch of normalized images -> embeddings, see encoders.load_encoder for convAE,
+    triplets_loss and pretrained), the index (distance, built by build_index) and the sinks (functions called with
+    the results dictionary, see SubmitSink, PickleSink and JSONSink). The images are decoded, normalized and
+    embedded batch_size at a time, the gallery embeddings go through the embedding cache or the embedding store,
+    and every stage is recorded by the shared profiler (see profiling.py)"""
+
+    def __init__(self, loader, embed_fn, output_dir, fingerprint=None, distance='knn', metric='minkowski', k=10,
+                 index_params=None, search_params=None, reduce='none', n_components=256, whiten=True,
+                 rerank_method='none', rerank_n=100, sinks=(), cache=True, store=None, store_dtype='float32',
+                 chunk_size=0, rebuild_index=False, batch_size=256, n_workers=None):
+
+        self.loader = loader
+        self.embed_fn = embed_fn
+        self.output_dir = output_dir
+        self.fingerprint = fingerprint
+        self.distance = distance
+        self.metric = metric
+        self.k = k
+        self.index_params = dict() if index_params is None else index_params
+        self.search_params = dict() if search_params is None else search_params
+        self.reduce = reduce
+        self.n_components = n_components
+        self.whiten = whiten
+        self.rerank_method = rerank_method
+        self.rerank_n = rerank_n
+        self.sinks = list(sinks)
+        self.cache = cache and fingerprint is not None
+        self.store = store
+        self.store_dtype = store_dtype
+        self.chunk_size = chunk_size
+        self.rebuild_index = rebuild_index
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+        self.index = None
+        self.reducer = None
+
+    def list_images(self, data_dir):
+
+        """This function returns the names, paths and classes of the images of a folder: with class subfolders
+        from the loader manifest, otherwise the images of the folder itself (classes is None then)"""
+
+        with stage('list') as counter:
+            with os.scandir(data_dir) as entries:
+                has_subfolders = any(entry.is_dir() for entry in entries)
+            if has_subfolders:
+                manifest = self.loader.get_manifest(data_dir, self.n_workers)
+                images_paths = [entry[0] for entry in manifest]
+                classes = np.array([entry[1] for entry in manifest])
+            else:
+                images_paths = list_imgs_no_subfolders(data_dir)
+                classes = None
+            counter['items'] = len(images_paths)
+        return [os.path.split(img_path)[1] for img_path in images_paths], images_paths, classes
+
+    def embed(self, X):
+
+        """This function returns the flattened embeddings of normalized images, batch_size at a time"""
+
+        embeddings = []
+        for start in range(0, len(X), self.batch_size):
+            batch = X[start:start + self.batch_size]
+            with stage('predict', len(batch)):
+                embeddings.append(np.asarray(self.embed_fn(batch)).reshape((len(batch), -1)))
+        return np.concatenate(embeddings)
+
+    def embed_paths(self, images_paths):
+
+        """This function decodes, normalizes and embeds the images batch_size at a time"""
+
+        embeddings = []
+        with ThreadPoolExecutor(self.n_workers) as pool:
+            for start in range(0, len(images_paths), self.batch_size):
+                batch_paths = images_paths[start:start + self.batch_size]
+                with stage('decode', len(batch_paths)):
+                    imgs = self.loader.read_images(batch_paths, pool=pool)
+                with stage('normalize', len(batch_paths)):
+                    imgs = normalize_img(imgs)
+                embeddings.append(self.embed(imgs))
+        return np.concatenate(embeddings)
+
+    def load_gallery(self, gallery_dir):
+
+        """This function returns the names, paths, classes and embeddings of the gallery: from the store if it
+        exists and was built from the same model and gallery images, otherwise embedded with the cache (or chunk
+        by chunk into the store with chunk_size) and saved to the store if there is one"""
+
+        gallery_names, gallery_paths, gallery_classes = self.list_images(gallery_dir)
+
+        if self.store is not None and store_exists(self.store):
+            mismatch = store_mismatch(self.store, self.fingerprint, gallery_paths)
+            if not mismatch:
+                with stage('store') as counter:
+                    E_gallery, gallery_names, gallery_paths, gallery_classes = load_embedding_matrix(self.store)
+                    counter['items'] = len(E_gallery)
+                return gallery_names, gallery_paths, gallery_classes, E_gallery
+            print('\nThe store does not match the model and gallery ({}), embedding the gallery again'.format(
+                ', '.join(mismatch)))
+
+        if self.chunk_size > 0:
+            # Out-of-core extraction, straight into the store
+            store_path = self.store if self.store is not None else os.path.join(self.output_dir, "gallery_embeddings")
+            E_gallery = extract_embedding_matrix(store_path, gallery_paths, gallery_names, self.embed_paths,
+                                                 self.chunk_size, self.store_dtype, gallery_classes, self.fingerprint)
+            return gallery_names, gallery_paths, gallery_classes, E_gallery
+
+        cache = None
+        if self.cache:
+            cache = EmbeddingCache(os.path.join(self.output_dir, "embedding_cache"), self.fingerprint)
+        E_gallery = embed_with_cache(gallery_paths, self.embed_paths, cache)
+
+        if self.store is not None:
+            with stage('store', len(gallery_paths)):
+                save_embedding_matrix(self.store, E_gallery, gallery_names, gallery_paths, gallery_classes,
+                                      self.store_dtype, fingerprint=self.fingerprint)
+        return gallery_names, gallery_paths, gallery_classes, E_gallery
+
+    def reduction(self):
+
+        """This function returns the name of the reduction of the embeddings, saved with the index"""
+
+        if self.reduce == 'none':
+            return 'none'
+        return '{}_{}{}'.format(self.reduce, self.n_components, '_whiten' if self.whiten else '')
+
+    def reduce_embeddings(self, E_query, E_gallery):
+
+        """This function reduces the query and gallery embeddings with the reducer fitted on the gallery, saved in
+        the output folder and reused as long as the model, the embedding dimension and the whitening match"""
+
+        if self.reduce == 'none':
+            return E_query, E_gallery
+
+        with stage('reduce', len(E_query) + len(E_gallery)):
+            reducer_file = os.path.join(self.output_dir, "reducer_{}_{}.npz".format(self.reduce, self.n_components))
+            meta = {'fingerprint': self.fingerprint or '', 'dim': int(np.prod(np.shape(E_gallery)[1:])),
+                    'whiten': self.whiten}
+            self.reducer = None
+            if os.path.exists(reducer_file) and not self.rebuild_index:
+                self.reducer = Reducer.load(reducer_file)
+                mismatch = meta_mismatch(self.reducer, meta)
+                if mismatch:
+                    print('\nThe saved reducer does not match the embeddings ({}), fitting it again'.format(
+                        ', '.join(mismatch)))
+                    self.reducer = None
+            if self.reducer is None:
+                self.reducer = Reducer(self.reduce, self.n_components, whiten=self.whiten).fit(E_gallery)
+                self.reducer.meta = meta
+                self.reducer.save(reducer_file)
+            return self.reducer.transform(E_query), self.reducer.transform(E_gallery)
+
+    def search(self, E_query, E_gallery, gallery_paths):
+
+        """This function returns the indices of the k best gallery matches of every query: the index is built (or
+        loaded), searched and, with a re-ranking, its rerank_n first matches are re-ranked"""
+
+        with stage('index', len(E_gallery)):
+            self.index = build_index(self.distance, E_gallery, gallery_paths, self.output_dir, self.rebuild_index,
+                                     self.fingerprint, self.reduction(), **self.index_params)
+            search_fn = index_search_fn(self.distance, self.index, E_gallery, gallery_paths, self.metric,
+                                        **self.search_params)
+
+        k_first = self.k if self.rerank_method == 'none' else max(self.k, self.rerank_n)
+        with stage('search', len(E_query)):
+            indices = np.asarray(search_fn(E_query, k_first))
+
+        if self.rerank_method != 'none':
+            with stage('rerank', len(E_query)):
+                indices = rerank(E_query, E_gallery, indices, self.rerank_method)[:, :self.k]
+        return indices
+
+    def results(self, query_names, gallery_names, indices):
+
+        """This function returns the results dictionary of create_results_dict, and passes it to the sinks"""
+
+        results = dict()
+        with stage('results', len(query_names)):
+            for query_name, indx in zip(query_names, indices):
+                create_results_dict(results, query_name, [gallery_names[idx] for idx in indx if idx >= 0])
+        for sink in self.sinks:
+            with stage('sink', len(results)):
+                sink(results)
+        return results
+
+    def run(self, query_dir, gallery_dir):
+
+        """This function runs every stage on the query and gallery folders, prints the top-k accuracy when the
+        folders have class subfolders, and returns the results dictionary and the indices of the matches"""
+
+        query_names, query_paths, query_classes = self.list_images(query_dir)
+        E_query = self.embed_paths(query_paths)
+        gallery_names, gallery_paths, gallery_classes, E_gallery = self.load_gallery(gallery_dir)
+
+        E_query, E_gallery = self.reduce_embeddings(E_query, E_gallery)
+        indices = self.search(E_query, E_gallery, gallery_paths)
+
+        if query_classes is not None and gallery_classes is not None:
+            gallery_matches = np.where(indices >= 0, gallery_classes[np.maximum(indices, 0)], None)
+            for k in [1, 3, 10]:
+                if k <= self.k:
+                    print('>>> Top-{:d} Accuracy: {:.3f}'.format(k, topk_accuracy(query_classes, gallery_matches, k)))
+
+        return self.results(query_names, gallery_names, indices), indices
+
+    def report(self):
+
+        """This function prints the wall time, CPU time, number of items and peak memory of every stage"""
+
+        return PROFILER.report()
+
+
+if __name__ == '__main__':
+
+    from image_loading import Loader
+    from encoders import load_encoder
+
+    parser = argparse.ArgumentParser(description='Image retrieval from a query folder to a gallery folder')
+    parser.add_argument('--data_path',
+                        '-d',
+                        type=str,
+                        default='dataset_test',
+                        help='Dataset path, with the query and gallery folders')
+    parser.add_argument('-img_size',
+                        type=int,
+                        default=324,
+                        help='image size for the model')
+    parser.add_argument('-channels',
+                        type=int,
+                        default=3,
+                        help='number of channels')
+    parser.add_argument('-model',
+                        type=str,
+                        default='convAE',
+                        help='Default model = convAE, other options: pretrained, triplets_loss')
+    parser.add_argument('-precision',
+                        type=str,
+                        default='float32',
+                        help='inference precision: float32, mixed_bfloat16, mixed_float16 or int8 (TFLite)')
+    parser.add_argument('-jit',
+                        type=str,
+                        default='False',
+                        help='Compile the encoder with XLA (default = False)')
+    parser.add_argument('-pooling',
+                        type=str,
+                        default='none',
+                        help='pooling head of the pretrained model: none (flattened), gap, gem or rmac')
+    parser.add_argument('-distance',
+                        type=str,
+                        default='knn',
+                        help='knn, pairwise, ivfpq, hnsw or hamming distance between query and gallery')
+    parser.add_argument('-metric',
+                        type=str,
+                        default='minkowski',
+                        help='metric of the pairwise distance')
+    parser.add_argument('-k',
+                        type=int,
+                        default=10,
+                        help='number of gallery images returned per query')
+    parser.add_argument('-n_lists',
+                        type=int,
+                        default=256,
+                        help='number of inverted lists of the ivfpq index')
+    parser.add_argument('-n_subvectors',
+                        type=int,
+                        default=8,
+                        help='number of bytes of the product-quantized codes of the ivfpq index')
+    parser.add_argument('-nprobe',
+                        type=int,
+                        default=8,
+                        help='number of inverted lists scanned per query by the ivfpq index')
+    parser.add_argument('-M',
+                        type=int,
+                        default=16,
+                        help='number of links per node of the hnsw graph')
+    parser.add_argument('-ef_construction',
+                        type=int,
+                        default=100,
+                        help='size of the candidate list used to insert images in the hnsw graph')
+    parser.add_argument('-ef',
+                        type=int,
+                        default=50,
+                        help='size of the candidate list of the hnsw search')
+    parser.add_argument('-n_bits',
+                        type=int,
+                        default=256,
+                        help='number of bits of the binary codes with -distance hamming')
+    parser.add_argument('-hash_method',
+                        type=str,
+                        default='itq',
+                        help='binary hashing: mean or itq')
+    parser.add_argument('-shortlist',
+                        type=int,
+                        default=100,
+                        help='number of gallery images re-ranked after the hamming search')
+    parser.add_argument('-rebuild_index',
+                        type=str,
+                        default='False',
+                        help='Rebuild the index and the reducer even if they are saved (default = False)')
+    parser.add_argument('-reduce',
+                        type=str,
+                        default='none',
+                        help='reduction of the embeddings before the search: none, pca or random')
+    parser.add_argument('-n_components',
+                        type=int,
+                        default=256,
+                        help='dimension of the reduced embeddings')
+    parser.add_argument('-whiten',
+                        type=str,
+                        default='True',
+                        help='Whiten the PCA components (default = True)')
+    parser.add_argument('-rerank',
+                        type=str,
+                        default='none',
+                        help='re-ranking of the first-stage matches: none, qe or kreciprocal')
+    parser.add_argument('-rerank_n',
+                        type=int,
+                        default=100,
+                        help='number of first-stage matches re-ranked')
+    parser.add_argument('-cache',
+                        type=str,
+                        default='True',
+                        help='Reuse the gallery embeddings cached on disk (default = True)')
+    parser.add_argument('-store',
+                        type=str,
+                        default=None,
+                        help='Path of a gallery embedding store: read if it exists, written otherwise')
+    parser.add_argument('-store_dtype',
+                        type=str,
+                        default='float32',
+                        help='dtype of the gallery embedding store, float32 or float16')
+    parser.add_argument('-chunk_size',
+                        type=int,
+                        default=0,
+                        help='embed the gallery in resumable chunks of this size into the store (default = 0)')
+    parser.add_argument('-bs',
+                        type=int,
+                        default=256,
+                        help='number of images decoded and embedded at a time')
+    parser.add_argument('-workers',
+                        type=int,
+                        default=None,
+                        help='number of threads used to decode the images (default = one per CPU)')
+    parser.add_argument('-sink',
+                        type=str,
+                        default='none',
+                        help='where the results go: none, submit, pickle or json (to -out)')
+    parser.add_argument('-out',
+                        type=str,
+                        default=None,
+                        help='output file of the pickle and json sinks (default = output/<model>/results.<sink>)')
+    parser.add_argument('-report',
+                        type=str,
+                        default=None,
+                        help='JSON profiling report of the run (default = output/<model>/profiles/pipeline_<time>.json)')
+    parser.add_argument('-profile_stage',
+                        type=str,
+                        default=None,
+                        help='stage run under cProfile, e.g. decode, predict or search (default = None)')
+    args = parser.parse_args()
+    PROFILER.profile_stage = args.profile_stage
+
+    shape_img = (args.img_size, args.img_size, args.channels)
+    QueryDir = os.path.join(os.getcwd(), args.data_path, "query")
+    GalleryDir = os.path.join(os.getcwd(), args.data_path, "gallery")
+    OutputDir = os.path.join(os.getcwd(), "output", args.model)
+    if not os.path.exists(OutputDir):
+        os.makedirs(OutputDir)
+
+    loader = Loader(args.img_size, args.img_size, args.channels, os.path.join(os.getcwd(), "output", "manifests"))
+    embed, fingerprint = load_encoder(args.model, shape_img, OutputDir, args.precision, args.jit == 'True',
+                                     args.pooling)
+
+    OutFile = args.out
+    if OutFile is None:
+        OutFile = os.path.join(OutputDir, "results." + args.sink)
+    sinks = {'none': [], 'submit': [SubmitSink()], 'pickle': [PickleSink(OutFile)], 'json': [JSONSink(OutFile)]}
+
+    pipeline = RetrievalPipeline(loader, embed, OutputDir, fingerprint, args.distance, args.metric, args.k,
+                                 index_params=dict(n_lists=args.n_lists, n_subvectors=args.n_subvectors, M=args.M,
+                                                   ef_construction=args.ef_construction, n_bits=args.n_bits,
+                                                   hash_method=args.hash_method),
+                                 search_params=dict(nprobe=args.nprobe, ef=args.ef, shortlist=args.shortlist),
+                                 reduce=args.reduce, n_components=args.n_components, whiten=args.whiten == 'True',
+                                 rerank_method=args.rerank, rerank_n=args.rerank_n, sinks=sinks[args.sink],
+                                 cache=args.cache == 'True', store=args.store, store_dtype=args.store_dtype,
+                                 chunk_size=args.chunk_size, rebuild_index=args.rebuild_index == 'True',
+                                 batch_size=args.bs, n_workers=args.workers)
+    pipeline.run(QueryDir, GalleryDir)
+    pipeline.report()
+    PROFILER.save(args.report if args.report is not None else report_file(OutputDir, 'pipeline'), **vars(args))
@@ -0,0 +1,98 @@
+import numpy as np
+import tensorflow as tf
+
+
+POOLINGS = ('none', 'gap', 'gem', 'rmac')
+
+
+class GeMPooling(tf.keras.layers.Layer):
+
+    """This layer is the generalized mean pooling: (mean of x^p over the spatial positions)^(1/p),
+    p = 1 is the average pooling and a large p tends to the max pooling"""
+
+    def __init__(self, p=3., eps=1e-6, **kwargs):
+        super().__init__(**kwargs)
+        self.p = p
+        self.eps = eps
+
+    def call(self, x):
+        x = tf.pow(tf.maximum(x, self.eps), self.p)
+        return tf.pow(tf.reduce_mean(x, axis=[1, 2]), 1. / self.p)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'p': self.p, 'eps': self.eps})
+        return config
+
+
+def rmac_regions(height, width, levels=3, overlap=0.4):
+
+    """This function returns the (top, left, size) of the square regions of R-MAC: at level l the shorter side
+    is covered by l regions of size 2 * min(height, width) / (l + 1), overlapping by about 40%"""
+
+    side = min(height, width)
+    steps = np.arange(2, 8)
+    b = (max(height, width) - side) / (steps - 1)
+    extra = np.argmin(np.abs((side ** 2 - side * b) / side ** 2 - overlap)) + 1
+    extra_w = extra if width > height else 0
+    extra_h = extra if height > width else 0
+
+    regions = []
+    for level in range(1, levels + 1):
+        size = max(int(np.floor(2 * side / (level + 1))), 1)
+        half = np.floor(size / 2 - 1)
+
+        def centers(length, extra):
+            n = level + extra
+            step = (length - size) / (n - 1) if n > 1 else 0
+            return (np.floor(half + np.arange(n) * step) - half).astype(int)
+
+        for top in centers(height, extra_h):
+            for left in centers(width, extra_w):
+                regions.append((int(top), int(left), size))
+    return regions
+
+
+class RMACPooling(tf.keras.layers.Layer):
+
+    """This layer is the regional maximum activation of convolutions: the features are max-pooled over square
+    regions at several scales, every region vector is L2-normalized and the sum is L2-normalized again"""
+
+    def __init__(self, levels=3, **kwargs):
+        super().__init__(**kwargs)
+        self.levels = levels
+
+    def build(self, input_shape):
+        self.regions = rmac_regions(int(input_shape[1]), int(input_shape[2]), self.levels)
+        super().build(input_shape)
+
+    def call(self, x):
+        descriptor = 0.
+        for top, left, size in self.regions:
+            region = tf.reduce_max(x[:, top:top + size, left:left + size, :], axis=[1, 2])
+            descriptor += tf.math.l2_normalize(region, axis=1)
+        return tf.math.l2_normalize(descriptor, axis=1)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'levels': self.levels})
+        return config
+
+
+def pretrained_encoder(shape_img, pooling='none'):
+
+    """This function returns ResNet50 without top followed by a pooling head: none keeps the flattened feature map,
+    gap, gem and rmac return 2048-d descriptors computed inside the graph"""
+
+    assert pooling in POOLINGS, 'The pooling is one of ' + ', '.join(POOLINGS)
+    backbone = tf.keras.applications.ResNet50(weights='imagenet', include_top=False, input_shape=shape_img)
+    if pooling == 'none':
+        return backbone
+
+    if pooling == 'gap':
+        x = tf.keras.layers.GlobalAveragePooling2D()(backbone.output)
+    elif pooling == 'gem':
+        x = GeMPooling()(backbone.output)
+    else:
+        x = RMACPooling()(backbone.output)
+    return tf.keras.models.Model(backbone.input, x, name='resnet50_' + pooling)
@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import platform
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak memory is not reported there
+    resource = None
+
+
+def peak_rss_mb():
+
+    """This function returns the peak resident memory of the process in MB (None if it is not available)"""
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class Profiler:
+
+    """This class accumulates, for every stage of a run, the number of calls and items, the wall time, the CPU time
+    of the process and the peak resident memory at the end of the stage. Stages opened inside another stage are
+    recorded under 'outer/inner', a stage opened inside a stage of the same name is counted once. The stage named
+    profile_stage also runs under cProfile, its statistics are written next to the report"""
+
+    def __init__(self, profile_stage=None):
+
+        self.profile_stage = profile_stage
+        self.started = time.time()
+        self.stages = dict()
+        self.cprofile = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def reset(self):
+
+        """This function forgets every stage recorded so far"""
+
+        with self.lock:
+            self.started = time.time()
+            self.stages = dict()
+            self.cprofile = None
+
+    @contextmanager
+    def stage(self, name, n_items=0):
+
+        """This function records the code run inside it as the stage name, items only known at the end of the
+        stage can be added to the yielded counter"""
+
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        counter = {'items': n_items}
+        if stack and stack[-1] == name:
+            # Same stage called from its own wrapper, e.g. RetrievalPipeline.search and topk_search
+            yield counter
+            return
+
+        stack.append(name)
+        key = '/'.join(stack)
+        profile = name == self.profile_stage and threading.current_thread() is threading.main_thread()
+        if profile:
+            if self.cprofile is None:
+                self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        start_wall, start_cpu, start_peak = time.perf_counter(), time.process_time(), peak_rss_mb()
+        try:
+            yield counter
+        finally:
+            wall, cpu, peak = time.perf_counter() - start_wall, time.process_time() - start_cpu, peak_rss_mb()
+            if profile:
+                self.cprofile.disable()
+            stack.pop()
+            with self.lock:
+                record = self.stages.setdefault(key, {'calls': 0, 'items': 0, 'wall_s': 0., 'cpu_s': 0.,
+                                                      'peak_rss_mb': None, 'peak_rss_growth_mb': None})
+                record['calls'] += 1
+                record['items'] += counter['items']
+                record['wall_s'] += wall
+                record['cpu_s'] += cpu
+                if peak is not None:
+                    record['peak_rss_mb'] = max(record['peak_rss_mb'] or 0., peak)
+                    record['peak_rss_growth_mb'] = (record['peak_rss_growth_mb'] or 0.) + peak - start_peak
+
+    def report(self):
+
+        """This function prints the recorded stages, in the order they were first run"""
+
+        print('\n{:>24s} {:>7s} {:>9s} {:>9s} {:>9s} {:>10s} {:>12s}'.format(
+            'stage', 'calls', 'items', 'wall s', 'cpu s', 'items/s', 'peak RSS MB'))
+        for key, record in self.stages.items():
+            throughput = record['items'] / record['wall_s'] if record['wall_s'] > 0 else 0.
+            peak = record['peak_rss_mb'] if record['peak_rss_mb'] is not None else float('nan')
+            print('{:>24s} {:7d} {:9d} {:9.3f} {:9.3f} {:10.1f} {:12.1f}'.format(
+                key, record['calls'], record['items'], record['wall_s'], record['cpu_s'], throughput, peak))
+        return self.stages
+
+    def save(self, report_file, **run_info):
+
+        """This function writes the JSON report of the run (command line, machine, run_info and stages), and the
+        cProfile statistics of profile_stage to report_file + '.prof', whose 25 slowest functions are printed"""
+
+        report_dir = os.path.dirname(report_file)
+        if report_dir and not os.path.exists(report_dir):
+            os.makedirs(report_dir)
+
+        report = {
+            'argv': sys.argv,
+            'python': platform.python_version(),
+            'machine': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_s': time.time() - self.started,
+            'peak_rss_mb': peak_rss_mb(),
+            'run': run_info,
+            'stages': self.stages,
+        }
+        if self.cprofile is not None:
+            report['cprofile'] = report_file + '.prof'
+            self.cprofile.dump_stats(report['cprofile'])
+            print('\ncProfile of the {:s} stage:'.format(self.profile_stage))
+            pstats.Stats(self.cprofile).sort_stats('cumulative').print_stats(25)
+
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('\nProfiling report written to {:s}'.format(report_file))
+        return report
+
+
+# Profiler shared by the modules of the repository, the scripts save its report at the end of the run
+PROFILER = Profiler()
+
+
+def stage(name, n_items=0):
+
+    """This function records a stage with the shared profiler"""
+
+    return PROFILER.stage(name, n_items)
+
+
+def report_file(output_dir, prefix='profile'):
+
+    """This function returns a new report file name in output_dir/profiles, one per run"""
+
+    return os.path.join(output_dir, 'profiles', '{:s}_{:s}.json'.format(prefix, time.strftime('%Y%m%d-%H%M%S')))
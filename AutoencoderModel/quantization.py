@@ -0,0 +1,176 @@
+import os
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from image_loading import read_img, IMG_EXTENSIONS
+from retrieval import topk_search, topk_accuracy
+
+
+TFLITE_FILE = "encoder_int8.tflite"
+
+
+def tflite_file(output_dir, pooling='none'):
+
+    """This function returns the int8 TFLite model of an output folder, one per pooling head of the pretrained model"""
+
+    if pooling == 'none':
+        return os.path.join(output_dir, TFLITE_FILE)
+    return os.path.join(output_dir, TFLITE_FILE.replace('.tflite', '_{}.tflite'.format(pooling)))
+
+
+def representative_dataset(data_mapping, img_size, n_samples=200, seed=0):
+
+    """This function returns the calibration data of the int8 quantization: a generator of normalized images
+    drawn at random from a Loader.get_files mapping (usually the training set)"""
+
+    images_paths = [img_path for img_path in data_mapping.keys() if img_path.endswith(IMG_EXTENSIONS)]
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(images_paths), min(n_samples, len(images_paths)), replace=False)
+
+    def generator():
+        for i in sample:
+            img = read_img(images_paths[i], img_size, img_size) / 255
+            yield [img[None].astype(np.float32)]
+
+    return generator
+
+
+def export_tflite_int8(model, data_mapping, img_size, tflite_file, n_samples=200):
+
+    """This function converts a Keras encoder to TFLite with int8 weights and activations, calibrated on
+    n_samples images of data_mapping. Input and output stay float32, so the model is a drop-in replacement"""
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset(data_mapping, img_size, n_samples)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    tflite_model = converter.convert()
+
+    with open(tflite_file, 'wb') as f:
+        f.write(tflite_model)
+    print('Saved {:s} ({:.1f} MB)'.format(tflite_file, len(tflite_model) / 2 ** 20))
+
+
+def load_tflite_encoder(tflite_file, batch_size=32, num_threads=None):
+
+    """This function loads a TFLite encoder and returns a function embedding a batch of normalized images
+    into flattened float32 vectors. The interpreter is resized once to batch_size, the last batch is padded"""
+
+    interpreter = tf.lite.Interpreter(model_path=tflite_file, num_threads=num_threads)
+    input_details = interpreter.get_input_details()[0]
+    input_shape = tuple(int(d) for d in input_details['shape'][1:])
+    interpreter.resize_tensor_input(input_details['index'], (batch_size,) + input_shape)
+    interpreter.allocate_tensors()
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+
+    def embed(X):
+        X = np.asarray(X, dtype=np.float32).reshape((-1,) + input_shape)
+        embeddings = []
+        for start in range(0, len(X), batch_size):
+            batch = X[start:start + batch_size]
+            n = len(batch)
+            if n < batch_size:
+                batch = np.concatenate([batch, np.zeros((batch_size - n,) + input_shape, dtype=np.float32)])
+
+            # Models converted with integer input/output are (de)quantized here
+            if input_details['dtype'] != np.float32:
+                scale, zero_point = input_details['quantization']
+                batch = np.round(batch / scale + zero_point).astype(input_details['dtype'])
+            interpreter.set_tensor(input_details['index'], batch)
+            interpreter.invoke()
+            out = interpreter.get_tensor(output_details['index'])[:n].reshape((n, -1))
+            if output_details['dtype'] != np.float32:
+                scale, zero_point = output_details['quantization']
+                out = (out.astype(np.float32) - zero_point) * scale
+            embeddings.append(out.astype(np.float32))
+        return np.concatenate(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+
+    return embed
+
+
+def retrieval_accuracy(embed, X_query, X_gallery, query_classes, gallery_classes, metric='minkowski', k=10):
+
+    """This function returns the top-1/3/10 accuracy of an embedding function on the query/gallery split
+    and its throughput in images/sec"""
+
+    start = time.perf_counter()
+    E_query = embed(X_query)
+    E_gallery = embed(X_gallery)
+    images_per_sec = (len(X_query) + len(X_gallery)) / (time.perf_counter() - start)
+
+    indices = topk_search(E_query, E_gallery, k=k, metric=metric, p=2.)[1]
+    gallery_matches = gallery_classes[indices]
+    return {n: topk_accuracy(query_classes, gallery_matches, n) for n in [1, 3, 10]}, images_per_sec
+
+
+if __name__ == '__main__':
+
+    from image_loading import Loader
+    from encoders import load_encoder_model
+
+    parser = argparse.ArgumentParser(description='int8 TFLite export of the encoders')
+    parser.add_argument('--data_path',
+                        '-d',
+                        type=str,
+                        default='dataset',
+                        help='Dataset path, with the training and validation folders')
+    parser.add_argument('-img_size',
+                        type=int,
+                        default=324,
+                        help='image size for the model')
+    parser.add_argument('-channels',
+                        type=int,
+                        default=3,
+                        help='number of channels')
+    parser.add_argument('-model',
+                        type=str,
+                        default='convAE',
+                        help='Default model = convAE, other options: pretrained, triplets_loss')
+    parser.add_argument('-pooling',
+                        type=str,
+                        default='none',
+                        help='pooling head of the pretrained model: none (flattened), gap, gem or rmac')
+    parser.add_argument('-n_calibration',
+                        type=int,
+                        default=200,
+                        help='number of training images used to calibrate the quantization')
+    parser.add_argument('-metric',
+                        type=str,
+                        default='minkowski',
+                        help='metric to compute distance query-gallery')
+    parser.add_argument('-workers',
+                        type=int,
+                        default=None,
+                        help='number of threads used to decode the images (default = one per CPU)')
+    args = parser.parse_args()
+
+    shape_img = (args.img_size, args.img_size, args.channels)
+    TrainDir = os.path.join(os.getcwd(), args.data_path, "training")
+    QueryDir = os.path.join(os.getcwd(), args.data_path, "validation", "query")
+    GalleryDir = os.path.join(os.getcwd(), args.data_path, "validation", "gallery")
+    OutputDir = os.path.join(os.getcwd(), "output", args.model)
+    TFLiteFile = tflite_file(OutputDir, args.pooling)
+
+    loader = Loader(args.img_size, args.img_size, args.channels)
+    model, _ = load_encoder_model(args.model, shape_img, OutputDir, args.pooling)
+
+    print("\nQuantizing the encoder")
+    export_tflite_int8(model, loader.get_files(TrainDir), args.img_size, TFLiteFile, args.n_calibration)
+
+    # Accuracy check on the validation split
+    _, _, X_query, query_classes = loader.get_data_array(loader.get_files(QueryDir), args.workers)
+    _, _, X_gallery, gallery_classes = loader.get_data_array(loader.get_files(GalleryDir), args.workers)
+    X_query /= 255
+    X_gallery /= 255
+
+    def embed_float(X):
+        return model.predict(X).reshape((len(X), -1))
+
+    for name, embed in [('float32', embed_float), ('int8', load_tflite_encoder(TFLiteFile))]:
+        accuracy, images_per_sec = retrieval_accuracy(embed, X_query, X_gallery, query_classes, gallery_classes,
+                                                      args.metric)
+        print('\nRESULTS {:s} ({:.1f} images/sec):'.format(name, images_per_sec))
+        for k in [1, 3, 10]:
+            print('>>> Top-{:d} Accuracy: {:.3f}'.format(k, accuracy[k]))
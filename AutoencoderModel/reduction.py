@@ -0,0 +1,201 @@
+import json
+import time
+import numpy as np
+from scipy import sparse
+from retrieval import topk_search, topk_accuracy
+
+
+def randomized_pca(X, rows, n_components, n_oversamples=10, n_iter=4, block_size=4096, seed=0):
+
+    """This function returns the mean, the top singular values and the right singular vectors of the rows of X
+    (centered), with a randomized range finder and n_iter power iterations. X is only read block_size rows at a
+    time and multiplied by thin matrices, so the memory is O((len(rows) + dim) * n_components) instead of the
+    dense SVD of the whole sample, which does not fit in memory for the flattened convolutional features"""
+
+    rng = np.random.default_rng(seed)
+    dim = int(np.prod(X.shape[1:]))
+
+    def block(start):
+        return np.asarray(X[rows[start:start + block_size]], dtype=np.float32).reshape((-1, dim))
+
+    mean = np.zeros(dim, dtype=np.float64)
+    for start in range(0, len(rows), block_size):
+        mean += block(start).sum(axis=0)
+    mean = (mean / len(rows)).astype(np.float32)
+
+    n_vectors = min(n_components + n_oversamples, len(rows), dim)
+    if n_vectors == min(len(rows), dim):
+        # Small problem, the dense SVD is exact and not larger than the sketch
+        _, S, Vt = np.linalg.svd(np.concatenate([block(start) - mean for start in range(0, len(rows), block_size)]),
+                                 full_matrices=False)
+        return mean, S[:n_components], Vt[:n_components]
+
+    def right(M):
+        # (X - mean) @ M, one row per sample
+        return np.concatenate([(block(start) - mean) @ M for start in range(0, len(rows), block_size)])
+
+    def left(M):
+        # (X - mean).T @ M, one row per dimension
+        out = np.zeros((dim, M.shape[1]), dtype=np.float32)
+        for start in range(0, len(rows), block_size):
+            out += (block(start) - mean).T @ M[start:start + block_size]
+        return out
+
+    Q = np.linalg.qr(right(rng.standard_normal((dim, n_vectors), dtype=np.float32)))[0]
+    for _ in range(n_iter):
+        Q = np.linalg.qr(right(np.linalg.qr(left(Q))[0]))[0]
+    # SVD of the small projection Q.T @ (X - mean), of shape (n_vectors, dim)
+    _, S, Vt = np.linalg.svd(left(Q).T, full_matrices=False)
+    return mean, S[:n_components], Vt[:n_components]
+
+
+class Reducer:
+
+    """This class reduces the dimension of the embeddings before the search: PCA (optionally whitened) or a
+    sparse random projection, optionally followed by an L2 normalization. It is fitted once on the gallery
+    embeddings and saved, so queries and gallery are always projected with the same matrix"""
+
+    def __init__(self, method='pca', n_components=256, whiten=True, l2_normalize=True, seed=0):
+
+        assert method in ('pca', 'random'), 'The reduction is pca or random (sparse random projection)'
+        self.method = method
+        self.n_components = n_components
+        self.whiten = whiten
+        self.l2_normalize = l2_normalize
+        self.seed = seed
+        self.dim = None
+        self.mean = None
+        self.components = None
+        self.scale = None
+        # What the reduction was fitted on, checked by RetrievalPipeline before reusing it
+        self.meta = dict()
+
+    def fit(self, X, max_train=20000):
+
+        """This function fits the projection on (a random sample of) the embeddings X"""
+
+        rng = np.random.default_rng(self.seed)
+        self.dim = int(np.prod(X.shape[1:]))
+
+        if self.method == 'random':
+            # Sparse random projection: entries +-sqrt(s / n_components) with probability 1 / s, s = sqrt(dim)
+            s = np.sqrt(self.dim)
+            n_nonzero = rng.binomial(self.dim * self.n_components, 1 / s)
+            flat = np.unique(rng.integers(0, self.dim * self.n_components, n_nonzero))
+            values = np.where(rng.random(len(flat)) < 0.5, -1, 1) * np.sqrt(s / self.n_components)
+            self.components = sparse.csr_matrix((values.astype(np.float32), (flat // self.n_components,
+                                                 flat % self.n_components)), shape=(self.dim, self.n_components))
+            return self
+
+        sample = np.arange(len(X)) if len(X) <= max_train else np.sort(rng.choice(len(X), max_train, replace=False))
+        # The components are the right singular vectors of the centered sample
+        self.mean, S, Vt = randomized_pca(X, sample, self.n_components, seed=self.seed)
+        n_components = len(S)
+        self.components = np.ascontiguousarray(Vt.T)
+        variance = S ** 2 / max(len(sample) - 1, 1)
+        self.scale = 1 / np.sqrt(variance + 1e-8) if self.whiten else np.ones(n_components, dtype=np.float32)
+        self.scale = self.scale.astype(np.float32)
+        return self
+
+    def transform(self, X, block_size=4096):
+
+        """This function projects the embeddings X, one block of rows at a time (X can be memory-mapped)"""
+
+        out = np.empty((len(X), self.components.shape[1]), dtype=np.float32)
+        for start in range(0, len(X), block_size):
+            block = np.asarray(X[start:start + block_size], dtype=np.float32).reshape((-1, self.dim))
+            if self.method == 'random':
+                reduced = np.asarray(self.components.T.dot(block.T)).T
+            else:
+                reduced = (block - self.mean) @ self.components * self.scale
+            if self.l2_normalize:
+                norms = np.linalg.norm(reduced, axis=1, keepdims=True)
+                norms[norms == 0] = 1
+                reduced /= norms
+            out[start:start + block_size] = reduced
+        return out
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
+
+    def save(self, reducer_file):
+
+        """This function writes the fitted reduction to a .npz file"""
+
+        state = dict(method=self.method, n_components=self.n_components, whiten=self.whiten,
+                     l2_normalize=self.l2_normalize, seed=self.seed, dim=self.dim, meta=json.dumps(self.meta))
+        if self.method == 'random':
+            coo = self.components.tocoo()
+            state.update(rows=coo.row, cols=coo.col, values=coo.data)
+        else:
+            state.update(mean=self.mean, components=self.components, scale=self.scale)
+        np.savez(reducer_file, **state)
+
+    @classmethod
+    def load(cls, reducer_file):
+
+        """This function reads a reduction written by save"""
+
+        saved = np.load(reducer_file)
+        reducer = cls(str(saved['method']), int(saved['n_components']), bool(saved['whiten']),
+                      bool(saved['l2_normalize']), int(saved['seed']))
+        reducer.dim = int(saved['dim'])
+        reducer.meta = json.loads(str(saved['meta'])) if 'meta' in saved.files else dict()
+        if reducer.method == 'random':
+            reducer.components = sparse.csr_matrix((saved['values'], (saved['rows'], saved['cols'])),
+                                                   shape=(reducer.dim, reducer.n_components))
+        else:
+            reducer.mean = saved['mean']
+            reducer.components = saved['components']
+            reducer.scale = saved['scale']
+        return reducer
+
+
+def reduction_sweep(E_query, E_gallery, query_classes, gallery_classes, methods=('pca', 'random'),
+                    dims=(32, 64, 128, 256, 512), metric='minkowski', whiten=True, l2_normalize=True, k=10):
+
+    """This function prints, for every method and dimension, the top-1/3/10 accuracy and the search latency
+    of the reduced embeddings, next to the full embeddings"""
+
+    def evaluate(Q, G):
+        start = time.perf_counter()
+        indices = topk_search(Q, G, k=k, metric=metric, p=2.)[1]
+        ms_query = 1000 * (time.perf_counter() - start) / len(Q)
+        gallery_matches = gallery_classes[indices]
+        return [topk_accuracy(query_classes, gallery_matches, n) for n in [1, 3, 10]], ms_query
+
+    full_dim = int(np.prod(E_gallery.shape[1:]))
+    print('\n  method      dim    top-1    top-3   top-10   ms/query')
+    accuracy, ms_query = evaluate(E_query.reshape((len(E_query), -1)), E_gallery.reshape((len(E_gallery), -1)))
+    print('{:>8s} {:8d} {:8.3f} {:8.3f} {:8.3f} {:10.3f}'.format('none', full_dim, *accuracy, ms_query))
+    results = [('none', full_dim, accuracy, ms_query)]
+
+    for method in methods:
+        for dim in dims:
+            if dim >= full_dim or (method == 'pca' and dim > len(E_gallery)):
+                continue
+            reducer = Reducer(method, dim, whiten, l2_normalize).fit(E_gallery)
+            accuracy, ms_query = evaluate(reducer.transform(E_query), reducer.transform(E_gallery))
+            print('{:>8s} {:8d} {:8.3f} {:8.3f} {:8.3f} {:10.3f}'.format(method, dim, *accuracy, ms_query))
+            results.append((method, dim, accuracy, ms_query))
+    return results
+
+
+if __name__ == '__main__':
+
+    from validation import validation_parser, validation_embeddings
+
+    parser = validation_parser('Dimension vs accuracy vs latency of the reduced embeddings')
+    parser.add_argument('-whiten',
+                        type=str,
+                        default='True',
+                        help='Whiten the PCA components (default = True)')
+    parser.add_argument('-l2',
+                        type=str,
+                        default='True',
+                        help='L2-normalize the reduced embeddings (default = True)')
+    args = parser.parse_args()
+
+    E_query, E_gallery, query_classes, gallery_classes = validation_embeddings(args)
+    reduction_sweep(E_query, E_gallery, query_classes, gallery_classes, metric=args.metric,
+                    whiten=args.whiten == 'True', l2_normalize=args.l2 == 'True')
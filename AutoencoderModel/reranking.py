@@ -0,0 +1,139 @@
+import time
+import numpy as np
+from retrieval import topk_search, topk_accuracy
+
+
+def gather_normalized(E, indices):
+
+    """This function returns the L2-normalized rows of E at indices (any shape), -1 entries give zero vectors"""
+
+    flat = indices.reshape(-1)
+    X = np.asarray(E[np.maximum(flat, 0)], dtype=np.float32).reshape((len(flat), -1))
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    X /= norms
+    X[flat < 0] = 0
+    return X.reshape(indices.shape + (X.shape[1],))
+
+
+def query_expansion(E_query, E_gallery, indices, n_expand=5, query_block=64):
+
+    """This function re-ranks the shortlist of every query (indices, sorted by the first-stage distance) with
+    average query expansion: the query is replaced by the mean of itself and of its n_expand first matches,
+    and only the shortlist is scored again with the cosine similarity"""
+
+    reranked = np.empty_like(indices)
+    for start in range(0, len(indices), query_block):
+        idx = indices[start:start + query_block]
+        valid = idx >= 0
+        G = gather_normalized(E_gallery, idx)
+        q = gather_normalized(E_query, np.arange(start, start + len(idx)))
+
+        expanded = q + G[:, :n_expand].sum(axis=1)
+        expanded /= np.maximum(np.linalg.norm(expanded, axis=1, keepdims=True), 1e-12)
+        similarity = np.einsum('bnd,bd->bn', G, expanded)
+        similarity[~valid] = -np.inf
+
+        order = np.argsort(-similarity, axis=1, kind='stable')
+        reranked[start:start + len(idx)] = np.take_along_axis(idx, order, axis=1)
+    return reranked
+
+
+def k_reciprocal(E_query, E_gallery, indices, k1=20, k2=6, lambda_value=0.3, query_block=64, max_block_size=2 ** 24):
+
+    """This function re-ranks the shortlist of every query with k-reciprocal encoding (Zhong et al., 2017)
+    computed among the query and its N shortlisted images only, so the cost grows with N and not with the
+    gallery: two images are k-reciprocal neighbours if each one is in the k1 nearest neighbours of the other,
+    every image is encoded by the Gaussian-weighted set of its k-reciprocal neighbours (averaged over its k2
+    nearest neighbours) and the final distance mixes the Jaccard distance of these sets and the original one.
+    Every block of queries holds a few (query_block, N + 1, N + 1) float32 arrays, query_block is lowered so that
+    they have at most max_block_size entries (64 MB each by default) whatever the shortlist length"""
+
+    N = indices.shape[1]
+    query_block = max(1, min(query_block, max_block_size // (N + 1) ** 2))
+    reranked = np.empty_like(indices)
+    for start in range(0, len(indices), query_block):
+        idx = indices[start:start + query_block]
+        B, N = idx.shape
+        valid = idx >= 0
+
+        # Distances among the query (position 0) and its shortlist, normalized by the largest of every row
+        X = np.concatenate([gather_normalized(E_query, np.arange(start, start + B))[:, None],
+                            gather_normalized(E_gallery, idx)], axis=1)
+        D = np.sqrt(np.maximum(2 - 2 * np.einsum('bid,bjd->bij', X, X), 0))
+        invalid = np.concatenate([np.zeros((B, 1), dtype=bool), ~valid], axis=1)
+        D[invalid[:, :, None] | invalid[:, None, :]] = 4
+        D /= np.maximum(D.max(axis=2, keepdims=True), 1e-12)
+
+        # k-reciprocal neighbours
+        knn = np.argsort(D, axis=2, kind='stable')[:, :, :min(k1, N) + 1]
+        is_knn = np.zeros(D.shape, dtype=bool)
+        np.put_along_axis(is_knn, knn, True, axis=2)
+        reciprocal = is_knn & is_knn.transpose(0, 2, 1)
+
+        V = np.where(reciprocal, np.exp(-D), np.float32(0)).astype(np.float32)
+        V /= np.maximum(V.sum(axis=2, keepdims=True), 1e-12)
+        if k2 > 1:
+            # Mean over the k2 nearest neighbours, one neighbour at a time to stay at (B, N + 1, N + 1)
+            rows = np.arange(B)[:, None]
+            expanded = np.zeros_like(V)
+            for j in range(min(k2, knn.shape[2])):
+                expanded += V[rows, knn[:, :, j]]
+            V = expanded / min(k2, knn.shape[2])
+
+        # Jaccard distance between the query and every shortlisted image, the rows of V sum to 1
+        overlap = np.minimum(V[:, :1, :], V[:, 1:, :]).sum(axis=2)
+        jaccard = 1 - overlap / (2 - overlap)
+        final = (1 - lambda_value) * jaccard + lambda_value * D[:, 0, 1:]
+        final[~valid] = np.inf
+
+        order = np.argsort(final, axis=1, kind='stable')
+        reranked[start:start + B] = np.take_along_axis(idx, order, axis=1)
+    return reranked
+
+
+def rerank(E_query, E_gallery, indices, method='kreciprocal', **kwargs):
+
+    """This function re-ranks the shortlists with query expansion (qe) or k-reciprocal encoding (kreciprocal)"""
+
+    if method == 'qe':
+        return query_expansion(E_query, E_gallery, indices, **kwargs)
+    if method == 'kreciprocal':
+        return k_reciprocal(E_query, E_gallery, indices, **kwargs)
+    return indices
+
+
+def rerank_report(E_query, E_gallery, query_classes, gallery_classes, shortlist=100, metric='cosine'):
+
+    """This function prints the top-1/3/10 accuracy and the re-ranking time per query of the first-stage
+    order, of query expansion and of k-reciprocal re-ranking of the shortlist"""
+
+    indices = topk_search(E_query, E_gallery, k=shortlist, metric=metric, p=2.)[1]
+
+    print('\n      re-ranking    top-1    top-3   top-10   ms/query')
+    results = []
+    for method in ['none', 'qe', 'kreciprocal']:
+        start = time.perf_counter()
+        reranked = rerank(E_query, E_gallery, indices, method)
+        ms_query = 1000 * (time.perf_counter() - start) / len(E_query)
+        gallery_matches = gallery_classes[reranked]
+        accuracy = [topk_accuracy(query_classes, gallery_matches, k) for k in [1, 3, 10]]
+        print('{:>16s} {:8.3f} {:8.3f} {:8.3f} {:10.3f}'.format(method, *accuracy, ms_query))
+        results.append((method, accuracy, ms_query))
+    return results
+
+
+if __name__ == '__main__':
+
+    from validation import validation_parser, validation_embeddings
+
+    parser = validation_parser('Accuracy of the re-ranking of the shortlist', metric='cosine',
+                               metric_help='metric of the first-stage search')
+    parser.add_argument('-rerank_n',
+                        type=int,
+                        default=100,
+                        help='number of first-stage matches re-ranked')
+    args = parser.parse_args()
+
+    E_query, E_gallery, query_classes, gallery_classes = validation_embeddings(args)
+    rerank_report(E_query, E_gallery, query_classes, gallery_classes, args.rerank_n, args.metric)
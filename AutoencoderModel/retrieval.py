@@ -0,0 +1,96 @@
+import numpy as np
+from scipy import spatial
+from profiling import stage
+
+
+def topk_accuracy(gt_label, matched_label, k=1):
+
+    """This function returns the fraction of queries with the right class among the first k matches"""
+
+    matched_label = matched_label[:, :k]
+    total = matched_label.shape[0]
+    correct = 0
+    for q_idx, q_lbl in enumerate(gt_label):
+        correct += np.any(q_lbl == matched_label[q_idx, :]).item()
+    acc_tmp = correct/total
+    return acc_tmp
+
+
+def squared_norms(E, block_size=4096):
+
+    """This function returns the squared L2 norm of every row, reading E one block at a time"""
+
+    norms = np.empty(len(E), dtype=np.float32)
+    for start in range(0, len(E), block_size):
+        block = np.asarray(E[start:start + block_size], dtype=np.float32)
+        norms[start:start + block_size] = np.einsum('ij,ij->i', block, block)
+    return norms
+
+
+def block_distances(Q, G, metric='minkowski', p=2., Q_norms=None, G_norms=None):
+
+    """This function returns the (len(Q), len(G)) distance matrix of one query block and one gallery block.
+    Euclidean and cosine distances use the matrix multiplication formulation, other metrics go through cdist"""
+
+    if metric == 'euclidean' or metric == 'sqeuclidean' or (metric == 'minkowski' and p == 2):
+        dist = Q @ G.T
+        dist *= -2
+        dist += Q_norms[:, None]
+        dist += G_norms[None, :]
+        np.maximum(dist, 0, out=dist)
+        if metric != 'sqeuclidean':
+            np.sqrt(dist, out=dist)
+        return dist
+
+    if metric == 'cosine':
+        dist = Q @ G.T
+        q_len = np.sqrt(Q_norms)
+        g_len = np.sqrt(G_norms)
+        q_len[q_len == 0] = 1
+        g_len[g_len == 0] = 1
+        dist /= q_len[:, None]
+        dist /= g_len[None, :]
+        return 1 - dist
+
+    if metric == 'minkowski':
+        return spatial.distance.cdist(Q, G, metric, p=p)
+    return spatial.distance.cdist(Q, G, metric)
+
+
+def topk_search(E_query, E_gallery, k=10, metric='minkowski', p=2., query_block=256, gallery_block=4096):
+
+    """This function returns the distances and indices of the k nearest gallery embeddings of every query,
+    sorted by increasing distance. The distances are computed one (query_block, gallery_block) tile at a
+    time and only the running top-k is kept, with argpartition instead of a full argsort"""
+
+    n_query, n_gallery = len(E_query), len(E_gallery)
+    k = min(k, n_gallery)
+
+    with stage('search', n_query):
+        G_norms = squared_norms(E_gallery, gallery_block)
+        top_dist = np.full((n_query, k), np.inf, dtype=np.float32)
+        top_indx = np.zeros((n_query, k), dtype=np.int64)
+
+        for q_start in range(0, n_query, query_block):
+            Q = np.asarray(E_query[q_start:q_start + query_block], dtype=np.float32)
+            Q_norms = np.einsum('ij,ij->i', Q, Q)
+            best_dist = top_dist[q_start:q_start + query_block]
+            best_indx = top_indx[q_start:q_start + query_block]
+
+            for g_start in range(0, n_gallery, gallery_block):
+                G = np.asarray(E_gallery[g_start:g_start + gallery_block], dtype=np.float32)
+                with stage('distances', len(Q) * len(G)):
+                    dist = block_distances(Q, G, metric, p, Q_norms, G_norms[g_start:g_start + gallery_block])
+
+                # Merge the running top-k with the new block and keep the k smallest
+                with stage('topk', len(Q)):
+                    cand_dist = np.concatenate([best_dist, dist], axis=1)
+                    cand_indx = np.concatenate([best_indx, np.broadcast_to(np.arange(g_start, g_start + G.shape[0]),
+                                                                           dist.shape)], axis=1)
+                    part = np.argpartition(cand_dist, k - 1, axis=1)[:, :k]
+                    best_dist[:] = np.take_along_axis(cand_dist, part, axis=1)
+                    best_indx[:] = np.take_along_axis(cand_indx, part, axis=1)
+
+        with stage('topk', n_query):
+            order = np.argsort(top_dist, axis=1, kind='stable')
+    return np.take_along_axis(top_dist, order, axis=1), np.take_along_axis(top_indx, order, axis=1)
@@ -0,0 +1,241 @@
+import io
+import os
+import json
+import argparse
+import threading
+import numpy as np
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from image_loading import Loader, read_img, list_imgs_no_subfolders
+from embedding_cache import EmbeddingCache, embed_with_cache
+from embedding_store import load_embedding_matrix, store_exists, store_mismatch
+from encoders import load_encoder
+from final_display import create_results_dict
+from indexes import INDEX_FILES, load_index, index_meta, meta_mismatch, index_search_fn
+from batching import MicroBatcher
+
+
+class RetrievalService:
+
+    """This class keeps the model and the gallery index in memory and answers the queries,
+    the results have the same structure as the dictionary built by create_results_dict"""
+
+    def __init__(self, embed_fn, search_fn, gallery_names, k=10, batcher=None):
+
+        self.embed_fn = embed_fn
+        self.search_fn = search_fn
+        self.gallery_names = gallery_names
+        self.k = k
+        self.batcher = batcher
+        self.lock = threading.Lock()
+
+    def query(self, imgs, query_names):
+
+        """This function returns the names of the k closest gallery images of every query image"""
+
+        X = np.asarray(imgs, dtype=np.float32) / 255
+        if self.batcher is not None:
+            # Concurrent queries are embedded together by the micro-batcher
+            E_query = np.stack([self.batcher.submit_threadsafe(x) for x in X])
+        else:
+            with self.lock:
+                E_query = self.embed_fn(X)
+        indices = self.search_fn(E_query, self.k)
+
+        results = dict()
+        for query_name, indx in zip(query_names, indices):
+            create_results_dict(results, query_name, [self.gallery_names[idx] for idx in indx if idx >= 0])
+        return results
+
+
+def make_search_fn(distance, E_gallery, gallery_paths, output_dir, metric='minkowski', nprobe=8, ef=50, shortlist=100,
+                   fingerprint=None):
+
+    """This function returns a function searching the k nearest gallery rows of a batch of query embeddings,
+    the ivfpq, hnsw and hamming indexes are the ones saved in the output folder by main.test.py or pipeline.py,
+    an index built from another model or gallery is refused"""
+
+    index = None
+    if distance in INDEX_FILES:
+        index = load_index(distance, output_dir)
+        meta = index_meta(E_gallery, gallery_paths, fingerprint)
+        if distance == 'hnsw':
+            # The graph is updated with the gallery by gallery_manager.py, its labels are matched to the paths
+            del meta['paths']
+        mismatch = meta_mismatch(index, meta)
+        # The queries are not reduced here, an index of reduced embeddings is refused
+        assert 'reduce' not in mismatch, 'The saved {} index was built on embeddings reduced with {}, the server ' \
+                                         'does not reduce the queries: rebuild it without -reduce'.format(
+                                             distance, index.meta.get('reduce'))
+        assert not mismatch, 'The saved {} index was not built from this model and gallery ({}): rebuild it with ' \
+                             'pipeline.py -distance {} -rebuild_index True'.format(distance, ', '.join(mismatch),
+                                                                                   distance)
+    return index_search_fn(distance, index, E_gallery, gallery_paths, metric, nprobe, ef, shortlist)
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    """POST /query?name=<query name> with the image file as body, GET /health and GET /metrics"""
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        service = self.server.service
+        if path == '/health':
+            return self.send_json(200, {'status': 'ok', 'gallery': len(service.gallery_names)})
+        if path == '/metrics':
+            return self.send_json(200, {} if service.batcher is None else service.batcher.metrics())
+        self.send_json(404, {'error': 'unknown path'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/query':
+            return self.send_json(404, {'error': 'unknown path'})
+
+        query_name = parse_qs(url.query).get('name', ['query'])[0]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            img = read_img(io.BytesIO(body), self.server.img_size, self.server.img_size)
+        except Exception as e:
+            return self.send_json(400, {'error': 'cannot read the image: {}'.format(e)})
+
+        try:
+            results = self.server.service.query([img], [query_name])
+        except Exception as e:
+            # Errors of the micro-batcher, the encoder or the search, the server keeps serving
+            return self.send_json(500, {'error': 'the query failed: {}'.format(e)})
+        self.send_json(200, results)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Retrieval server')
+    parser.add_argument('--data_path',
+                        '-d',
+                        type=str,
+                        default='dataset_test',
+                        help='Dataset path, the gallery folder inside it is searched')
+    parser.add_argument('-img_size',
+                        type=int,
+                        default=324,
+                        help='image size for the model')
+    parser.add_argument('-channels',
+                        type=int,
+                        default=3,
+                        help='number of channels')
+    parser.add_argument('-model',
+                        type=str,
+                        default='convAE',
+                        help='Default model = convAE, other options: pretrained, triplets_loss')
+    parser.add_argument('-metric',
+                        type=str,
+                        default='minkowski',
+                        help='metric to compute distance query-gallery')
+    parser.add_argument('-distance',
+                        type=str,
+                        default='knn',
+                        help='knn, pairwise, ivfpq, hnsw or hamming distance between query and gallery')
+    parser.add_argument('-k',
+                        type=int,
+                        default=10,
+                        help='number of gallery images returned per query')
+    parser.add_argument('-nprobe',
+                        type=int,
+                        default=8,
+                        help='number of inverted lists scanned per query by the ivfpq index')
+    parser.add_argument('-ef',
+                        type=int,
+                        default=50,
+                        help='size of the candidate list of the hnsw search')
+    parser.add_argument('-shortlist',
+                        type=int,
+                        default=100,
+                        help='number of gallery images re-ranked after the hamming search')
+    parser.add_argument('-store',
+                        type=str,
+                        default=None,
+                        help='Path of a gallery embedding store to use instead of the gallery folder')
+    parser.add_argument('-cache',
+                        type=str,
+                        default='True',
+                        help='Reuse the gallery embeddings cached on disk (default = True)')
+    parser.add_argument('-workers',
+                        type=int,
+                        default=None,
+                        help='number of threads used to decode the images (default = one per CPU)')
+    parser.add_argument('-batching',
+                        type=str,
+                        default='True',
+                        help='Embed concurrent queries together in micro-batches (default = True)')
+    parser.add_argument('-max_batch_size',
+                        type=int,
+                        default=32,
+                        help='maximum number of queries embedded in one micro-batch')
+    parser.add_argument('-max_wait_ms',
+                        type=float,
+                        default=5.,
+                        help='maximum time a query waits for other queries to fill its micro-batch')
+    parser.add_argument('-precision',
+                        type=str,
+                        default='float32',
+                        help='inference precision: float32, mixed_bfloat16, mixed_float16 or int8 (TFLite)')
+    parser.add_argument('-jit',
+                        type=str,
+                        default='False',
+                        help='Compile the encoder with XLA (default = False)')
+    parser.add_argument('-pooling',
+                        type=str,
+                        default='none',
+                        help='pooling head of the pretrained model: none (flattened), gap, gem or rmac')
+    parser.add_argument('-host',
+                        type=str,
+                        default='127.0.0.1',
+                        help='address the server listens on')
+    parser.add_argument('-port',
+                        type=int,
+                        default=8000,
+                        help='port the server listens on')
+    args = parser.parse_args()
+
+    shape_img = (args.img_size, args.img_size, args.channels)
+    GalleryDir = os.path.join(os.getcwd(), args.data_path, "gallery")
+    OutputDir = os.path.join(os.getcwd(), "output", args.model)
+    CacheDir = os.path.join(OutputDir, "embedding_cache")
+
+    # The model and the gallery embeddings are loaded once for the whole life of the server
+    embed, fingerprint = load_encoder(args.model, shape_img, OutputDir, args.precision, args.jit == 'True',
+                                     args.pooling)
+
+    GalleryPaths = list_imgs_no_subfolders(GalleryDir)
+    if args.store is not None and store_exists(args.store):
+        mismatch = store_mismatch(args.store, fingerprint, GalleryPaths)
+        assert not mismatch, 'The store {} was not built from this model and gallery ({}): build it again with ' \
+                             'pipeline.py -store {}'.format(args.store, ', '.join(mismatch), args.store)
+        E_gallery, GalleryName, GalleryPaths, _ = load_embedding_matrix(args.store)
+    else:
+        loader = Loader(args.img_size, args.img_size, args.channels)
+        GalleryName = [os.path.split(img_path)[1] for img_path in GalleryPaths]
+        cache = EmbeddingCache(CacheDir, fingerprint) if args.cache == 'True' else None
+        E_gallery = embed_with_cache(GalleryPaths, lambda paths: embed(loader.read_images(paths, args.workers) / 255),
+                                     cache)
+
+    search_fn = make_search_fn(args.distance, E_gallery, GalleryPaths, OutputDir, args.metric, args.nprobe, args.ef,
+                               args.shortlist, fingerprint)
+
+    batcher = None
+    if args.batching == 'True':
+        batcher = MicroBatcher(embed, args.max_batch_size, args.max_wait_ms)
+        batcher.start_in_thread()
+
+    server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+    server.service = RetrievalService(embed, search_fn, GalleryName, args.k, batcher)
+    server.img_size = args.img_size
+    print('\nServing {:d} gallery images on http://{:s}:{:d}/query'.format(len(GalleryName), args.host, args.port))
+    server.serve_forever()
@@ -0,0 +1,192 @@
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+INDEX_FILE = "index.json"
+# Index of the shards being written, renamed to INDEX_FILE once they are all written
+PENDING_FILE = "index.pending.json"
+
+
+def shards_index(loader, data_mapping, shard_size=1024):
+
+    """This function returns the index of the shards of a Loader.get_files mapping: image size, shards (file and
+    number of images), names, paths, classes and the (size, mtime) of every image"""
+
+    images_names, images_paths, classes = loader.get_data_names(data_mapping)
+    stats = [os.stat(img_path) for img_path in images_paths]
+    return {
+        'img_size': [loader.img_length, loader.img_height],
+        'shards': [{'file': "shard_{:05d}.npy".format(shard_id), 'count': len(images_paths[start:start + shard_size])}
+                   for shard_id, start in enumerate(range(0, len(images_paths), shard_size))],
+        'names': images_names,
+        'paths': images_paths,
+        'classes': classes.tolist(),
+        'files': [[stat.st_size, stat.st_mtime_ns] for stat in stats],
+    }
+
+
+def read_index(shard_dir, index_file=INDEX_FILE):
+
+    """This function returns the saved index of a shard directory, None if there is none"""
+
+    index_path = os.path.join(shard_dir, index_file)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def same_images(saved, index):
+
+    """This function checks whether two shard indexes hold the same images (paths, classes, and size and mtime of
+    the files, so an image overwritten in place is decoded again) at the same image size"""
+
+    return all(saved.get(key) == index[key] for key in ('img_size', 'paths', 'classes', 'files'))
+
+
+def write_shards(loader, data_mapping, shard_dir, shard_size=1024, n_workers=None):
+
+    """This function decodes and resizes once the images of a Loader.get_files mapping and writes them as uint8
+    (N, H, W, 3) .npy shards of shard_size images, with an index.json (image size, shards, names, paths, classes).
+    Shards already written for the same images are skipped, so an interrupted run can be started again, the
+    shards of other images, image size or shard size are removed first"""
+
+    index = shards_index(loader, data_mapping, shard_size)
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    saved = read_index(shard_dir) or read_index(shard_dir, PENDING_FILE)
+    if saved is not None and not (same_images(saved, index) and saved['shards'] == index['shards']):
+        print('Removing the shards of other images from {:s}'.format(shard_dir))
+        with os.scandir(shard_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('shard_') or entry.name == INDEX_FILE:
+                    os.remove(entry.path)
+    with open(os.path.join(shard_dir, PENDING_FILE), 'w') as f:
+        json.dump(index, f)
+
+    with ThreadPoolExecutor(n_workers) as pool:
+        for shard_id, shard in enumerate(index['shards']):
+            start = shard_id * shard_size
+            shard_paths = index['paths'][start:start + shard_size]
+            shard_path = os.path.join(shard_dir, shard['file'])
+            if os.path.exists(shard_path):
+                continue
+            imgs = loader.read_images(shard_paths, pool=pool, dtype=np.uint8)
+            tmp_path = shard_path + '.tmp.npy'
+            np.save(tmp_path, imgs)
+            os.replace(tmp_path, shard_path)
+            print('Written {:s} ({:d} images)'.format(shard['file'], len(shard_paths)))
+
+    os.replace(os.path.join(shard_dir, PENDING_FILE), os.path.join(shard_dir, INDEX_FILE))
+    print('\nWritten {:d} images in {:d} shards to {:s}'.format(len(index['paths']), len(index['shards']), shard_dir))
+
+
+def shards_exist(shard_dir, loader=None, data_mapping=None):
+
+    """This function checks whether a shard directory has been completely written and, with a loader and a
+    Loader.get_files mapping, whether it holds the images of the mapping at the image size of the loader"""
+
+    saved = read_index(shard_dir)
+    if saved is None or data_mapping is None:
+        return saved is not None
+    return same_images(saved, shards_index(loader, data_mapping))
+
+
+class ShardedImages:
+
+    """This class reads the images written by write_shards. The shards are memory-mapped, so opening them is
+    instant and only the indexed images are read from disk; images are normalized to float32 when indexed.
+    It can be indexed like an (N, H, W, 3) array with an int, a slice or an array of indices"""
+
+    def __init__(self, shard_dir):
+
+        with open(os.path.join(shard_dir, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.names = index['names']
+        self.paths = index['paths']
+        self.classes = np.array(index['classes'])
+        self.shards = [np.load(os.path.join(shard_dir, shard['file']), mmap_mode='r') for shard in index['shards']]
+        self.offsets = np.cumsum([0] + [shard['count'] for shard in index['shards']])
+        self.shape = (int(self.offsets[-1]), index['img_size'][0], index['img_size'][1], 3)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def raw(self, indices):
+
+        """This function returns the uint8 images at indices, read shard by shard"""
+
+        # Copied, the negative indices are wrapped in place
+        indices = np.array(indices, dtype=np.int64, copy=True)
+        indices[indices < 0] += len(self)
+        out = np.empty((len(indices),) + self.shape[1:], dtype=np.uint8)
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        for shard_id in np.unique(shard_ids):
+            rows = np.flatnonzero(shard_ids == shard_id)
+            # Sorted reads from the memory map, then back to the requested order
+            local = indices[rows] - self.offsets[shard_id]
+            order = np.argsort(local, kind='stable')
+            out[rows[order]] = self.shards[shard_id][local[order]]
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.raw([key])[0].astype(np.float32) / 255
+        if isinstance(key, slice):
+            key = np.arange(len(self))[key]
+        return self.raw(key).astype(np.float32) / 255
+
+    def batches(self, batch_size, shuffle=False, seed=None):
+
+        """This function yields the normalized images and their classes batch by batch, for one epoch"""
+
+        order = np.random.default_rng(seed).permutation(len(self)) if shuffle else np.arange(len(self))
+        for start in range(0, len(self), batch_size):
+            indices = np.sort(order[start:start + batch_size])
+            yield self[indices], self.classes[indices]
+
+
+if __name__ == '__main__':
+
+    from image_loading import Loader
+
+    parser = argparse.ArgumentParser(description='Preprocess a dataset folder into uint8 image shards')
+    parser.add_argument('--data_path',
+                        '-d',
+                        type=str,
+                        default='dataset/training',
+                        help='folder with one subfolder per class')
+    parser.add_argument('-out',
+                        type=str,
+                        default=None,
+                        help='shard directory (default = output/shards/<folder name>_<img_size>)')
+    parser.add_argument('-img_size',
+                        type=int,
+                        default=324,
+                        help='image size for the model')
+    parser.add_argument('-channels',
+                        type=int,
+                        default=3,
+                        help='number of channels')
+    parser.add_argument('-shard_size',
+                        type=int,
+                        default=1024,
+                        help='number of images per shard')
+    parser.add_argument('-workers',
+                        type=int,
+                        default=None,
+                        help='number of threads used to decode the images (default = one per CPU)')
+    args = parser.parse_args()
+
+    DataDir = os.path.join(os.getcwd(), args.data_path)
+    ShardDir = args.out
+    if ShardDir is None:
+        ShardDir = os.path.join(os.getcwd(), "output", "shards",
+                                "{}_{}".format(os.path.basename(os.path.normpath(DataDir)), args.img_size))
+
+    loader = Loader(args.img_size, args.img_size, args.channels)
+    write_shards(loader, loader.get_files(DataDir), ShardDir, args.shard_size, args.workers)
@@ -2,13 +2,23 @@ from tensorflow.keras.preprocessing.image import ImageDataGenerator
 import matplotlib.pyplot as plt
 import numpy as np
 from skimage.transform import resize
+from profiling import stage
 
 
 def normalize_img(imgs):
 
     """ Normalize images """
 
-    transformed_images = [img/255 for img in imgs]
+    with stage('normalize', len(imgs)):
+        # Float arrays coming from Loader.get_data_array are normalized in place to avoid another copy,
+        # integer arrays (uint8 images or shards) are converted
+        if isinstance(imgs, np.ndarray):
+            if not np.issubdtype(imgs.dtype, np.floating):
+                return imgs.astype(np.float32) / 255
+            imgs /= 255
+            return imgs
+
+        transformed_images = [img/255 for img in imgs]
     return transformed_images
 
 
@@ -19,10 +29,10 @@ def random_crop(img):
     # Note: image_data_format is 'channel_last'
     assert img.shape[2] == 3
     height, width = img.shape[0], img.shape[1]  # for us it is the one set in the loader (eg: 324)
-    dy, dx = 224, 224  # img will be reduced at most to this size (eg: 224)
+    dy, dx = round(height * 224 / 324), round(width * 224 / 324)  # img will be reduced at most to this size (eg: 224)
     x = np.random.randint(0, width - dx + 1)
     y = np.random.randint(0, height - dy + 1)
-    return resize(img[y:(y+dy), x:(x+dx), :], (324, 324, 3), anti_aliasing=True, preserve_range=True)
+    return resize(img[y:(y+dy), x:(x+dx), :], (height, width, 3), anti_aliasing=True, preserve_range=True)
 
 
 def data_augmentation(train_set, batch_size):
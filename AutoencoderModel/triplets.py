@@ -1,58 +1,110 @@
+import tensorflow as tf
 from tensorflow.keras import backend as K
 import random
 from transform import *
+from batch_augmentation import BatchAugmenter
 
 
-def data_generator_1(train_classes, x_train, batch_size):
+class TripletSampler:
 
-    """ This function generates triplets to use for the triplets loss without data augmentation"""
+    """This class generates batches of triplets for the triplets loss. The indices of the images of every class
+    are computed once, anchors, positives and negatives are sampled as index arrays and every batch is gathered
+    from x_train with a single fancy-index. augment (e.g. a BatchAugmenter) is applied to the whole batch"""
+
+    def __init__(self, x_train, train_classes, batch_size, augment=None, seed=None):
+
+        self.x_train = x_train
+        self.batch_size = batch_size
+        self.augment = augment
+        self.rng = np.random.default_rng(seed)
+
+        # Class -> indices index: the images sorted by class, with the first position and the size of every class
+        self.classes, class_ids = np.unique(np.asarray(train_classes), return_inverse=True)
+        self.sorted_indices = np.argsort(class_ids, kind='stable')
+        self.class_counts = np.bincount(class_ids)
+        self.class_starts = np.concatenate([[0], np.cumsum(self.class_counts)[:-1]])
+        # Anchors need another image of their class as positive
+        self.anchor_classes = np.flatnonzero(self.class_counts >= 2)
+        assert len(self.anchor_classes) > 0 and len(self.classes) > 1, 'Triplets need two classes, one with two images'
+
+    def sample_indices(self, batch_size):
+
+        """This function returns the indices of the anchors, positives and negatives of a batch"""
+
+        rng = self.rng
+        pos_class = rng.choice(self.anchor_classes, batch_size)
+        # Negative class drawn uniformly among the other classes
+        neg_class = rng.integers(0, len(self.classes) - 1, batch_size)
+        neg_class += neg_class >= pos_class
+
+        counts = self.class_counts[pos_class]
+        anchor = rng.integers(0, counts)
+        positive = (anchor + rng.integers(1, counts)) % counts
+        negative = rng.integers(0, self.class_counts[neg_class])
+
+        starts = self.class_starts[pos_class]
+        return (self.sorted_indices[starts + anchor], self.sorted_indices[starts + positive],
+                self.sorted_indices[self.class_starts[neg_class] + negative])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        indices = np.concatenate(self.sample_indices(self.batch_size))
+        batch = self.x_train[indices]
+        if self.augment is not None:
+            batch = self.augment(batch)
+        Xa, Xp, Xn = np.split(batch, 3)
+        return [Xa, Xp, Xn], np.zeros((self.batch_size, 1), dtype="float32")
+
+
+class PKSampler(TripletSampler):
+
+    """This class generates P x K batches for the online triplet losses: P classes with K images each, labelled
+    with their class id. Classes with fewer than K images are sampled with repetition"""
+
+    def __init__(self, x_train, train_classes, P, K, augment=None, seed=None):
+
+        super().__init__(x_train, train_classes, P * K, augment, seed)
+        self.P = P
+        self.K = K
+
+    def sample_indices(self, batch_size=None):
+
+        """This function returns the indices and the class ids of the images of a batch"""
+
+        rng = self.rng
+        batch_classes = rng.choice(self.anchor_classes, self.P, replace=len(self.anchor_classes) < self.P)
+        counts = self.class_counts[batch_classes]
 
-    classes_list = list(set(train_classes))
+        # Random permutation of the images of every class, padded positions sort last
+        keys = rng.random((self.P, counts.max()))
+        keys[np.arange(counts.max())[None, :] >= counts[:, None]] = np.inf
+        offsets = np.argsort(keys, axis=1)[:, np.arange(self.K) % counts.max()] % counts[:, None]
 
-    while True:
-        a = []
-        p = []
-        n = []
-        for _ in range(batch_size):
-            pos_neg = random.sample(classes_list, 2)
-            positive_samples = random.sample(list(x_train[train_classes == pos_neg[0]]), 2)
-            negative_samples = random.choice(list(x_train[train_classes == pos_neg[1]]))
-            a.append(positive_samples[0])
-            p.append(positive_samples[1])
-            n.append(negative_samples)
+        indices = self.sorted_indices[self.class_starts[batch_classes][:, None] + offsets]
+        return indices.reshape(-1), np.repeat(batch_classes, self.K)
 
-        yield [np.array(a), np.array(p), np.array(n)], np.zeros((batch_size, 1)).astype("float32")
+    def __next__(self):
+        indices, labels = self.sample_indices()
+        batch = self.x_train[indices]
+        if self.augment is not None:
+            batch = self.augment(batch)
+        return batch, labels.astype("float32")
+
+
+def data_generator_1(train_classes, x_train, batch_size):
+
+    """ This function generates triplets to use for the triplets loss without data augmentation"""
+
+    return TripletSampler(x_train, train_classes, batch_size)
 
 
-        
 def data_generator(train_classes, X_train, batch_size):
 
     """ This function generates triplets to use for the triplets loss with data augmentation"""
 
-    # train classes retrieved by loader
-    # defined in main at row 104
-    classes_list = list(set(train_classes))
-    # X_train = list(X_train)
-    #while True:
-    for _ in range(batch_size):
-        a = []
-        p = []
-        n = []
-        pos_neg = random.sample(classes_list, 2)
-        positive_samples = random.sample(list(X_train[train_classes == pos_neg[0]]), 2)
-        negative_samples = random.choice(list(X_train[train_classes == pos_neg[1]]))
-        a.append(positive_samples[0])
-        p.append(positive_samples[1])
-        n.append(negative_samples)
-
-        trainGenAnchor, trainGenPositive, trainGenNegative = data_augmentation_triplet(np.array(a), np.array(p),
-                                                                                   np.array(n), batch_size)
-
-        while True:
-            Xa = trainGenAnchor.next()
-            Xp = trainGenPositive.next()
-            Xn = trainGenNegative.next()
-            yield [Xa[0], Xp[0], Xn[0]], Xa[1]
+    return TripletSampler(X_train, train_classes, batch_size, augment=BatchAugmenter())
 
 
 def triplet_loss(y_true, y_pred):
@@ -66,3 +118,58 @@ def triplet_loss(y_true, y_pred):
     neg_dist = K.sum(K.abs(anchor_out - negative_out), axis=1)
     probs = K.softmax([pos_dist, neg_dist], axis=0)
     return K.mean(K.abs(probs[0]) + K.abs(1.0 - probs[1]))
+
+
+def pairwise_distances(embeddings):
+
+    """This function returns the euclidean distances between all the embeddings of a batch"""
+
+    dot = tf.matmul(embeddings, embeddings, transpose_b=True)
+    square_norms = tf.linalg.diag_part(dot)
+    distances = tf.maximum(square_norms[:, None] - 2.0 * dot + square_norms[None, :], 0.0)
+    # The gradient of sqrt is infinite in 0
+    zeros = tf.cast(tf.equal(distances, 0.0), tf.float32)
+    return tf.sqrt(distances + zeros * 1e-16) * (1.0 - zeros)
+
+
+def online_triplet_loss(mining='batch_hard', margin=0.5):
+
+    """ This function returns the triplets loss mined inside a P x K batch: y_true are the class ids and y_pred
+    the embeddings of the shared encoder. batch_hard uses the farthest positive and the closest negative of every
+    anchor, semi_hard the closest negative farther than each positive, batch_all every valid triplet """
+
+    def loss(y_true, y_pred):
+        labels = tf.reshape(y_true, [-1])
+        distances = pairwise_distances(y_pred)
+        same_class = tf.equal(labels[:, None], labels[None, :])
+        positive_mask = tf.cast(tf.logical_and(same_class, tf.logical_not(tf.eye(tf.shape(labels)[0], dtype=tf.bool))),
+                                tf.float32)
+        negative_mask = tf.cast(tf.logical_not(same_class), tf.float32)
+
+        if mining == 'batch_hard':
+            hardest_positive = tf.reduce_max(distances * positive_mask, axis=1)
+            max_distance = tf.reduce_max(distances)
+            hardest_negative = tf.reduce_min(distances + max_distance * (1.0 - negative_mask), axis=1)
+            return tf.reduce_mean(tf.nn.relu(hardest_positive - hardest_negative + margin))
+
+        # Anchor-positive distances along axis 1, anchor-negative distances along axis 2
+        positive_dist = distances[:, :, None]
+        negative_dist = distances[:, None, :]
+        valid = positive_mask[:, :, None] * negative_mask[:, None, :]
+
+        if mining == 'batch_all':
+            triplets = tf.nn.relu(positive_dist - negative_dist + margin) * valid
+            n_active = tf.reduce_sum(tf.cast(triplets > 1e-16, tf.float32))
+            return tf.reduce_sum(triplets) / (n_active + 1e-16)
+
+        # semi_hard: the closest negative farther than the positive, else the farthest negative
+        outside = valid * tf.cast(negative_dist > positive_dist, tf.float32)
+        closest_outside = tf.reduce_min(negative_dist + (1.0 - outside) * 1e9, axis=2)
+        farthest_negative = tf.reduce_max(distances * negative_mask, axis=1)[:, None]
+        has_outside = tf.reduce_sum(outside, axis=2) > 0
+        negative = tf.where(has_outside, closest_outside, tf.broadcast_to(farthest_negative, tf.shape(closest_outside)))
+        triplets = tf.nn.relu(distances - negative + margin) * positive_mask
+        return tf.reduce_sum(triplets) / (tf.reduce_sum(positive_mask) + 1e-16)
+
+    loss.__name__ = mining + '_triplet_loss'
+    return loss
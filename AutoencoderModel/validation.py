@@ -0,0 +1,68 @@
+import os
+import argparse
+from image_loading import Loader
+from embedding_cache import EmbeddingCache, embed_with_cache
+from encoders import load_encoder
+
+
+def validation_parser(description, metric='minkowski', metric_help='metric to compute distance query-gallery'):
+
+    """This function returns the command line parser shared by the scripts evaluated on the validation split
+    (reduction.py, reranking.py): dataset, image size, model, metric, cache and workers"""
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--data_path',
+                        '-d',
+                        type=str,
+                        default='dataset',
+                        help='Dataset path, with the validation folder')
+    parser.add_argument('-img_size',
+                        type=int,
+                        default=324,
+                        help='image size for the model')
+    parser.add_argument('-channels',
+                        type=int,
+                        default=3,
+                        help='number of channels')
+    parser.add_argument('-model',
+                        type=str,
+                        default='convAE',
+                        help='Default model = convAE, other options: pretrained, triplets_loss')
+    parser.add_argument('-metric',
+                        type=str,
+                        default=metric,
+                        help=metric_help)
+    parser.add_argument('-cache',
+                        type=str,
+                        default='True',
+                        help='Reuse the embeddings cached on disk (default = True)')
+    parser.add_argument('-workers',
+                        type=int,
+                        default=None,
+                        help='number of threads used to decode the images (default = one per CPU)')
+    return parser
+
+
+def validation_embeddings(args):
+
+    """This function embeds the validation query and gallery images with the encoder of args.model, through the
+    embedding cache, and returns the query and gallery embeddings and classes"""
+
+    shape_img = (args.img_size, args.img_size, args.channels)
+    QueryDir = os.path.join(os.getcwd(), args.data_path, "validation", "query")
+    GalleryDir = os.path.join(os.getcwd(), args.data_path, "validation", "gallery")
+    OutputDir = os.path.join(os.getcwd(), "output", args.model)
+    CacheDir = os.path.join(OutputDir, "embedding_cache")
+
+    loader = Loader(args.img_size, args.img_size, args.channels)
+    embed, fingerprint = load_encoder(args.model, shape_img, OutputDir)
+    cache = EmbeddingCache(CacheDir, fingerprint) if args.cache == 'True' else None
+
+    def embed_paths(images_paths):
+        return embed(loader.read_images(images_paths, args.workers) / 255)
+
+    _, query_paths, query_classes = loader.get_data_names(loader.get_files(QueryDir, args.workers))
+    _, gallery_paths, gallery_classes = loader.get_data_names(loader.get_files(GalleryDir, args.workers))
+    E_query = embed_with_cache(query_paths, embed_paths, cache)
+    E_gallery = embed_with_cache(gallery_paths, embed_paths, cache)
+    return E_query, E_gallery, query_classes, gallery_classes